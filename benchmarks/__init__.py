@@ -0,0 +1,10 @@
+"""
+Benchmarks of the library, most of them measuring an implementation and the former one on the
+same workload. They are run as modules from the root of the repository, for instance:
+
+    python -m benchmarks.pipeline -n 10000
+
+Every benchmark prints its options with -h.
+"""
+
+__author__ = 'Giacomo Tanganelli'
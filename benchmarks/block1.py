@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the reassembly of a large body received with Block1, as a firmware image or a bulk
+content instance uploaded by POST or PUT.
+
+The blocks are written at their offset into a bytearray, allocated at once when the request
+announces the size of the body with Size1. The former implementation, which concatenated every
+block to the bytes received so far, is measured on the same blocks for comparison.
+"""
+
+from __future__ import annotations
+
+import getopt
+import sys
+import time
+from typing import Callable, Optional
+
+from coapthon import defines
+from coapthon.layers.blocklayer import BlockLayer
+from coapthon.messages.request import Request
+from coapthon.transaction import Transaction
+
+__author__ = 'Giacomo Tanganelli'
+
+
+def build_blocks(length:int, size:int, size1:Optional[int]) -> list[Request]:
+    """
+    The requests of an upload of length bytes, by blocks of size bytes.
+    """
+    body = bytes(i % 256 for i in range(length))
+    requests = []
+    for num, offset in enumerate(range(0, length, size)):
+        request = Request()
+        request.code = defines.Codes.POST.number
+        request.type = defines.Types["CON"]
+        request.mid = num % 0x10000
+        request.token = b"\x01"
+        request.source = ("127.0.0.1", 5683)
+        request.uri_path = "/firmware"
+        request.block1 = (num, 1 if offset + size < length else 0, size)
+        if num == 0 and size1 is not None:
+            request.size1 = size1
+        request.payload = body[offset:offset + size]
+        requests.append(request)
+    return requests
+
+
+def former_receive(requests:list[Request]) -> bytes:
+    """
+    The former reassembly: every block is concatenated to the bytes received so far.
+    """
+    payload = b""
+    for request in requests:
+        payload += request.payload
+    return payload
+
+
+def receive(requests:list[Request]) -> bytes:
+    """
+    Reassembly by the block layer.
+    """
+    layer = BlockLayer(max_block1_size=sys.maxsize, max_block1_total=sys.maxsize)
+    transaction = None
+    for request in requests:
+        transaction = layer.receive_request(Transaction(request))
+    return transaction.request.payload
+
+
+def bench(fn:Callable[[list[Request]], bytes], requests:list[Request], rounds:int=3) -> float:
+    """
+    Best time of an upload over the rounds.
+    """
+    best = None
+    for _ in range(rounds):
+        start = time.process_time()
+        fn(requests)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.block1 [-l length] [-s size]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    length = 16 * 1024 * 1024
+    size = 1024
+    try:
+        opts, args = getopt.getopt(argv, "hl:s:", ["length=", "size="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-l", "--length"):
+            length = int(arg)
+        elif opt in ("-s", "--size"):
+            size = int(arg)
+
+    print(f"upload of {length} bytes by blocks of {size} bytes")
+    with_size1 = build_blocks(length, size, length)
+    without_size1 = build_blocks(length, size, None)
+    print(f"  Size1, bytearray:    {bench(receive, with_size1) * 1e3:10.1f} ms")
+    print(f"  no Size1, bytearray: {bench(receive, without_size1) * 1e3:10.1f} ms")
+    print(f"  former, bytes:       {bench(former_receive, without_size1, 1) * 1e3:10.1f} ms")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the download of a large representation with Block2, as a firmware image or a log
+fetched by GET, through the request pipeline of the server.
+
+The representation rendered for the first block is pinned and the following blocks are sliced out
+of it without rendering the resource again. The former behaviour, in which every block ran the
+request pipeline and rendered the whole representation, is measured with a pinning budget of zero.
+"""
+
+from __future__ import annotations
+
+import getopt
+import socket
+import sys
+import time
+
+from coapthon import defines
+from coapthon.layers.blocklayer import BlockLayer
+from coapthon.messages.request import Request
+from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class FirmwareResource(Resource):
+    """
+    Resource with a large text representation, counting its renders.
+    """
+    def __init__(self, length:int) -> None:
+        super(FirmwareResource, self).__init__("Firmware", visible=True, observable=False, allow_children=False)
+        self.payload = "x" * length
+        self.renders = 0
+
+    def render_GET(self, request:Request) -> FirmwareResource:
+        self.renders += 1
+        return self
+
+
+def bench(length:int, pinned:int) -> tuple[float, int]:
+    """
+    Time of a download by blocks of 1024 bytes and number of renders of the resource.
+    """
+    server = CoAP(("127.0.0.1", 0), starting_mid=0x8000)
+    server._blockLayer = BlockLayer(max_block2_pinned=pinned)
+    resource = FirmwareResource(length)
+    server.add_resource("firmware", resource)
+    # the responses are sent to a socket that nobody reads
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    source = sink.getsockname()
+    try:
+        datagrams = []
+        for num in range((length + defines.MAX_PAYLOAD - 1) // defines.MAX_PAYLOAD):
+            request = Request()
+            request.type = defines.Types["CON"]
+            request.code = defines.Codes.GET.number
+            request.mid = num
+            request.token = b"\x01"
+            request.uri_path = "/firmware"
+            request.block2 = (num, 0, defines.MAX_PAYLOAD)
+            datagrams.append(Serializer.serialize(request))
+        start = time.perf_counter()
+        for datagram in datagrams:
+            server.receive_request(server._messageLayer.receive_request(Serializer.deserialize(datagram, source)))
+        return time.perf_counter() - start, resource.renders
+    finally:
+        server.close()
+        sink.close()
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.block2 [-l length]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    length = 1024 * 1024
+    try:
+        opts, args = getopt.getopt(argv, "hl:", ["length="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-l", "--length"):
+            length = int(arg)
+
+    print(f"download of {length} bytes by blocks of {defines.MAX_PAYLOAD} bytes")
+    elapsed, renders = bench(length, defines.MAX_BLOCK2_PINNED)
+    print(f"  pinned:   {elapsed * 1e3:10.1f} ms, {renders} renders")
+    elapsed, renders = bench(length, 0)
+    print(f"  rendered: {elapsed * 1e3:10.1f} ms, {renders} renders")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the discovery of the resources of a server, GET /.well-known/core, with many resources.
+
+The document is kept with its ETag until a resource is added or removed or attributes change, the
+filtered requests are answered from an index of the attributes. The former implementation, which
+built the document and checked the filters of every resource for every request, is measured on the
+same resources for comparison.
+
+The filtered documents of the last queries are kept too and the large ones are generated by Block2
+block, the time of one block is measured with the slicing done by the block layer.
+"""
+
+from __future__ import annotations
+
+import getopt
+import sys
+import time
+from typing import Callable, Optional
+
+from coapthon import defines
+from coapthon.layers.resourcelayer import ResourceLayer
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.transaction import Transaction
+from coapthon.utils import Tree
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Server(object):
+    """
+    The resource tree of a server, as used by the resource layer.
+    """
+    def __init__(self, resources:int) -> None:
+        self.root = Tree()
+        root = Resource("root", visible=False, observable=False)
+        root.path = "/"
+        self.root["/"] = root
+        for i in range(resources):
+            resource = Resource(f"sensor{i}")
+            resource.path = f"/sensors/sensor{i}"
+            resource.resource_type = ("temperature", "humidity", "pressure")[i % 3]
+            resource.interface_type = "sensor"
+            resource.add_content_type(0)
+            self.root[resource.path] = resource
+
+
+def former_valid(query:str, attributes:dict) -> bool:
+    """
+    The former check of the filters of a query, for one resource.
+    """
+    for q in query.split("&"):
+        tmp = q.split("=")
+        if len(tmp) > 1:
+            if tmp[0] not in attributes or tmp[1] != attributes[tmp[0]]:
+                return False
+    return True
+
+
+def former_discover(server:Server, transaction:Transaction) -> Transaction:
+    """
+    The former discovery: all the paths are sorted and all the links formatted for every request.
+    """
+    transaction.response.code = defines.Codes.CONTENT.number
+    payload = ""
+    for i in sorted(list(server.root.tree.keys())):
+        if i == "/":
+            continue
+        resource = server.root[i]
+        if resource.visible:
+            if former_valid(transaction.request.uri_query, resource.attributes):
+                msg = "<" + resource.path + ">;"
+                for k in sorted(list(resource.attributes.keys())):
+                    method = getattr(resource, defines.corelinkformat[k], None)
+                    if method is not None and method != "":
+                        msg = msg[:-1] + ";" + str(method) + ","
+                    else:
+                        v = resource.attributes[k]
+                        if v is not None:
+                            msg = msg[:-1] + ";" + k + "=" + v + ","
+                payload += msg
+    transaction.response.payload = bytes(payload, 'utf-8')
+    transaction.response.content_type = defines.Content_types["application/link-format"]
+    return transaction
+
+
+def build_transaction(query:Optional[str]=None, etag:Optional[bytes]=None) -> Transaction:
+    request = Request()
+    request.code = defines.Codes.GET.number
+    request.uri_path = defines.DISCOVERY_URL
+    if query is not None:
+        request.uri_query = query
+    if etag is not None:
+        request.etag = etag
+    transaction = Transaction(request)
+    transaction.response = Response()
+    return transaction
+
+
+def bench(discover:Callable[[Transaction], Transaction], count:int, query:Optional[str]=None,
+          etag:Optional[bytes]=None) -> float:
+    """
+    Best time per discovery request over 3 rounds.
+    """
+    best = None
+    for _ in range(3):
+        transactions = [build_transaction(query, etag) for _ in range(count)]
+        start = time.process_time()
+        for transaction in transactions:
+            discover(transaction)
+        elapsed = (time.process_time() - start) / count
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def block(discover:Callable[[Transaction], Transaction], num:int) -> Callable[[Transaction], bytes]:
+    """
+    Discovery of the block num of 1024 bytes, as sliced by the block layer.
+    """
+    def fn(transaction:Transaction) -> bytes:
+        payload = discover(transaction).response.payload
+        return payload[num * defines.MAX_PAYLOAD:(num + 1) * defines.MAX_PAYLOAD]
+    return fn
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.discovery [-r resources] [-n requests]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    resources = 10000
+    count = 100
+    try:
+        opts, args = getopt.getopt(argv, "hr:n:", ["resources=", "requests="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-r", "--resources"):
+            resources = int(arg)
+        elif opt in ("-n", "--requests"):
+            count = int(arg)
+
+    server = Server(resources)
+    layer = ResourceLayer(server)
+    start = time.process_time()
+    etag = layer.discover(build_transaction()).response.etag[0]
+    print(f"{resources} resources, document built in {(time.process_time() - start) * 1e3:.1f} ms")
+    print(f"  cached:         {bench(layer.discover, count) * 1e6:10.1f} us/request")
+    print(f"  cached, ETag:   {bench(layer.discover, count, etag=etag) * 1e6:10.1f} us/request")
+    print(f"  former:         {bench(lambda t: former_discover(server, t), max(1, count // 10)) * 1e6:10.1f} us/request")
+    print(f"  filtered:       {bench(layer.discover, max(1, count // 10), 'rt=humidity') * 1e6:10.1f} us/request")
+    print(f"  former, filter: {bench(lambda t: former_discover(server, t), max(1, count // 10), 'rt=humidity') * 1e6:10.1f} us/request")
+    print(f"  no match:       {bench(layer.discover, count, 'rt=humidity&if=actuator') * 1e6:10.1f} us/request")
+    print(f"  prefix:         {bench(layer.discover, max(1, count // 10), 'rt=hum*&if=sensor') * 1e6:10.1f} us/request")
+    print(f"  filtered block: {bench(block(layer.discover, 100), max(1, count // 10), 'rt=humidity') * 1e6:10.1f} us/block")
+    print(f"  former block:   {bench(block(lambda t: former_discover(server, t), 100), max(1, count // 10), 'rt=humidity') * 1e6:10.1f} us/block")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the download of a large representation with Block2 by a client, as a firmware image
+fetched by GET, over a link with a high latency.
+
+Once the first response gives the size of the representation with Size2, the client requests the
+following blocks several at a time and writes them at their offset. The former behaviour, one block
+requested after the other, is measured with a window of 1. A relay between the client and the
+server delays every datagram by half of the round trip time.
+"""
+
+from __future__ import annotations
+
+import getopt
+import heapq
+import socket
+import sys
+import threading
+import time
+
+from coapthon import defines
+from coapthon.client.helperclient import HelperClient
+from coapthon.messages.request import Request
+from coapthon.resources.resource import Resource
+from coapthon.server.coap import CoAP
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class FirmwareResource(Resource):
+    """
+    Resource with a large text representation.
+    """
+    def __init__(self, length:int) -> None:
+        super(FirmwareResource, self).__init__("Firmware", visible=True, observable=False, allow_children=False)
+        self.payload = "x" * length
+
+    def render_GET(self, request:Request) -> FirmwareResource:
+        return self
+
+
+class Relay(object):
+    """
+    UDP relay delaying the datagrams between a client and a server.
+    """
+    def __init__(self, server:defines.ServerT, delay:float) -> None:
+        self.server = server
+        self.delay = delay
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.settimeout(0.001)
+        self.address = self.socket.getsockname()
+        self.client:defines.ServerT = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        pending:list = []
+        while not self.stopped.is_set():
+            try:
+                datagram, source = self.socket.recvfrom(4096)
+                if source == self.server:
+                    destination = self.client
+                else:
+                    self.client = source
+                    destination = self.server
+                heapq.heappush(pending, (time.monotonic() + self.delay, id(datagram), datagram, destination))
+            except socket.timeout:
+                pass
+            while pending and pending[0][0] <= time.monotonic():
+                _, _, datagram, destination = heapq.heappop(pending)
+                self.socket.sendto(datagram, destination)
+
+    def close(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.socket.close()
+
+
+def bench(server:CoAP, length:int, rtt:float, window:int) -> float:
+    """
+    Time of a download by blocks of 1024 bytes.
+    """
+    relay = Relay(server._socket.getsockname(), rtt / 2)
+    client = HelperClient(relay.address, block2_window=window)
+    try:
+        start = time.perf_counter()
+        response = client.get("firmware", timeout=60)
+        elapsed = time.perf_counter() - start
+        assert response is not None and len(response.payload) == length
+        return elapsed
+    finally:
+        client.stop()
+        relay.close()
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.download [-l length] [-r rtt_ms] [-w window]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    length = 128 * 1024
+    rtt = 0.05
+    window = 8
+    try:
+        opts, args = getopt.getopt(argv, "hl:r:w:", ["length=", "rtt=", "window="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-l", "--length"):
+            length = int(arg)
+        elif opt in ("-r", "--rtt"):
+            rtt = float(arg) / 1000
+        elif opt in ("-w", "--window"):
+            window = int(arg)
+
+    server = CoAP(("127.0.0.1", 0), multicast=False)
+    server.add_resource("firmware/", FirmwareResource(length))
+    thread = threading.Thread(target=server.listen, args=(1,), daemon=True)
+    thread.start()
+    try:
+        print(f"download of {length} bytes by blocks of {defines.MAX_PAYLOAD} bytes, round trip of {rtt * 1e3:.0f} ms")
+        print(f"  window {window}: {bench(server, length, rtt, window) * 1e3:10.1f} ms")
+        print(f"  window 1: {bench(server, length, rtt, 1) * 1e3:10.1f} ms")
+    finally:
+        server.close()
+        thread.join(timeout=5)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Memory benchmark of the state kept by the threaded server: bytes per live transaction (a completed
+GET exchange still held by the message layer for duplicate detection) and per observe relation
+(the registration, its transaction and the messages it keeps).
+
+The requests go through the same path as in CoAP.receive_request, the responses are sent to a
+socket that nobody reads. Allocations are measured with tracemalloc.
+"""
+
+from __future__ import annotations
+
+import gc
+import getopt
+import socket
+import sys
+import tracemalloc
+
+from coapthon import defines
+from coapthon.messages.request import Request
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+from exampleresources import BasicResource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+def build_request(mid:int, observe:bool) -> Request:
+    request = Request()
+    request.type = defines.Types["CON"]
+    request.code = defines.Codes.GET.number
+    request.mid = mid
+    request.token = mid.to_bytes(4, "big")
+    request.uri_path = "/sensors/temperature/room1"
+    request.accept = defines.Content_types["text/plain"]
+    if observe:
+        request.observe = 0
+    return request
+
+
+def bench_memory(count:int, observe:bool) -> float:
+    """
+    Bytes allocated and still alive per exchange after count requests.
+    """
+    server = CoAP(("127.0.0.1", 0), max_transactions=None)
+    server.add_resource("sensors/temperature/room1", BasicResource())
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    source = sink.getsockname()
+    datagrams = [Serializer.serialize(build_request(mid, observe)) for mid in range(count)]
+    try:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for datagram in datagrams:
+            message = Serializer.deserialize(datagram, source)
+            transaction = server._messageLayer.receive_request(message)
+            server.receive_request(transaction)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        if observe:
+            assert len(server._observeLayer._relations) == count
+        return used / count
+    finally:
+        server.close()
+        sink.close()
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.memory [-n exchanges]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    count = 10000
+    try:
+        opts, args = getopt.getopt(argv, "hn:", ["exchanges="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-n", "--exchanges"):
+            count = int(arg)
+
+    print(f"live transaction: {bench_memory(count, False):8.0f} bytes")
+    print(f"observe relation: {bench_memory(count, True):8.0f} bytes")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
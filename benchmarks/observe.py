@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of ObserveLayer.notify with many observe relations spread over many resources.
+
+The relations are indexed by observed resource, so the cost of a notification depends on the
+observers of the changed resource only. The former implementation, which compared the resource
+of every relation of the server, is measured on the same relations for comparison.
+
+The fan-out of CoAP.notify to the observers of one resource is measured too, with the resource
+rendered once per representation and, for comparison, once per observer.
+
+Finally the time a PUT request spends on the request thread is measured with the notifications
+handed over to the notification dispatcher and, for comparison, sent before the response.
+"""
+
+from __future__ import annotations
+
+import getopt
+import random
+import socket
+import sys
+import time
+from typing import Callable, Optional
+
+from coapthon import defines
+from coapthon.layers.observelayer import ObserveLayer
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+from coapthon.transaction import Transaction
+from exampleresources import BasicResource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class SensorResource(BasicResource):
+    """
+    Resource whose text payload is replaced by PUT requests.
+    """
+    def render_PUT(self, request:Request) -> SensorResource:
+        self.payload = bytes(request.payload).decode("utf-8")
+        return self
+
+
+def build_layer(observers:int, resources:int) -> tuple[ObserveLayer, list[Resource]]:
+    """
+    Register the observers, each on a random resource, as the server does.
+    """
+    layer = ObserveLayer()
+    targets = [Resource(f"resource{i}") for i in range(resources)]
+    for i in range(observers):
+        request = Request()
+        request.type = defines.Types["NON"]
+        request.code = defines.Codes.GET.number
+        request.token = i.to_bytes(4, "big")
+        # up to 1000 clients with many relations each
+        request.source = (f"10.0.{i % 1000 // 256}.{i % 256}", 5683)
+        request.observe = 0
+        transaction = layer.receive_request(Transaction(request))
+        transaction.resource = random.choice(targets)
+        transaction.response = Response()
+        transaction.response.code = defines.Codes.CONTENT.number
+        layer.send_response(transaction)
+    return layer, targets
+
+
+def full_scan(layer:ObserveLayer, resource:Resource) -> list[Transaction]:
+    """
+    The former lookup of ObserveLayer.notify: every relation of the server is visited.
+    """
+    return [item.transaction for item in layer._relations.values() if item.transaction.resource in [resource]]
+
+
+def bench(notify:Callable, layer:ObserveLayer, resources:list[Resource], count:int) -> tuple[float, float]:
+    """
+    Time per notification and average number of notified observers.
+    """
+    changed = [random.choice(resources) for _ in range(count)]
+    notified = 0
+    start = time.perf_counter()
+    for resource in changed:
+        notified += len(notify(resource))
+    return (time.perf_counter() - start) / count, notified / count
+
+
+def bench_fan_out(observers:int, count:int, shared:bool) -> float:
+    """
+    Time per notification of a resource observed by all the observers, with NON requests.
+    """
+    server = CoAP(("127.0.0.1", 0))
+    resource = BasicResource()
+    server.add_resource("sensors/temperature/room1", resource)
+    # the notifications are sent to a socket that nobody reads
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    source = sink.getsockname()
+    representation_key = ObserveLayer.representation_key
+    if not shared:
+        # the former fan-out: every notification is rendered and encoded
+        ObserveLayer.representation_key = staticmethod(lambda request: None)  # type:ignore[assignment]
+    try:
+        for i in range(observers):
+            request = Request()
+            request.type = defines.Types["NON"]
+            request.code = defines.Codes.GET.number
+            request.mid = i
+            request.token = i.to_bytes(4, "big")
+            request.uri_path = "/sensors/temperature/room1"
+            request.observe = 0
+            message = Serializer.deserialize(Serializer.serialize(request), source)
+            server.receive_request(server._messageLayer.receive_request(message))
+        start = time.perf_counter()
+        for _ in range(count):
+            resource.observe_count += 1
+            server.notify(resource)
+        return (time.perf_counter() - start) / count
+    finally:
+        ObserveLayer.representation_key = representation_key  # type:ignore[assignment]
+        server.close()
+        sink.close()
+
+
+def bench_write(observers:int, count:int, notifiers:Optional[int]) -> float:
+    """
+    Time per PUT request on a resource observed by all the observers, with NON requests.
+    """
+    # the MIDs of the server do not collide with the ones of the requests, sent from the same socket
+    server = CoAP(("127.0.0.1", 0), starting_mid=0x8000, notifiers=notifiers)
+    resource = SensorResource()
+    server.add_resource("sensors/temperature/room1", resource)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    source = sink.getsockname()
+    try:
+        mid = 0
+        for i in range(observers):
+            request = Request()
+            request.type = defines.Types["NON"]
+            request.code = defines.Codes.GET.number
+            request.mid = mid
+            request.token = i.to_bytes(4, "big")
+            request.uri_path = "/sensors/temperature/room1"
+            request.observe = 0
+            message = Serializer.deserialize(Serializer.serialize(request), source)
+            server.receive_request(server._messageLayer.receive_request(message))
+            mid += 1
+        datagrams = []
+        for i in range(count):
+            request = Request()
+            request.type = defines.Types["NON"]
+            request.code = defines.Codes.PUT.number
+            request.mid = mid
+            request.token = mid.to_bytes(4, "big")
+            request.uri_path = "/sensors/temperature/room1"
+            request.payload = f"{20 + i % 10}"
+            datagrams.append(Serializer.serialize(request))
+            mid += 1
+        elapsed = 0.0
+        for datagram in datagrams:
+            start = time.perf_counter()
+            server.receive_request(server._messageLayer.receive_request(Serializer.deserialize(datagram, source)))
+            elapsed += time.perf_counter() - start
+            # let the dispatcher catch up, only the request thread is measured
+            while notifiers is not None and server.notification_stats()["queue_depth"] > 0:
+                time.sleep(0.001)
+        return elapsed / count
+    finally:
+        server.close()
+        sink.close()
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.observe [-o observers] [-r resources] [-n notifications]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    observers = 100000
+    resources = 10000
+    count = 1000
+    try:
+        opts, args = getopt.getopt(argv, "ho:r:n:", ["observers=", "resources=", "notifications="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-o", "--observers"):
+            observers = int(arg)
+        elif opt in ("-r", "--resources"):
+            resources = int(arg)
+        elif opt in ("-n", "--notifications"):
+            count = int(arg)
+
+    random.seed(1)
+    layer, targets = build_layer(observers, resources)
+    print(f"{observers} observers on {resources} resources")
+    elapsed, notified = bench(layer.notify, layer, targets, count)
+    print(f"  indexed notify: {elapsed * 1e6:10.1f} us/notification ({notified:.1f} observers)")
+    elapsed, notified = bench(lambda resource: full_scan(layer, resource), layer, targets, max(1, count // 100))
+    print(f"  full scan:      {elapsed * 1e6:10.1f} us/notification ({notified:.1f} observers)")
+
+    print("fan-out to 1000 observers of one resource")
+    print(f"  rendered once:         {bench_fan_out(1000, 20, True) * 1e3:8.2f} ms/notification")
+    print(f"  rendered per observer: {bench_fan_out(1000, 20, False) * 1e3:8.2f} ms/notification")
+
+    print("PUT on a resource observed by 1, 100 and 1000 observers")
+    for observed in (1, 100, 1000):
+        dispatched = bench_write(observed, 20, 1)
+        inline = bench_write(observed, 20, None)
+        print(f"  {observed:5d} observers: dispatched {dispatched * 1e3:8.2f} ms/request, inline {inline * 1e3:8.2f} ms/request")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the request pipeline of the threaded server, without the socket receive loop.
+
+Every request is deserialized, matched by the message layer and processed by the block, observe,
+request and resource layers as CoAP.receive_request does, then the response is serialized and
+sent. The cost of the option accessors used by the layers is also measured on its own.
+"""
+
+from __future__ import annotations
+
+import getopt
+import socket
+import sys
+import time
+
+from coapthon import defines
+from coapthon.messages.request import Request
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+from exampleresources import BasicResource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+def build_request(mid:int) -> Request:
+    request = Request()
+    request.type = defines.Types["CON"]
+    request.code = defines.Codes.GET.number
+    request.mid = mid
+    request.token = mid.to_bytes(4, "big")
+    request.uri_path = "/sensors/temperature/room1"
+    request.uri_query = "unit=C&precision=1"
+    request.accept = defines.Content_types["text/plain"]
+    request.etag = [b"\x01\x02", b"\x03\x04"]
+    return request
+
+
+def bench_pipeline(count:int, rounds:int=5) -> float:
+    """
+    Best time per request over a number of rounds, the server threads and the other processes of
+    the host make single rounds noisy.
+    """
+    server = CoAP(("127.0.0.1", 0))
+    server.add_resource("sensors/temperature/room1", BasicResource())
+    # the responses are sent to a socket that nobody reads
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    source = sink.getsockname()
+    best = float("inf")
+    try:
+        for i in range(rounds):
+            # new MIDs in every round, retransmissions take another path
+            datagrams = [Serializer.serialize(build_request((i * count + mid) % 65536)) for mid in range(count)]
+            start = time.process_time()
+            for datagram in datagrams:
+                message = Serializer.deserialize(datagram, source)
+                transaction = server._messageLayer.receive_request(message)
+                server.receive_request(transaction)
+            best = min(best, (time.process_time() - start) / count)
+        return best
+    finally:
+        server.close()
+        sink.close()
+
+
+def bench_accessors(count:int) -> float:
+    request = Serializer.deserialize(Serializer.serialize(build_request(1)), ("127.0.0.1", 5683))
+    start = time.perf_counter()
+    for _ in range(count):
+        request.uri_path
+        request.uri_query
+        request.observe
+        request.block1
+        request.block2
+        request.size1
+        request.size2
+        request.accept
+        request.content_type
+        request.etag
+        request.proxy_uri
+        request.if_none_match
+    return (time.perf_counter() - start) / count
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.pipeline [-n requests]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    count = 5000
+    try:
+        opts, args = getopt.getopt(argv, "hn:", ["requests="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-n", "--requests"):
+            count = int(arg)
+
+    print(f"option accessors: {bench_accessors(count) * 1e6:.2f} us per set of 12 accesses")
+    print(f"request pipeline: {bench_pipeline(count) * 1e6:.2f} us/request")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
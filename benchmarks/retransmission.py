@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the retransmission of confirmable messages.
+
+Starts many concurrent CON exchanges, acknowledges half of them after the first retransmission and
+lets the other half give up. Compares the shared scheduler with the former thread per message.
+"""
+
+from __future__ import annotations
+
+import getopt
+import sys
+import threading
+import time
+
+from coapthon import defines
+from coapthon.messages.message import Message
+from coapthon.scheduler import Retransmitter, Scheduler
+from coapthon.transaction import Transaction
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Counters(object):
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.given_up = 0
+        self.done = threading.Event()
+        self.expected = 0
+
+    def send(self, message:Message) -> None:
+        with self.lock:
+            self.sent += 1
+
+    def give_up(self, transaction:Transaction, message:Message) -> None:
+        with self.lock:
+            self.given_up += 1
+            if self.given_up == self.expected:
+                self.done.set()
+
+
+def build_exchanges(count:int) -> list[tuple[Transaction, Message]]:
+    exchanges = []
+    for i in range(count):
+        message = Message()
+        message.type = defines.Types["CON"]
+        message.mid = i % 65535
+        exchanges.append((Transaction(), message))
+    return exchanges
+
+
+def thread_retransmit(counters:Counters, message:Message, stop:threading.Event) -> None:
+    """
+    The former implementation: one thread per message sleeping on its own Event.
+    """
+    future_time = defines.ACK_TIMEOUT
+    retransmit_count = 0
+    while retransmit_count < defines.MAX_RETRANSMIT and not message.acknowledged:
+        stop.wait(timeout=future_time)
+        if not message.acknowledged:
+            retransmit_count += 1
+            future_time *= 2
+            counters.send(message)
+    if not message.acknowledged:
+        counters.give_up(None, message)
+
+
+def bench(mode:str, count:int) -> None:
+    counters = Counters()
+    counters.expected = count - count // 2
+    exchanges = build_exchanges(count)
+    peak_threads = threading.active_count()
+
+    start = time.perf_counter()
+    if mode == "scheduler":
+        scheduler = Scheduler()
+        retransmitter = Retransmitter(counters.send, counters.give_up, scheduler=scheduler)
+        for transaction, message in exchanges:
+            retransmitter.start(transaction, message)
+    else:
+        stops = []
+        for transaction, message in exchanges:
+            stop = threading.Event()
+            stops.append(stop)
+            threading.Thread(target=thread_retransmit, args=(counters, message, stop), daemon=True).start()
+    setup = time.perf_counter() - start
+    peak_threads = max(peak_threads, threading.active_count())
+
+    # acknowledge half of the exchanges after the first retransmission
+    time.sleep(defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR * 1.5)
+    peak_threads = max(peak_threads, threading.active_count())
+    ack_start = time.perf_counter()
+    for i, (transaction, message) in enumerate(exchanges):
+        if i % 2 == 0:
+            message.acknowledged = True
+            if mode == "scheduler":
+                if transaction.retransmit_handle is not None:
+                    transaction.retransmit_handle.cancel()
+            else:
+                stops[i].set()
+    ack = time.perf_counter() - ack_start
+
+    counters.done.wait(timeout=defines.MAX_TRANSMIT_SPAN * 4)
+    elapsed = time.perf_counter() - start
+    if mode == "scheduler":
+        scheduler.stop()
+
+    print(f"{mode:>9}: {count} exchanges, setup {setup * 1000:.1f} ms, ack {ack * 1000:.1f} ms, "
+          f"peak threads {peak_threads}, sent {counters.sent}, given up {counters.given_up}, total {elapsed:.2f}s")
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.retransmission [-m scheduler|threads|all] [-n exchanges] [-t ack_timeout]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    modes = ["scheduler", "threads"]
+    count = 10000
+    try:
+        opts, args = getopt.getopt(argv, "hm:n:t:", ["mode=", "exchanges=", "timeout="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    # scale the timers down so that the benchmark runs in a few seconds
+    defines.ACK_TIMEOUT = 0.1
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-m", "--mode"):
+            modes = ["scheduler", "threads"] if arg == "all" else [arg]
+        elif opt in ("-n", "--exchanges"):
+            count = int(arg)
+        elif opt in ("-t", "--timeout"):
+            defines.ACK_TIMEOUT = float(arg)
+    defines.MAX_TRANSMIT_SPAN = defines.ACK_TIMEOUT * (pow(2, (defines.MAX_RETRANSMIT + 1)) - 1) * defines.ACK_RANDOM_FACTOR
+
+    for mode in modes:
+        bench(mode, count)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the serialization of typical messages: a GET response, an observe notification and
+a Block2 response. Reports messages per second, optionally compared with the serializer of a
+previous revision (a copy of its serializer.py passed with -r).
+
+Serialization is also measured for an unchanged message, whose wire encoding is reused as for
+retransmissions and duplicate answers. Deserialization is measured twice: reading only the header and the token, as the duplicate
+filtering and the proxies do, and reading every option and the payload.
+"""
+
+from __future__ import annotations
+
+import getopt
+import importlib.util
+import sys
+import time
+from typing import Callable, Optional
+
+from coapthon import defines
+from coapthon.messages.response import Response
+from coapthon.serializer import Serializer
+
+__author__ = 'Giacomo Tanganelli'
+
+
+def get_response() -> Response:
+    response = Response()
+    response.type = defines.Types["ACK"]
+    response.code = defines.Codes.CONTENT.number
+    response.mid = 4321
+    response.token = b"\x1a\x2b\x3c\x4d"
+    response.content_type = defines.Content_types["application/json"]
+    response.max_age = 60
+    response.etag = b"\x01\x02\x03\x04"
+    response.payload = '{"temperature": 21.5, "unit": "C"}'
+    return response
+
+
+def observe_response() -> Response:
+    response = get_response()
+    response.type = defines.Types["CON"]
+    response.observe = 1234567
+    return response
+
+
+def block2_response() -> Response:
+    response = get_response()
+    del response.content_type
+    response.content_type = defines.Content_types["application/octet-stream"]
+    response.payload = bytes(range(256)) * 4
+    response.block2 = (3, 1, 1024)
+    response.size2 = 16384
+    return response
+
+
+def bench(serialize:Callable, message:Response, count:int, cached:bool=False) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        if not cached:
+            # drop the wire encoding kept by the previous iteration
+            message.datagram = None
+        serialize(message)
+    return count / (time.perf_counter() - start)
+
+
+def bench_header(deserialize:Callable, datagram:bytes, count:int) -> float:
+    source = ("127.0.0.1", 5683)
+    start = time.perf_counter()
+    for _ in range(count):
+        deserialize(datagram, source).token
+    return count / (time.perf_counter() - start)
+
+
+def bench_full(deserialize:Callable, datagram:bytes, count:int) -> float:
+    source = ("127.0.0.1", 5683)
+    start = time.perf_counter()
+    for _ in range(count):
+        message = deserialize(datagram, source)
+        for option in message.options:
+            option.value
+        message.payload
+    return count / (time.perf_counter() - start)
+
+
+def load_reference(path:str) -> type:
+    spec = importlib.util.spec_from_file_location("reference_serializer", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Serializer
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.serializer [-n messages] [-r reference_serializer.py]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    count = 100000
+    reference:Optional[type] = None
+    try:
+        opts, args = getopt.getopt(argv, "hn:r:", ["messages=", "reference="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-n", "--messages"):
+            count = int(arg)
+        elif opt in ("-r", "--reference"):
+            reference = load_reference(arg)
+
+    for name, build in (("GET", get_response), ("observe", observe_response), ("block2", block2_response)):
+        message = build()
+        datagram = Serializer.serialize(message)
+        print(f"{name} ({len(datagram)} bytes)")
+        print(f"  serialize:          {bench(Serializer.serialize, message, count):10.0f} msg/s", end="")
+        if reference is not None:
+            if bytes(reference.serialize(message)) != datagram:
+                print(" (output differs from the reference!)", end="")
+            print(f", reference {bench(reference.serialize, message, count):10.0f} msg/s", end="")
+        print()
+        print(f"  serialize, cached:  {bench(Serializer.serialize, message, count, True):10.0f} msg/s")
+        print(f"  deserialize header: {bench_header(Serializer.deserialize, datagram, count):10.0f} msg/s", end="")
+        if reference is not None:
+            print(f", reference {bench_header(reference.deserialize, datagram, count):10.0f} msg/s", end="")
+        print()
+        print(f"  deserialize full:   {bench_full(Serializer.deserialize, datagram, count):10.0f} msg/s", end="")
+        if reference is not None:
+            print(f", reference {bench_full(reference.deserialize, datagram, count):10.0f} msg/s", end="")
+        print()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Loopback benchmark for the CoAP server engines.
+
+Starts a server engine on the loopback interface and drives it with a raw UDP client that
+keeps a fixed window of confirmable GET requests in flight. Reports the throughput and the
+latency percentiles of the piggybacked responses.
+"""
+
+from __future__ import annotations
+from typing import Optional
+
+import getopt
+import socket
+import sys
+import threading
+import time
+
+from coapthon import defines
+from coapthon.messages.request import Request
+from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP as ThreadedCoAP
+from coapthon.server.coap_asyncio import CoAP as AsyncioCoAP
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class BenchResource(Resource):
+    def __init__(self, name:Optional[str]="Bench") -> None:
+        super(BenchResource, self).__init__(name, visible=True, observable=False, allow_children=False)
+        self.payload = "benchmark payload"
+
+    def render_GET(self, request:Request) -> Resource:
+        return self
+
+
+def build_requests(count:int, server:defines.ServerT) -> list[bytes]:
+    """
+    Serialize all requests up front so that the client does not measure its own encoding.
+    """
+    datagrams = []
+    for i in range(count):
+        request = Request()
+        request.destination = server
+        request.type = defines.Types["CON"]
+        request.code = defines.Codes.GET.number
+        request.mid = i % 65535
+        request.token = (i % 65535).to_bytes(2, "big")
+        request.uri_path = "bench"
+        datagrams.append(Serializer.serialize(request))
+    return datagrams
+
+
+def run_client(server:defines.ServerT, count:int, window:int, timeout:float) -> tuple[float, list[float], int]:
+    """
+    Send count requests keeping window requests in flight.
+
+    :return: elapsed time, the list of latencies and the number of lost requests
+    """
+    datagrams = build_requests(count, server)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    pending:dict[int, float] = {}
+    latencies:list[float] = []
+    lost = 0
+    sent = 0
+    start = time.perf_counter()
+    while sent < count or pending:
+        while sent < count and len(pending) < window:
+            pending[sent % 65535] = time.perf_counter()
+            sock.sendto(datagrams[sent], server)
+            sent += 1
+        try:
+            data, _ = sock.recvfrom(4096)
+        except socket.timeout:
+            lost += len(pending)
+            pending.clear()
+            continue
+        mid = int.from_bytes(data[2:4], "big")
+        t = pending.pop(mid, None)
+        if t is not None:
+            latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return elapsed, latencies, lost
+
+
+def percentile(values:list[float], p:float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def bench_engine(engine:str, port:int, count:int, window:int, workers:int) -> None:
+    server_address = ("127.0.0.1", port)
+    if engine == "asyncio":
+        server:ThreadedCoAP|AsyncioCoAP = AsyncioCoAP(server_address)
+    elif engine == "pool":
+        server = ThreadedCoAP(server_address, workers=workers)
+    else:
+        server = ThreadedCoAP(server_address)
+    server.add_resource("bench/", BenchResource())
+    thread = threading.Thread(target=server.listen, args=(1,))
+    thread.daemon = True
+    thread.start()
+    time.sleep(0.5)
+
+    # warm up
+    run_client(server_address, min(500, count), window, 2.0)
+    elapsed, latencies, lost = run_client(server_address, count, window, 2.0)
+
+    stats = server.worker_stats() if isinstance(server, ThreadedCoAP) else None
+    server.close()
+    thread.join(timeout=5)
+
+    done = len(latencies)
+    print(f"{engine:>9}: {done} responses in {elapsed:.2f}s, {done / elapsed:.0f} req/s, "
+          f"p50 {percentile(latencies, 50) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms, lost {lost}")
+    if stats is not None:
+        print(f"{'':>9}  shed {stats['shed']}, queue wait avg {stats['wait_avg'] * 1000:.2f} ms, "
+              f"max {stats['wait_max'] * 1000:.2f} ms")
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.server [-e threaded|pool|asyncio|all] [-n requests] [-w window] [-t workers] [-p port]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    engines = ["threaded", "pool", "asyncio"]
+    workers = 8
+    count = 20000
+    window = 32
+    port = 5693
+    try:
+        opts, args = getopt.getopt(argv, "he:n:w:t:p:", ["engine=", "requests=", "window=", "workers=", "port="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-e", "--engine"):
+            engines = ["threaded", "pool", "asyncio"] if arg == "all" else [arg]
+        elif opt in ("-n", "--requests"):
+            count = int(arg)
+        elif opt in ("-w", "--window"):
+            window = int(arg)
+        elif opt in ("-t", "--workers"):
+            workers = int(arg)
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+
+    for i, engine in enumerate(engines):
+        bench_engine(engine, port + i, count, window, workers)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
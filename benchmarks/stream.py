@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the first Block2 response of a large file, as a log or an image, served by GET.
+
+A StreamResource reads the window of the block from the file only and takes Size2 from the size of
+the file. A Resource whose payload is the content of the file, the former way to serve it, is
+measured for comparison: its representation is copied and encoded in full for the request.
+"""
+
+from __future__ import annotations
+
+import getopt
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from coapthon import defines
+from coapthon.layers.blocklayer import BlockLayer
+from coapthon.layers.resourcelayer import ResourceLayer
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.resources.streamResource import StreamResource
+from coapthon.transaction import Transaction
+from coapthon.utils import Tree
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Server(object):
+    """
+    The resource tree of a server, as used by the resource layer.
+    """
+    def __init__(self, resource:Resource) -> None:
+        self.root = Tree()
+        root = Resource("root", visible=False, observable=False)
+        root.path = "/"
+        self.root["/"] = root
+        resource.path = "/log"
+        self.root["/log"] = resource
+
+
+class LogResource(Resource):
+    """
+    Resource whose payload is the content of the file.
+    """
+    def render_GET(self, request:Request) -> LogResource:
+        return self
+
+
+def first_block(server:Server) -> tuple[float, int]:
+    """
+    Time and peak of allocated memory of the first block.
+    """
+    layer = ResourceLayer(server)
+    block_layer = BlockLayer()
+    request = Request()
+    request.code = defines.Codes.GET.number
+    request.token = b"\x01"
+    request.source = ("127.0.0.1", 5683)
+    request.uri_path = "/log"
+    tracemalloc.start()
+    start = time.perf_counter()
+    transaction = block_layer.receive_request(Transaction(request))
+    transaction.resource = server.root["/log"]
+    transaction.response = Response()
+    layer.get_resource(transaction)
+    block_layer.send_response(transaction)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.stream [-l length]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    length = 64 * 1024 * 1024
+    try:
+        opts, args = getopt.getopt(argv, "hl:", ["length="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-l", "--length"):
+            length = int(arg)
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        line = b"2026-01-01T00:00:00 sensor1 temperature 21.5\n"
+        f.write(line * (length // len(line)))
+    try:
+        print(f"first block of a file of {os.path.getsize(f.name)} bytes")
+        elapsed, peak = first_block(Server(StreamResource("log", f.name)))
+        print(f"  stream:  {elapsed * 1e3:10.2f} ms, {peak / 1024:10.1f} KiB allocated")
+        resource = LogResource("log")
+        with open(f.name, "rb") as log:
+            resource.payload = log.read().decode("utf-8")
+        elapsed, peak = first_block(Server(resource))
+        print(f"  payload: {elapsed * 1e3:10.2f} ms, {peak / 1024:10.1f} KiB allocated")
+    finally:
+        os.remove(f.name)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of the transaction lookups of the message layer.
+
+Compares the former string keys (utils.str_append_hash, plus getaddrinfo for the multicast
+fallback) with the tuple keys of utils.TransactionTable, and measures the per-message cost of
+MessageLayer.receive_request and MessageLayer.receive_empty.
+"""
+
+from __future__ import annotations
+
+import getopt
+import socket
+import sys
+import time
+
+from coapthon import defines, utils
+from coapthon.layers.messagelayer import MessageLayer
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+
+__author__ = 'Giacomo Tanganelli'
+
+
+def bench_string_keys(count:int, host:str, port:int) -> float:
+    """
+    Lookup cost of the former keys: MID and token, unicast and multicast, as done for every ACK.
+    """
+    table = {utils.str_append_hash(host, port, mid): mid for mid in range(count)}
+    token = b"\x01\x02\x03\x04"
+    start = time.perf_counter()
+    for mid in range(count):
+        all_coap_nodes = defines.ALL_COAP_NODES_IPV6 if socket.getaddrinfo(host, None)[0][0] == socket.AF_INET6 else defines.ALL_COAP_NODES
+        key_mid = utils.str_append_hash(host, port, mid)
+        utils.str_append_hash(all_coap_nodes, port, mid)
+        utils.str_append_hash(host, port, token)
+        utils.str_append_hash(all_coap_nodes, port, token)
+        table.get(key_mid)
+    return (time.perf_counter() - start) / count
+
+
+def bench_tuple_keys(count:int, host:str, port:int) -> float:
+    """
+    Lookup cost of the tuple keys: the multicast keys are only built on a miss.
+    """
+    table = utils.TransactionTable(None)
+    for mid in range(count):
+        table[utils.TransactionTable.key(host, port, mid)] = mid
+    start = time.perf_counter()
+    key = utils.TransactionTable.key
+    for mid in range(count):
+        table.get(key(host, port, mid))
+    return (time.perf_counter() - start) / count
+
+
+def bench_message_layer(count:int, host:str, port:int) -> tuple[float, float]:
+    """
+    Per-message cost of receiving a request and of matching its ACK.
+    """
+    layer = MessageLayer(0, max_transactions=None)
+    requests = []
+    acks = []
+    for i in range(count):
+        request = Request()
+        request.type = defines.Types["CON"]
+        request.code = defines.Codes.GET.number
+        request.mid = i % 65534
+        request.token = i.to_bytes(4, "big")
+        request.source = (host, port)
+        requests.append(request)
+        ack = Message()
+        ack.type = defines.Types["ACK"]
+        # a MID that no request uses, so that the ACK is matched by token
+        ack.mid = 65534
+        ack.token = request.token
+        ack.source = (host, port)
+        acks.append(ack)
+
+    start = time.perf_counter()
+    for request in requests:
+        layer.receive_request(request)
+    receive = (time.perf_counter() - start) / count
+
+    start = time.perf_counter()
+    for ack in acks:
+        layer.receive_empty(ack)
+    empty = (time.perf_counter() - start) / count
+    return receive, empty
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.transactions [-n messages]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    count = 50000
+    try:
+        opts, args = getopt.getopt(argv, "hn:", ["messages="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-n", "--messages"):
+            count = int(arg)
+
+    host, port = "127.0.0.1", 5683
+    print(f"string keys:  {bench_string_keys(count, host, port) * 1e6:.2f} us/message")
+    print(f"tuple keys:   {bench_tuple_keys(count, host, port) * 1e6:.2f} us/message")
+    receive, empty = bench_message_layer(count, host, port)
+    print(f"MessageLayer: receive_request {receive * 1e6:.2f} us/message, receive_empty by token {empty * 1e6:.2f} us/message")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the resource tree with many resources: the longest registered prefix of a path, as
+looked up for every POST and every request of the reverse proxy, and the ordered list of the paths,
+as built for every discovery request.
+
+The former implementation, a dictionary whose keys were all compared with str.startswith and sorted
+by dump, is measured on the same paths for comparison.
+"""
+
+from __future__ import annotations
+
+import getopt
+import random
+import sys
+import time
+from typing import Callable
+
+from coapthon.utils import Tree
+
+__author__ = 'Giacomo Tanganelli'
+
+
+def build_paths(resources:int) -> list[str]:
+    """
+    Paths of up to four segments, with 10 children per node.
+    """
+    paths = ["/"]
+    level = [""]
+    while len(paths) < resources:
+        following = []
+        for parent in level:
+            for i in range(10):
+                following.append(f"{parent}/node{i}")
+        level = following
+        paths.extend(level[:resources - len(paths)])
+    return paths
+
+
+def scan_longest_prefix(tree:dict, path:str) -> str:
+    """
+    The former lookup: every key of the tree is compared, then the longest match is kept.
+    """
+    ret = "/"
+    for key in list(tree.keys()):
+        if path.startswith(key) and len(key) > len(ret):
+            ret = key
+    return ret
+
+
+def bench(fn:Callable, arguments:list, rounds:int=5) -> float:
+    """
+    Best time per call over the rounds.
+    """
+    best = None
+    for _ in range(rounds):
+        start = time.process_time()
+        for argument in arguments:
+            fn(argument)
+        elapsed = (time.process_time() - start) / len(arguments)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.tree [-r resources] [-n lookups]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    resources = 100000
+    count = 1000
+    try:
+        opts, args = getopt.getopt(argv, "hr:n:", ["resources=", "lookups="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-r", "--resources"):
+            resources = int(arg)
+        elif opt in ("-n", "--lookups"):
+            count = int(arg)
+
+    random.seed(1)
+    paths = build_paths(resources)
+    tree = Tree()
+    for path in paths:
+        tree[path] = path
+    # POST to a new child of a random resource
+    posted = [random.choice(paths).rstrip("/") + "/new" for _ in range(count)]
+    scanned = posted[:max(1, count // 100)]
+
+    print(f"{len(tree)} resources")
+    print(f"  longest prefix trie: {bench(tree.longest_prefix, posted) * 1e6:10.1f} us/lookup")
+    print(f"  longest prefix scan: {bench(lambda path: scan_longest_prefix(tree.tree, path), scanned, 1) * 1e6:10.1f} us/lookup")
+    print(f"  first dump trie:     {bench(lambda _: tree._walk(tree._root), [None], 3) * 1e3:10.1f} ms")
+    print(f"  dump trie:           {bench(lambda _: tree.dump(), [None], 3) * 1e3:10.1f} ms")
+    print(f"  dump sorted:         {bench(lambda _: sorted(tree.tree.keys()), [None], 3) * 1e3:10.1f} ms")
+    print(f"  subtree of 1111:     {bench(lambda _: tree.subtree('/node1/node2'), [None] * 100) * 1e6:10.1f} us")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
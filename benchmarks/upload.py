@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the memory of a client uploading a large file with Block1, as a firmware image or a
+bulk content instance sent by a gateway.
+
+The file object is given to the block layer, which reads one block for each request. The former
+way, in which the payload of the request was the content of the file, is measured for comparison.
+The blocks are acknowledged by the block layer of the client as if the server had sent 2.31.
+"""
+
+from __future__ import annotations
+
+import getopt
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any
+
+from coapthon import defines
+from coapthon.layers.blocklayer import BlockLayer
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.streamResource import FileStream
+from coapthon.transaction import Transaction
+
+__author__ = 'Giacomo Tanganelli'
+
+
+def upload(payload:Any) -> tuple[float, int, int]:
+    """
+    Time, peak of allocated memory and number of blocks of an upload.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    layer = BlockLayer()
+    request = Request()
+    request.code = defines.Codes.POST.number
+    request.destination = ("127.0.0.1", 5683)
+    request.token = b"\x01"
+    request.uri_path = "/firmware"
+    request.payload = payload() if callable(payload) else payload
+    request = layer.send_request(request)
+    transaction = Transaction(request)
+    blocks = 1
+    while True:
+        response = Response()
+        response.source = request.destination
+        response.token = request.token
+        num, m, size = transaction.request.block1
+        response.code = defines.Codes.CONTINUE.number if m else defines.Codes.CHANGED.number
+        response.block1 = (num, m, size)
+        transaction.response = response
+        layer.receive_response(transaction)
+        if not transaction.block_transfer:
+            break
+        blocks += 1
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, blocks
+
+
+def usage() -> None:  # pragma: no cover
+    print("python -m benchmarks.upload [-l length]")
+
+
+def main(argv:list[str]) -> None:  # pragma: no cover
+    length = 16 * 1024 * 1024
+    try:
+        opts, args = getopt.getopt(argv, "hl:", ["length="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-l", "--length"):
+            length = int(arg)
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(length))
+    try:
+        print(f"upload of a file of {length} bytes")
+        with open(f.name, "rb") as firmware:
+            elapsed, peak, blocks = upload(lambda: FileStream(firmware))
+        print(f"  file object: {elapsed * 1e3:10.1f} ms, {peak / 1024:10.1f} KiB allocated, {blocks} blocks")
+        with open(f.name, "rb") as firmware:
+            elapsed, peak, blocks = upload(firmware.read)
+        print(f"  payload:     {elapsed * 1e3:10.1f} ms, {peak / 1024:10.1f} KiB allocated, {blocks} blocks")
+    finally:
+        os.remove(f.name)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -155,6 +155,8 @@ class for the element contained in the cache
 
 
 class CacheElement(object):
+	__slots__ = ("freshness", "key", "cached_response", "max_age", "creation_time", "uri")
+
 	def __init__(self, cache_key:Union[CacheKey, ReverseCacheKey], response:Response, request:Request,  max_age:Optional[int]=60) -> None:
 		"""
 
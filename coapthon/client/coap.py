@@ -13,10 +13,8 @@ from __future__ import annotations
 from typing import Optional, Callable, TYPE_CHECKING
 
 import logging
-import random
 import socket
 import threading
-import time
 import collections
 
 from coapthon import defines
@@ -27,6 +25,7 @@ from coapthon.layers.requestlayer import RequestLayer
 from coapthon.messages.message import Message
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
+from coapthon.scheduler import Retransmitter
 from coapthon.serializer import Serializer
 from coapthon.utils import generate_random_token
 
@@ -44,7 +43,7 @@ class CoAP(object):
     """
     Client class to perform requests to remote servers.
     """
-    def __init__(self, server:defines.ServerT, starting_mid:int, callback:Callable, sock:Optional[socket.socket]=None, cb_ignore_read_exception:Optional[Callable]=None, cb_ignore_write_exception:Optional[Callable]=None) -> None:
+    def __init__(self, server:defines.ServerT, starting_mid:int, callback:Callable, sock:Optional[socket.socket]=None, cb_ignore_read_exception:Optional[Callable]=None, cb_ignore_write_exception:Optional[Callable]=None, block2_window:int=defines.BLOCK2_WINDOW) -> None:
         """
         Initialize the client.
 
@@ -54,6 +53,7 @@ class CoAP(object):
         :param sock: if a socket has been created externally, it can be used directly
         :param cb_ignore_read_exception: Callback function to handle exception raised during the socket read operation
         :param cb_ignore_write_exception: Callback function to handle exception raised during the socket write operation        
+        :param block2_window: the Block2 requests sent at once once the size of a representation is known
         """
         self._currentMID = starting_mid
         self._server = server
@@ -61,12 +61,14 @@ class CoAP(object):
         self._cb_ignore_read_exception = cb_ignore_read_exception
         self._cb_ignore_write_exception = cb_ignore_write_exception
         self.stopped = threading.Event()
-        self.to_be_stopped:list[threading.Event] = []
 
-        self._messageLayer = MessageLayer(self._currentMID)
-        self._blockLayer = BlockLayer()
+        # the token of an observation must stay known however long the notifications take, the exchanges
+        # are only deleted by purge_transactions
+        self._messageLayer = MessageLayer(self._currentMID, None, None)
+        self._blockLayer = BlockLayer(block2_window=block2_window)
         self._observeLayer = ObserveLayer()
         self._requestLayer = RequestLayer(self)
+        self._retransmitter = Retransmitter(self.send_datagram, self._retransmission_timeout, self.stopped)
 
         addrinfo = socket.getaddrinfo(self._server[0], None)[0]
 
@@ -82,6 +84,8 @@ class CoAP(object):
             self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         self._receiver_thread:Optional[threading.Thread] = None
+        # requests given up by the retransmitter, reported to the callback by the receiver thread
+        self._timeouts:collections.deque[Transaction] = collections.deque()
         
         # akr: store the server IP address and port for later default use in client requests
         self._server_ip = addrinfo[4][0]
@@ -100,8 +104,6 @@ class CoAP(object):
 
         """
         self.stopped.set()
-        for event in self.to_be_stopped:
-            event.set()
         if self._receiver_thread is not None:
             self._receiver_thread.join()
         # self._socket.close()
@@ -161,26 +163,14 @@ class CoAP(object):
             message = self._messageLayer.send_empty(None, None, message)
             self.send_datagram(message)
 
-    @staticmethod
-    def _wait_for_retransmit_thread(transaction:Transaction) -> None:
-        """
-        Only one retransmit thread at a time, wait for other to finish
-        
-        """
-        if hasattr(transaction, 'retransmit_thread'):
-            while transaction.retransmit_thread is not None:
-                logger.debug("Waiting for retransmit thread to finish ...")
-                time.sleep(0.01)
-                continue
-
-    def _send_block_request(self, transaction:Transaction) -> None:
+    def _send_block_request(self, request:Request) -> None:
         """
         A former request resulted in a block wise transfer. With this method, the block wise transfer
         will be continued, including triggering of the retry mechanism.
         
-        :param transaction: The former transaction including the request which should be continued.
+        :param request: The request of the next block of the transfer.
         """
-        transaction = self._messageLayer.send_request(transaction.request)
+        transaction = self._messageLayer.send_request(request)
         # ... but don't forget to reset the acknowledge flag
         transaction.request.acknowledged = False
         self.send_datagram(transaction.request)
@@ -226,55 +216,17 @@ class CoAP(object):
         :type message: Message
         :param message: the message that needs the retransmission task
         """
-        with transaction:
-            if message.type == defines.Types['CON']:
-                future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
-                transaction.retransmit_stop = threading.Event()
-                self.to_be_stopped.append(transaction.retransmit_stop)
-                transaction.retransmit_thread = threading.Thread(target=self._retransmit,
-                                                                 name=str('%s-Retry-%d' % (threading.current_thread().name, message.mid)),
-                                                                 args=(transaction, message, future_time, 0))
-                transaction.retransmit_thread.start()
-
-    def _retransmit(self, transaction:Transaction, message:Message, future_time:float, retransmit_count:int) -> None:
-        """
-        Thread function to retransmit the message in the future
+        self._retransmitter.start(transaction, message)
 
-        :param transaction: the transaction that owns the message that needs retransmission
-        :param message: the message that needs the retransmission task
-        :param future_time: the amount of time to wait before a new attempt
-        :param retransmit_count: the number of retransmissions
+    def _retransmission_timeout(self, transaction:Transaction, message:Message) -> None:
         """
-        with transaction:
-            logger.debug("retransmit loop ... enter")
-            while retransmit_count <= defines.MAX_RETRANSMIT \
-                    and (not message.acknowledged and not message.rejected) \
-                    and not transaction.retransmit_stop.isSet():
-                transaction.retransmit_stop.wait(timeout=future_time)
-                if not message.acknowledged and not message.rejected and not transaction.retransmit_stop.isSet():
-                    retransmit_count += 1
-                    future_time *= 2
-                    if retransmit_count < defines.MAX_RETRANSMIT:
-                        logger.debug("retransmit loop ... retransmit Request")
-                        self.send_datagram(message)
-
-            if message.acknowledged or message.rejected:
-                message.timeouted = False
-            else:
-                logger.warning("Give up on message {message}".format(message=message.line_print))
-                message.timeouted = True
+        Called when a message has not been acknowledged after all the retransmissions.
 
-                # Inform the user, that nothing was received
-                self._callback(None)
-
-            try:
-                self.to_be_stopped.remove(transaction.retransmit_stop)
-            except ValueError:
-                pass
-            transaction.retransmit_stop = None
-            transaction.retransmit_thread = None
-
-            logger.debug("retransmit loop ... exit")
+        :param transaction: the transaction that owns the message
+        :param message: the message that timed out
+        """
+        # the callback must not run on the scheduler thread, shared by every timer
+        self._timeouts.append(transaction)
 
     def receive_datagram(self) -> None:
         """
@@ -282,6 +234,10 @@ class CoAP(object):
         """
         logger.debug("Start receiver Thread")
         while not self.stopped.isSet():
+            while self._timeouts:
+                self._timeouts.popleft()
+                # Inform the user, that nothing was received
+                self._callback(None)
             self._socket.settimeout(0.1)
             try:
                 datagram, addr = self._socket.recvfrom(1500)
@@ -313,12 +269,12 @@ class CoAP(object):
                 transaction, send_ack = self._messageLayer.receive_response(message)
                 if transaction is None:  # pragma: no cover
                     continue
-                self._wait_for_retransmit_thread(transaction)
                 if send_ack:
                     self._send_ack(transaction)
                 self._blockLayer.receive_response(transaction)
                 if transaction.block_transfer:
-                    self._send_block_request(transaction)
+                    for request in self._blockLayer.block_requests(transaction):
+                        self._send_block_request(request)
                     continue
                 elif transaction is None:  # pragma: no cover
                     self._send_rst(transaction)
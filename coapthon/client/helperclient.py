@@ -12,11 +12,14 @@
 #	Overview about the patches:
 #
 #	- Fixed: when receiving a response, the response is put back into the queue if the response is not for the request (.mid attribute)
+#	- POST and PUT payloads read from a file object or an iterator, one block at a time
+#	- Block2 responses fetched several blocks at a time, with block2_window
 #
 
 from __future__ import annotations
-from typing import Callable, Any, Optional
+from typing import Callable, Any, Iterable, Optional, Union, BinaryIO, cast
 
+import io
 import random
 # from multiprocessing import Queue
 from queue import Queue	# akr replace with a normal queue
@@ -29,6 +32,7 @@ from coapthon import defines
 from coapthon.client.coap import CoAP
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
+from coapthon.resources.streamResource import BufferStream, FileStream, IteratorStream, Stream
 from coapthon.utils import generate_random_token
 
 __author__ = 'Giacomo Tanganelli'
@@ -38,7 +42,7 @@ class HelperClient(object):
     """
     Helper Client class to perform requests to remote servers in a simplified way.
     """
-    def __init__(self, server:defines.ServerT, sock:socket.socket=None, cb_ignore_read_exception:Callable=None, cb_ignore_write_exception:Callable=None) -> None:
+    def __init__(self, server:defines.ServerT, sock:socket.socket=None, cb_ignore_read_exception:Callable=None, cb_ignore_write_exception:Callable=None, block2_window:int=defines.BLOCK2_WINDOW) -> None:
         """
         Initialize a client to perform request to a server.
 
@@ -46,10 +50,13 @@ class HelperClient(object):
         :param sock: if a socket has been created externally, it can be used directly
         :param cb_ignore_read_exception: Callback function to handle exception raised during the socket read operation
         :param cb_ignore_write_exception: Callback function to handle exception raised during the socket write operation 
+        :param block2_window: the Block2 requests sent at once once the size of a representation is known, 1
+            to request one block at a time
         """
         self.server = server
         self.protocol = CoAP(self.server, random.randint(1, 65535), self._wait_response, sock=sock,
-                             cb_ignore_read_exception=cb_ignore_read_exception, cb_ignore_write_exception=cb_ignore_write_exception)
+                             cb_ignore_read_exception=cb_ignore_read_exception, cb_ignore_write_exception=cb_ignore_write_exception,
+                             block2_window=block2_window)
         self.queue:Queue = Queue()
 
     def _wait_response(self, message:Message) -> None:
@@ -175,19 +182,22 @@ class HelperClient(object):
 
         return self.send_request(request, callback, timeout)
 
-    def post(self, path:str, payload:bytes, callback:Optional[Callable]=None, timeout:Optional[int]=None, no_response:Optional[bool]=False, **kwargs:Any) -> Response:  # pragma: no cover
+    def post(self, path:str, payload:Union[bytes, BinaryIO, Iterable[bytes]], callback:Optional[Callable]=None, timeout:Optional[int]=None, no_response:Optional[bool]=False,
+             progress:Optional[Callable[[int, Optional[int]], None]]=None, **kwargs:Any) -> Response:  # pragma: no cover
         """
         Perform a POST on a certain path.
 
         :param path: the path
-        :param payload: the request payload
+        :param payload: the request payload, or a binary file object or an iterator of chunks read one block at a time
         :param callback: the callback function to invoke upon response
         :param timeout: the timeout of the request
+        :param progress: the function called with the bytes acknowledged by the server and the total size, None if
+            not known, during a blockwise transfer
         :return: the response
         """
         request = self.mk_request(defines.Codes.POST, path)
         request.token = generate_random_token(2)
-        request.payload = payload
+        request.payload = self._upload(payload, progress)
 
         if no_response:
             request.add_no_response()
@@ -199,19 +209,22 @@ class HelperClient(object):
 
         return self.send_request(request, callback, timeout, no_response=no_response)
 
-    def put(self, path:str, payload:bytes, callback:Optional[Callable]=None, timeout:Optional[int]=None, no_response:Optional[bool]=False, **kwargs:Any) -> Optional[Response]:  # pragma: no cover
+    def put(self, path:str, payload:Union[bytes, BinaryIO, Iterable[bytes]], callback:Optional[Callable]=None, timeout:Optional[int]=None, no_response:Optional[bool]=False,
+             progress:Optional[Callable[[int, Optional[int]], None]]=None, **kwargs:Any) -> Optional[Response]:  # pragma: no cover
         """
         Perform a PUT on a certain path.
 
         :param path: the path
-        :param payload: the request payload
+        :param payload: the request payload, or a binary file object or an iterator of chunks read one block at a time
         :param callback: the callback function to invoke upon response
         :param timeout: the timeout of the request
+        :param progress: the function called with the bytes acknowledged by the server and the total size, None if
+            not known, during a blockwise transfer
         :return: the response
         """
         request = self.mk_request(defines.Codes.PUT, path)
         request.token = generate_random_token(2)
-        request.payload = payload
+        request.payload = self._upload(payload, progress)
 
         if no_response:
             request.add_no_response()
@@ -223,6 +236,30 @@ class HelperClient(object):
 
         return self.send_request(request, callback, timeout, no_response=no_response)
 
+    @staticmethod
+    def _upload(payload:Union[bytes, BinaryIO, Iterable[bytes]], progress:Optional[Callable[[int, Optional[int]], None]]) -> Union[bytes, Stream]:
+        """
+        Prepare the payload of a POST or PUT. A file object or an iterator is read by the block layer one block at a
+        time, a seekable file from its current position to its end.
+
+        :param payload: the payload
+        :param progress: the function called with the progress of the upload
+        :return: the payload of the request
+        """
+        if payload is None or (isinstance(payload, (bytes, str)) and progress is None):
+            return payload
+        if isinstance(payload, (bytes, str)):
+            stream:Stream = BufferStream(payload.encode("utf-8") if isinstance(payload, str) else payload)
+        elif isinstance(payload, io.IOBase):
+            if payload.seekable():
+                stream = FileStream(cast(BinaryIO, payload), payload.tell())
+            else:
+                stream = IteratorStream(iter(lambda: payload.read(defines.MAX_PAYLOAD), b""))
+        else:
+            stream = IteratorStream(payload)
+        stream.progress = progress
+        return stream
+
     def discover(self, callback:Optional[Callable]=None, timeout:Optional[float]=None, **kwargs:Any) -> Optional[Response]:  # pragma: no cover
         """
         Perform a Discover request on the server.
@@ -38,6 +38,39 @@ MAX_NON_NOTIFICATIONS = 10
 
 BLOCKWISE_SIZE = 1024
 
+# Maximum number of exchanges tracked by the message layer, the oldest ones are dropped beyond it
+MAX_TRANSACTIONS = 65536
+
+# Requests waiting for a worker of the server pool before new ones are shed with 5.03
+WORKER_QUEUE_SIZE = 256
+
+# Max-Age sent with 5.03 responses of shed requests, as a retry hint for the client
+SHED_MAX_AGE = 2
+
+# Seconds the server waits for each of its worker and notifier threads when it is closed
+SHUTDOWN_TIMEOUT = 5
+
+# Changed resources waiting for the notification dispatcher, the further changes are dropped
+NOTIFICATION_QUEUE_SIZE = 1024
+
+# Largest body received with Block1, larger ones are refused with 4.13 Request Entity Too Large
+MAX_BLOCK1_SIZE = 16 * 1024 * 1024
+
+# Bytes of all the bodies being received with Block1, the blocks beyond are refused with 5.03
+MAX_BLOCK1_TOTAL = 64 * 1024 * 1024
+
+# Bytes of all the representations pinned for the following blocks of Block2 transfers
+MAX_BLOCK2_PINNED = 64 * 1024 * 1024
+
+# Block2 requests a client sends at once once Size2 is known, 1 fetches one block at a time as NSTART
+BLOCK2_WINDOW = 1
+
+# Documents of filtered discovery queries kept for the following Block2 requests
+DISCOVERY_DOCUMENTS = 16
+
+# Observe relations notified at once by a thread of the notification dispatcher
+NOTIFICATION_BATCH_SIZE = 32
+
 """  Message Format """
 
 # number of bits used for the encoding of the CoAP version field.
@@ -1,7 +1,6 @@
 from __future__ import annotations
 from typing import Tuple, Any, Union, cast
 import logging
-import random
 import socket
 import struct
 import threading
@@ -17,6 +16,7 @@ from coapthon.transaction import Transaction
 from coapthon.messages.message import Message
 from coapthon.messages.request import Request
 from coapthon.resources.resource import Resource
+from coapthon.scheduler import Retransmitter, TimerHandle, get_deadline_queue
 from coapthon.serializer import Serializer
 from coapthon.utils import Tree
 from coapthon.defines import ServerT
@@ -42,7 +42,6 @@ class CoAP(object):
         """
         self.stopped = threading.Event()
         self.stopped.clear()
-        self.to_be_stopped:list[threading.Event] = []
         self.purgeThread = threading.Thread(target=self.purge)
         self.purgeThread.start()
         self.cache_enable = cache
@@ -58,6 +57,9 @@ class CoAP(object):
 
         self._forwardLayer = ForwardLayer(self)
         self.resourceLayer = ResourceLayer(self)
+        self._retransmitter = Retransmitter(self.send_datagram, self._retransmission_timeout, self.stopped)
+        self._separate_timers = get_deadline_queue(defines.ACK_TIMEOUT)
+        self._ack_lock = threading.Lock()
 
         # Resource directory
         root = Resource('root', self, visible=False, observable=False, allow_children=True)
@@ -157,8 +159,6 @@ class CoAP(object):
         """
         logger.debug("Stop server")
         self.stopped.set()
-        for event in self.to_be_stopped:
-            event.set()
         # self._socket.close()
 
     def receive_datagram(self, args:Tuple[Any, Union[defines.ServerT, Tuple[str, int, Any, Any]]]) -> None:
@@ -212,7 +212,8 @@ class CoAP(object):
 
             if transaction.block_transfer:
                 self._stop_separate_timer(transaction.separate_timer)
-                transaction = self._messageLayer.send_response(transaction)
+                with self._ack_lock:
+                    transaction = self._messageLayer.send_response(transaction)
                 self.send_datagram(transaction.response)
                 return
 
@@ -244,7 +245,8 @@ class CoAP(object):
 
             self._stop_separate_timer(transaction.separate_timer)
 
-            transaction = self._messageLayer.send_response(transaction)
+            with self._ack_lock:
+                transaction = self._messageLayer.send_response(transaction)
 
             if transaction.response is not None:
                 if transaction.response.type == defines.Types["CON"]:
@@ -285,66 +287,34 @@ class CoAP(object):
         :type message: Message
         :param message: the message that needs the retransmission task
         """
-        with transaction:
-            if message.type == defines.Types['CON']:
-                future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
-                transaction.retransmit_thread = threading.Thread(target=self._retransmit,
-                                                                 args=(transaction, message, future_time, 0))
-                transaction.retransmit_stop = threading.Event()
-                self.to_be_stopped.append(transaction.retransmit_stop)
-                transaction.retransmit_thread.start()
-
-    def _retransmit(self, transaction:Transaction, message:Message, future_time:float, retransmit_count:int) -> None:
-        """
-        Thread function to retransmit the message in the future
+        self._retransmitter.start(transaction, message)
 
-        :param transaction: the transaction that owns the message that needs retransmission
-        :param message: the message that needs the retransmission task
-        :param future_time: the amount of time to wait before a new attempt
-        :param retransmit_count: the number of retransmissions
+    def _retransmission_timeout(self, transaction:Transaction, message:Message) -> None:
         """
-        with transaction:
-            while retransmit_count < defines.MAX_RETRANSMIT and (not message.acknowledged and not message.rejected) \
-                    and not self.stopped.isSet():
-                transaction.retransmit_stop.wait(timeout=future_time)
-                if not message.acknowledged and not message.rejected and not self.stopped.isSet():
-                    retransmit_count += 1
-                    future_time *= 2
-                    self.send_datagram(message)
-
-            if message.acknowledged or message.rejected:
-                message.timeouted = False
-            else:
-                logger.warning("Give up on message {message}".format(message=message.line_print))
-                message.timeouted = True
-                if message.observe is not None:
-                    self._observeLayer.remove_subscriber(message)
+        Called when a message has not been acknowledged after all the retransmissions.
 
-            try:
-                self.to_be_stopped.remove(transaction.retransmit_stop)
-            except ValueError:
-                pass
-            transaction.retransmit_stop = None
-            transaction.retransmit_thread = None
+        :param transaction: the transaction that owns the message
+        :param message: the message that timed out
+        """
+        if message.observe is not None:
+            self._observeLayer.remove_subscriber(message)
 
-    def _start_separate_timer(self, transaction:Transaction) -> threading.Timer:
+    def _start_separate_timer(self, transaction:Transaction) -> TimerHandle:
         """
-        Start a thread to handle separate mode.
+        Schedule the empty ACK sent in separate mode if the request is not answered within ACK_TIMEOUT.
 
         :type transaction: Transaction
         :param transaction: the transaction that is in processing
-        :rtype : the Timer object
+        :rtype : the handle of the timer
         """
-        t = threading.Timer(defines.ACK_TIMEOUT, self._send_ack, (transaction,))
-        t.start()
-        return t
+        return self._separate_timers.add(self._send_ack, transaction)
 
     @staticmethod
-    def _stop_separate_timer(timer:threading.Timer) -> None:
+    def _stop_separate_timer(timer:TimerHandle) -> None:
         """
-        Stop the separate Thread if an answer has been already provided to the client.
+        Stop the separate timer if an answer has been already provided to the client.
 
-        :param timer: The Timer object
+        :param timer: The handle of the timer
         """
         timer.cancel()
 
@@ -358,6 +328,7 @@ class CoAP(object):
         ack = Message()
         ack.type = defines.Types['ACK']
 
-        if not transaction.request.acknowledged:
-            ack = self._messageLayer.send_empty(transaction, transaction.request, ack)
-            self.send_datagram(ack)
+        with self._ack_lock:
+            if not transaction.request.acknowledged:
+                ack = self._messageLayer.send_empty(transaction, transaction.request, ack)
+                self.send_datagram(ack)
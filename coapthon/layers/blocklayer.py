@@ -12,33 +12,45 @@
 #	Overview about the patches:
 #
 #	- Small tweaks to fixed blocking tranfers
+#	- Block1 bodies reassembled in a bytearray, with limits and expiry of the sessions
+#	- Block2 representations pinned for the following blocks, which are served without rendering
+#	- Block2 representations read from a stream, one window at a time
+#	- Block1 requests of a client read from a stream, one block at a time
+#	- Block2 responses fetched by a client several blocks at a time once Size2 is known
 #
 
 from __future__ import annotations
-from typing import Optional, TYPE_CHECKING
+from typing import Optional, Tuple, Union, cast, TYPE_CHECKING
 
+import collections
 import logging
+import threading
+import time
 
 from coapthon import defines
 from coapthon import utils
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
+from coapthon.resources.streamResource import Stream
 
 if TYPE_CHECKING:
 	from coapthon.messages.message import Message
 	from coapthon.messages.option import Option
 	from coapthon.transaction import Transaction 
+	from coapthon.layers.resourcelayer import LinkDocument
 
 logger = logging.getLogger(__name__)
 
 __author__ = 'Giacomo Tanganelli'
 
 class BlockItem(object):
+	__slots__ = ("byte", "num", "m", "size", "payload", "content_type", "options", "code", "offsets", "pin")
+
 	def __init__(self, 	byte:int, 
 			  			num:int, 
 						m:int, 
 						size:int, 
-						payload:Optional[bytes]=None, 
+						payload:Optional[Union[bytes, bytearray, memoryview, LinkDocument, Stream]]=None, 
 						content_type:Optional[int]=None, 
 						options:Optional[list[Option]]=None, 
 						code:Optional[int]=None) -> None:
@@ -62,6 +74,44 @@ class BlockItem(object):
 		self.content_type = content_type
 		self.options = options			# akr
 		self.code = code	# akr
+		# the offset of every block received -> the end of the block, for the Block1 sessions
+		self.offsets:Optional[dict[int, int]] = None
+		# the key of the pinned representation, for the Block2 sessions
+		self.pin:Optional[tuple] = None
+
+
+class BlockDownload(object):
+	"""
+	A Block2 transfer of a client whose blocks are requested several at a time, and written at their offset
+	into a buffer of the size given by Size2.
+	"""
+	__slots__ = ("request", "size", "total", "payload", "received", "next", "retries", "requests",
+				 "content_type", "etag")
+
+	def __init__(self, request:Request, size:int, length:int, content_type:Optional[int],
+				 etag:Optional[bytes]) -> None:
+		"""
+		Initialize a download.
+
+		:param request: the request of the first block
+		:param size: the size of the blocks
+		:param length: the size of the representation
+		:param content_type: the Content-Format of the first block
+		:param etag: the ETag of the first block
+		"""
+		self.request = request
+		self.size = size
+		self.total = (length + size - 1) // size
+		self.payload = bytearray(length)
+		self.received:set[int] = set()
+		# the next block not requested yet
+		self.next = 1
+		# num -> the times the block has been requested again
+		self.retries:dict[int, int] = {}
+		# the requests to send
+		self.requests:list[Request] = []
+		self.content_type = content_type
+		self.etag = etag
 
 
 def _filterOptions(options:list[Option]) -> list[Option]:
@@ -82,11 +132,42 @@ class BlockLayer(object):
 	"""
 	Handle the Blockwise options. Hides all the exchange to both servers and clients.
 	"""
-	def __init__(self) -> None:
-		self._block1_sent:dict[int, BlockItem] = {}  
-		self._block2_sent:dict[int, BlockItem]  = {}  
-		self._block1_receive:dict[int, BlockItem]  = {} 
-		self._block2_receive:dict[int, BlockItem]  = {}  
+	def __init__(self, max_block1_size:int=defines.MAX_BLOCK1_SIZE, max_block1_total:int=defines.MAX_BLOCK1_TOTAL,
+				 block1_lifetime:Optional[float]=defines.EXCHANGE_LIFETIME,
+				 max_block2_pinned:int=defines.MAX_BLOCK2_PINNED,
+				 block2_lifetime:Optional[float]=defines.EXCHANGE_LIFETIME,
+				 block2_window:int=defines.BLOCK2_WINDOW) -> None:
+		"""
+		Initialize a Block Layer.
+
+		:param max_block1_size: the maximum size of a body received with Block1, larger ones are refused with 4.13
+		:param max_block1_total: the maximum size of all the bodies being received with Block1, the blocks beyond
+			are refused with 5.03
+		:param block1_lifetime: the time in seconds after which a Block1 session without new blocks is dropped
+		:param max_block2_pinned: the maximum size of all the representations pinned for Block2 transfers, the
+			oldest ones are dropped beyond
+		:param block2_lifetime: the time in seconds after which a Block2 session, or a pinned representation,
+			without new requests is dropped
+		:param block2_window: the Block2 requests a client sends at once once the size of the representation is
+			known, 1 to request one block at a time
+		"""
+		self._block1_sent = utils.TransactionTable(None)
+		self._block2_sent = utils.TransactionTable(None)
+		self._block1_receive = utils.TransactionTable(block1_lifetime)
+		self._block2_receive = utils.TransactionTable(block2_lifetime)
+		self._max_block1_size = max_block1_size
+		self._max_block1_total = max_block1_total
+		# the bytes allocated by the Block1 sessions, may include sessions expired since
+		self._block1_bytes = 0
+		self._block1_lock = threading.Lock()
+		# pin key -> (representation, expiry time), the least recently used first
+		self._pinned:collections.OrderedDict[tuple, Tuple[memoryview, float]] = collections.OrderedDict()
+		self._pinned_bytes = 0
+		self._max_block2_pinned = max_block2_pinned
+		self._block2_lifetime = block2_lifetime
+		self._block2_lock = threading.Lock()
+		self._block2_window = block2_window
+		self._downloads = utils.TransactionTable(defines.EXCHANGE_LIFETIME)
 
 	def receive_request(self, transaction:Transaction) -> Optional[Transaction]:
 		"""
@@ -99,12 +180,25 @@ class BlockLayer(object):
 		"""
 		if transaction.request.block2 is not None:
 			host, port = transaction.request.source
-			key_token = utils.str_append_hash(host, port, transaction.request.token)
+			key_token = utils.TransactionTable.key(host, port, transaction.request.token)
 			num, m, size = transaction.request.block2
-			if key_token in self._block2_receive:
-				self._block2_receive[key_token].num = num
-				self._block2_receive[key_token].size = size
-				self._block2_receive[key_token].m = m
+			item = self._block2_receive.get(key_token)
+			if item is not None:
+				item.num = num
+				item.size = size
+				item.m = m
+				# the requested block, also when it is fetched again or the size has changed
+				item.byte = num * size
+				self._block2_receive.touch(key_token)
+				if item.pin is not None and item.pin[:2] == (transaction.request.uri_path, transaction.request.uri_query):
+					representation = item.payload if isinstance(item.payload, Stream) else self._pinned_payload(item.pin)
+					if representation is not None:
+						# the block is sliced out of the representation of the first one, without rendering
+						transaction.block_transfer = True
+						transaction.response = Response()
+						transaction.response.destination = transaction.request.source
+						transaction.response.token = transaction.request.token
+						return self._send_block(transaction, key_token, item, representation, num, size)
 				# del transaction.request.block2
 				# print(transaction.request.block2)
 
@@ -117,50 +211,81 @@ class BlockLayer(object):
 		elif transaction.request.block1 is not None:
 			# POST or PUT
 			host, port = transaction.request.source
-			key_token = utils.str_append_hash(host, port, transaction.request.token)
+			key_token = utils.TransactionTable.key(host, port, transaction.request.token)
 			num, m, size = transaction.request.block1
-			if transaction.request.size1 is not None:
-				# What to do if the size1 is larger than the maximum resource size or the maxium server buffer
-				pass
-			if key_token in self._block1_receive:
-				# n-th block
-				content_type = transaction.request.content_type
-				if num != self._block1_receive[key_token].num \
-						or content_type != self._block1_receive[key_token].content_type:
-					# Error Incomplete
-					return self.incomplete(transaction)
-				self._block1_receive[key_token].payload += transaction.request.payload
-			else:
+			payload = cast(bytes, transaction.request.payload) if transaction.request.payload is not None else b""
+			content_type = transaction.request.content_type
+			item = self._block1_receive.get(key_token)
+			if item is None:
 				# first block
 				if num != 0:
 					# Error Incomplete
 					return self.incomplete(transaction)
-				content_type = transaction.request.content_type
-				self._block1_receive[key_token] = BlockItem(size, num, m, size, transaction.request.payload, content_type)
-
+				size1 = transaction.request.size1
+				if size1 is not None and size1 > self._max_block1_size:
+					return self.too_large(transaction, self._max_block1_size)
+				# the body is received into a buffer of the announced size
+				buffer = bytearray(size1 if size1 is not None else 0)
+				if not self._reserve(len(buffer)):
+					return self.unavailable(transaction)
+				item = BlockItem(0, 0, m, size, buffer, content_type)
+				item.offsets = {}
+				self._block1_receive[key_token] = item
+			elif content_type != item.content_type:
+				# Error Incomplete
+				return self.incomplete(transaction)
+			elif num < item.num or (num > item.num and num * size in cast(dict, item.offsets)):
+				# a block received again, it has already been written at its offset
+				self._block1_receive.touch(key_token)
+				return self._continue(transaction, num, m, size)
+			elif num > item.num and (size != item.size or len(payload) > size or (m == 1 and len(payload) != size)):
+				# a block ahead of the next one is written at its offset only if it has the size of the blocks
+				return self.incomplete(transaction)
+			else:
+				self._block1_receive.touch(key_token)
+
+			buffer = cast(bytearray, item.payload)
+			offsets = cast(dict, item.offsets)
+			offset = item.byte if num == item.num else num * size
+			end = offset + len(payload)
+			if item.m == 0 and end > len(buffer):
+				# beyond the last block
+				return self.incomplete(transaction)
+			if end > self._max_block1_size:
+				self._release(key_token)
+				return self.too_large(transaction, self._max_block1_size)
+			if end > len(buffer):
+				if not self._reserve(end - len(buffer)):
+					self._release(key_token)
+					return self.unavailable(transaction)
+				if offset > len(buffer):
+					buffer.extend(bytes(offset - len(buffer)))
+			buffer[offset:end] = payload
+			offsets[offset] = end
+			if num == item.num:
+				item.num = num + 1
+				item.size = size
+			# the blocks received ahead that follow are part of the received body now
+			while offsets.get(item.byte, item.byte) > item.byte:
+				if item.byte != offset:
+					item.num = item.byte // item.size + 1
+				item.byte = offsets[item.byte]
 			if m == 0:
-				transaction.request.payload = self._block1_receive[key_token].payload
+				# the body ends with this block, the buffer is cut to it
+				item.m = 0
+				with self._block1_lock:
+					self._block1_bytes = max(0, self._block1_bytes - (len(buffer) - end))
+				del buffer[end:]
+
+			if item.m == 0 and item.byte >= len(buffer):
 				# end of blockwise
+				self._release(key_token)
+				transaction.request.payload = bytes(buffer)
 				del transaction.request.block1
 				transaction.block_transfer = False
-				del self._block1_receive[key_token]
 				return transaction
-			else:
-				# Continue
-				transaction.block_transfer = True
-				transaction.response = Response()
-				transaction.response.destination = transaction.request.source
-				transaction.response.token = transaction.request.token
-				transaction.response.code = defines.Codes.CONTINUE.number
-				transaction.response.block1 = (num, m, size)
-
-			num += 1
-			byte = size
-			self._block1_receive[key_token].byte = byte
-			self._block1_receive[key_token].num = num
-			self._block1_receive[key_token].size = size
-			self._block1_receive[key_token].m = m
-
+			# Continue
+			return self._continue(transaction, num, m, size)
 
 		return transaction
 
@@ -174,17 +299,27 @@ class BlockLayer(object):
 		:return: the edited transaction
 		"""
 		host, port = transaction.response.source
-		key_token = utils.str_append_hash(host, port, transaction.response.token)
+		key_token = utils.TransactionTable.key(host, port, transaction.response.token)
 
 		blockwise_finished = transaction.response.block1 is None or transaction.response.block1[1] == 0
 		# if key_token in self._block1_sent and (not blockwise_finished):
-		if key_token in self._block1_sent and transaction.response.block1 is not None:
-			item = self._block1_sent[key_token]
-			transaction.block_transfer = True
-			if item.m == 0:
+		item = self._block1_sent.get(key_token)
+		if item is not None and (transaction.response.block1 is None or item.m == 0):
+			# the last block has been acknowledged, or the request has been refused
+			self._block1_sent.pop(key_token)
+			if isinstance(item.payload, Stream):
+				item.payload.close()
+				if item.m == 0 and item.payload.progress is not None and \
+						defines.Codes.CREATED.number <= transaction.response.code <= defines.Codes.CONTENT.number:
+					length = item.payload.length
+					item.payload.progress(length if length is not None else item.byte, length)
+			if transaction.response.block1 is not None:
 				transaction.block_transfer = False
 				del transaction.request.block1
 				return transaction
+		if key_token in self._block1_sent and transaction.response.block1 is not None:
+			item = self._block1_sent[key_token]
+			transaction.block_transfer = True
 			n_num, n_m, n_size = transaction.response.block1
 			if n_num != item.num:  # pragma: no cover
 				logger.warning("Blockwise num acknowledged error, expected " + str(item.num) + " received " +
@@ -196,19 +331,39 @@ class BlockLayer(object):
 			request = transaction.request
 			del request.mid
 			del request.block1
-			request.payload = item.payload[item.byte: item.byte+item.size]
-			item.num += 1
-			item.byte += item.size
-			if len(item.payload) <= item.byte:
-				item.m = 0
+			if isinstance(item.payload, Stream):
+				if item.payload.progress is not None:
+					item.payload.progress(item.byte, item.payload.length)
+				# only the block being sent is read
+				request.payload, more = item.payload.block(item.byte, item.size)
+				item.m = 1 if more else 0
+				item.num += 1
+				item.byte += item.size
 			else:
-				item.m = 1
+				request.payload = item.payload[item.byte: item.byte+item.size]
+				item.num += 1
+				item.byte += item.size
+				if len(item.payload) <= item.byte:
+					item.m = 0
+				else:
+					item.m = 1
 			request.block1 = (item.num, item.m, item.size)
 			# The original request already has this option set
 			# request.size1 = len(item.payload)
+		elif key_token in self._downloads:
+			return self._receive_download(transaction, key_token, self._downloads[key_token])
 		elif transaction.response.block2 is not None:
 
 			num, m, size = transaction.response.block2
+			if m == 1 and num == 0 and self._block2_window > 1 and transaction.response.size2 is not None and \
+					transaction.request.observe is None and transaction.response.code == defines.Codes.CONTENT.number:
+				# the following blocks are requested several at a time
+				self._block2_sent.pop(key_token)
+				etag = transaction.response.etag
+				download = BlockDownload(transaction.request, size, transaction.response.size2,
+										 transaction.response.content_type, etag[0] if etag else None)
+				self._downloads[key_token] = download
+				return self._receive_download(transaction, key_token, download)
 			if m == 1:
 				transaction.block_transfer = True
 				if key_token in self._block2_sent:
@@ -271,60 +426,55 @@ class BlockLayer(object):
 		:return: the edited transaction
 		"""
 		host, port = transaction.request.source
-		key_token = utils.str_append_hash(host, port, transaction.request.token)
-		if (key_token in self._block2_receive and transaction.response.payload is not None) or \
-				(key_token in self._block2_receive and self._block2_receive[key_token].payload is not None) or \
+		key_token = utils.TransactionTable.key(host, port, transaction.request.token)
+		item = self._block2_receive.get(key_token)
+		if item is None and isinstance(transaction.response.payload, Stream):
+			window, more = transaction.response.payload.block(0, defines.MAX_PAYLOAD)
+			if not more:
+				# a single block
+				transaction.response.payload.close()
+				transaction.response.payload = window
+		if (item is not None and transaction.response.payload is not None) or \
+				isinstance(transaction.response.payload, Stream) or \
+				(item is not None and item.payload is not None) or \
 				(transaction.response.payload is not None and len(transaction.response.payload) > defines.MAX_PAYLOAD):
-			_payload = transaction.response.payload if transaction.response.payload is not None else self._block2_receive[key_token].payload
-			if key_token in self._block2_receive:
-
-				byte = self._block2_receive[key_token].byte
-				size = self._block2_receive[key_token].size
-				num = self._block2_receive[key_token].num
+			_payload = transaction.response.payload if transaction.response.payload is not None else item.payload
+			if item is not None:
+				if item.code is None:
+					# early negotiation, the representation is known only now
+					item.content_type = transaction.response.content_type
+					item.options = _filterOptions(transaction.response.options)
+					item.code = transaction.response.code
 
 			else:
-				byte = 0
-				num = 0
-				size = defines.MAX_PAYLOAD
-				m = 1
-				self._block2_receive[key_token] = BlockItem(byte, num, m, size, 
-															transaction.response.payload, 
-															transaction.response.content_type, 
-															_filterOptions(transaction.response.options), 
-															transaction.response.code)
-
-				
-			# correct m
-			m = 0 if ((num * size) + size) > len(_payload) else 1
-			# m = 0 if ((num * size) + size) > len(transaction.response.payload) else 1
-			# add size2 if requested or if payload is bigger than one datagram
-			del transaction.response.size2
-			# if (transaction.request.size2 is not None and transaction.request.size2 == 0) or \
-			#    (transaction.response.payload is not None and len(transaction.response.payload) > defines.MAX_PAYLOAD):
-			#     transaction.response.size2 = len(transaction.response.payload)
-			if (transaction.request.size2 is not None and transaction.request.size2 == 0) or \
-			   (_payload is not None and len(_payload) > defines.MAX_PAYLOAD):
-				transaction.response.size2 = len(_payload)
-
-			transaction.response.payload = _payload[byte:byte + size]
-			del transaction.response.content_type
-			transaction.response.content_type = self._block2_receive[key_token].content_type
-			transaction.response.code = self._block2_receive[key_token].code
-			
-			# Add the original options to blockwise response
-			_on = [o.number for o in transaction.response.options]
-			for o in self._block2_receive[key_token].options:
-				if o.number not in _on:
-					transaction.response.options.append(o)
-			
-			del transaction.response.block2
-			transaction.response.block2 = (num, m, size)
-
-			# TODO can we optimize this?
-			self._block2_receive[key_token].byte += size
-			self._block2_receive[key_token].num += 1
-			if m == 0:
-				del self._block2_receive[key_token]
+				item = BlockItem(0, 0, 1, defines.MAX_PAYLOAD, None,
+								 transaction.response.content_type,
+								 _filterOptions(transaction.response.options),
+								 transaction.response.code)
+				self._block2_receive[key_token] = item
+
+			if isinstance(_payload, Stream):
+				# the following blocks are read from the same stream
+				item.payload = _payload
+				item.pin = (transaction.request.uri_path, transaction.request.uri_query, item.content_type, key_token)
+			elif item.pin is None and transaction.request.code == defines.Codes.GET.number and \
+					transaction.request.observe is None and item.code == defines.Codes.CONTENT.number and \
+					isinstance(_payload, (bytes, bytearray)) and item.byte + item.size < len(_payload):
+				# the following blocks are served from this representation
+				etag = transaction.response.etag
+				pin = (transaction.request.uri_path, transaction.request.uri_query, item.content_type,
+					   etag[0] if etag else key_token)
+				pinned = self._pin(pin, _payload)
+				if pinned is not None:
+					item.pin = pin
+					_payload = pinned
+
+			if transaction.request.block2 is not None:
+				# the block of this request, other ones may be served at the same time
+				num, m, size = transaction.request.block2
+			else:
+				num, size = item.num, item.size
+			self._send_block(transaction, key_token, item, _payload, num, size)
 
 		return transaction
 
@@ -337,9 +487,26 @@ class BlockLayer(object):
 		:return: the edited request
 		"""
 		# assert isinstance(request, Request)
-		if request.block1 or (request.payload is not None and len(request.payload) > defines.MAX_PAYLOAD):
+		if isinstance(request.payload, Stream):
+			stream = request.payload
+			num, m, size = request.block1 if request.block1 else (0, 1, defines.MAX_PAYLOAD)
+			request.payload, more = stream.block(num * size, size)
+			if not more and not request.block1:
+				# a single block
+				stream.close()
+				return request
 			host, port = request.destination
-			key_token = utils.str_append_hash(host, port, request.token)
+			key_token = utils.TransactionTable.key(host, port, request.token)
+			m = 1 if more else 0
+			del request.size1
+			if stream.length is not None:
+				request.size1 = stream.length
+			self._block1_sent[key_token] = BlockItem(num * size + size, num, m, size, stream, request.content_type)
+			del request.block1
+			request.block1 = (num, m, size)
+		elif request.block1 or (request.payload is not None and len(request.payload) > defines.MAX_PAYLOAD):
+			host, port = request.destination
+			key_token = utils.TransactionTable.key(host, port, request.token)
 			if request.block1:
 				num, m, size = request.block1
 			else:
@@ -354,15 +521,356 @@ class BlockLayer(object):
 			request.payload = request.payload[0:size]
 			del request.block1
 			request.block1 = (num, m, size)
-		elif request.block2:
+		elif request.block2 or (self._block2_window > 1 and request.code == defines.Codes.GET.number and
+								request.observe is None):
+			if not request.block2:
+				# the size of the representation is needed to request several blocks at once
+				if request.size2 is None:
+					request.size2 = 0
+				return request
 			host, port = request.destination
-			key_token = utils.str_append_hash(host, port, request.token)
+			key_token = utils.TransactionTable.key(host, port, request.token)
 			num, m, size = request.block2
 			item = BlockItem(size, num, m, size, b"", None)
 			self._block2_sent[key_token] = item
 			return request
 		return request
 
+	def _send_block(self, transaction:Transaction, key_token:Tuple[str, int, Union[int, bytes]], item:BlockItem,
+					_payload:Union[bytes, bytearray, memoryview, LinkDocument, Stream], num:int, size:int) -> Transaction:
+		"""
+		Set the requested block of a representation as the payload of the response.
+
+		:param transaction: the transaction that owns the response
+		:param key_token: the key of the Block2 session
+		:param item: the Block2 session
+		:param _payload: the whole representation
+		:param num: the number of the block
+		:param size: the size of the block
+		:return: the edited transaction
+		"""
+		byte = num * size
+		window:Union[bytes, bytearray, memoryview]
+		if isinstance(_payload, Stream):
+			try:
+				window, more = _payload.block(byte, size)
+			except ValueError:
+				logger.error("Block no more available")
+				self._block2_receive.pop(key_token)
+				_payload.close()
+				return self.incomplete(transaction)
+			m = 1 if more else 0
+			length = _payload.length
+		else:
+			window = _payload[byte:byte + size]
+			# correct m
+			m = 0 if byte + size >= len(_payload) else 1
+			length = len(_payload)
+		# add size2 if requested or if payload is bigger than one datagram
+		del transaction.response.size2
+		if length is not None and ((transaction.request.size2 is not None and transaction.request.size2 == 0) or
+								   length > defines.MAX_PAYLOAD):
+			transaction.response.size2 = length
+
+		transaction.response.payload = window
+		del transaction.response.content_type
+		transaction.response.content_type = item.content_type
+		transaction.response.code = item.code
+
+		# Add the original options to blockwise response
+		_on = [o.number for o in transaction.response.options]
+		for o in item.options:
+			if o.number not in _on:
+				transaction.response.options.append(o)
+
+		del transaction.response.block2
+		transaction.response.block2 = (num, m, size)
+
+		item.num = num + 1
+		item.byte = item.num * size
+		if m == 0:
+			self._block2_receive.pop(key_token)
+			if isinstance(_payload, Stream):
+				_payload.close()
+			elif item.pin is not None and item.pin[3] == key_token:
+				# a representation without ETag is not shared with other transfers
+				self._unpin(item.pin)
+		return transaction
+
+	def _pin(self, pin:tuple, payload:Union[bytes, bytearray]) -> Optional[memoryview]:
+		"""
+		Keep a representation for the following blocks of its transfers. The representations of a resource
+		with an ETag are shared by the transfers of the same representation.
+
+		:param pin: the path, the query, the Content-Format and the ETag, or the key of the session
+		:param payload: the representation
+		:return: the pinned representation, None if it is larger than all the pinned representations may be
+		"""
+		with self._block2_lock:
+			entry = self._pinned.get(pin)
+			if entry is not None:
+				self._pinned[pin] = (entry[0], self._expiry())
+				self._pinned.move_to_end(pin)
+				return entry[0]
+			if len(payload) > self._max_block2_pinned:
+				return None
+			self._expire()
+			while self._pinned and self._pinned_bytes + len(payload) > self._max_block2_pinned:
+				# the least recently used representations are dropped, their transfers render again
+				_, (view, _) = self._pinned.popitem(last=False)
+				self._pinned_bytes -= len(view)
+			view = memoryview(bytes(payload))
+			self._pinned[pin] = (view, self._expiry())
+			self._pinned_bytes += len(view)
+			return view
+
+	def _pinned_payload(self, pin:tuple) -> Optional[memoryview]:
+		"""
+		Return a pinned representation and restart its lifetime.
+
+		:param pin: the key of the representation
+		:return: the representation, None if it has been dropped
+		"""
+		with self._block2_lock:
+			entry = self._pinned.get(pin)
+			if entry is None:
+				return None
+			if entry[1] < time.monotonic():
+				del self._pinned[pin]
+				self._pinned_bytes -= len(entry[0])
+				return None
+			self._pinned[pin] = (entry[0], self._expiry())
+			self._pinned.move_to_end(pin)
+			return entry[0]
+
+	def _unpin(self, pin:tuple) -> None:
+		"""
+		Drop a pinned representation.
+
+		:param pin: the key of the representation
+		"""
+		with self._block2_lock:
+			entry = self._pinned.pop(pin, None)
+			if entry is not None:
+				self._pinned_bytes -= len(entry[0])
+
+	def _expiry(self) -> float:
+		"""
+		Return the expiry time of a representation used now.
+
+		:return: the monotonic time
+		"""
+		return time.monotonic() + self._block2_lifetime if self._block2_lifetime is not None else float("inf")
+
+	def _expire(self) -> None:
+		"""
+		Drop the pinned representations not used during their lifetime. Must be called with the lock held.
+
+		"""
+		now = time.monotonic()
+		# the representations are ordered by last use, so by expiry time
+		while self._pinned:
+			pin, (view, expiry) = next(iter(self._pinned.items()))
+			if expiry >= now:
+				break
+			del self._pinned[pin]
+			self._pinned_bytes -= len(view)
+
+	def _receive_download(self, transaction:Transaction, key_token:Tuple[str, int, Union[int, bytes]],
+						  download:BlockDownload) -> Transaction:
+		"""
+		Write a block of a download at its offset and request the next one. A block that has not been received
+		is requested again, at most MAX_RETRANSMIT times.
+
+		:param transaction: the transaction that owns the response
+		:param key_token: the key of the download
+		:param download: the download
+		:return: the edited transaction
+		"""
+		response = transaction.response
+		requested = transaction.request.block2[0] if transaction.request.block2 is not None else 0
+		if response.block2 is not None and response.code == defines.Codes.CONTENT.number:
+			etag = response.etag
+			if response.content_type != download.content_type or (etag[0] if etag else None) != download.etag:
+				logger.error("Representation changed during the blockwise transfer")
+				self._downloads.pop(key_token)
+				response.code = defines.Codes.REQUEST_ENTITY_INCOMPLETE.number
+				response.payload = None
+				return self._end_download(transaction, download)
+			num, m, size = response.block2
+			offset = num * size
+			payload = cast(bytes, response.payload) if response.payload is not None else b""
+			if size == download.size and num < download.total and \
+					offset + len(payload) == min(offset + size, len(download.payload)):
+				download.payload[offset:offset + len(payload)] = payload
+				download.received.add(num)
+
+		if requested not in download.received:
+			retries = download.retries.get(requested, 0) + 1
+			if retries > defines.MAX_RETRANSMIT:
+				logger.error("Block " + str(requested) + " not received")
+				self._downloads.pop(key_token)
+				if response.code == defines.Codes.CONTENT.number:
+					response.code = defines.Codes.REQUEST_ENTITY_INCOMPLETE.number
+				response.payload = None
+				return self._end_download(transaction, download)
+			download.retries[requested] = retries
+			download.requests.append(self._block_request(download, requested))
+		elif len(download.received) == download.total:
+			self._downloads.pop(key_token)
+			response.payload = bytes(download.payload)
+			del response.block2
+			response.block2 = (download.total - 1, 0, download.size)
+			return self._end_download(transaction, download)
+		# the blocks requested and not received yet are at most the window
+		while download.next < download.total and download.next - len(download.received) < self._block2_window:
+			download.requests.append(self._block_request(download, download.next))
+			download.next += 1
+		transaction.block_transfer = True
+		return transaction
+
+	@staticmethod
+	def _block_request(download:BlockDownload, num:int) -> Request:
+		"""
+		Create the request of a block of a download.
+
+		:param download: the download
+		:param num: the number of the block
+		:return: the request
+		"""
+		request = Request()
+		request.destination = download.request.destination
+		request.type = download.request.type
+		request.code = download.request.code
+		request.token = download.request.token
+		request.options = _filterOptions(download.request.options)
+		request.block2 = (num, 0, download.size)
+		return request
+
+	@staticmethod
+	def _end_download(transaction:Transaction, download:BlockDownload) -> Transaction:
+		"""
+		Give the last response of a download to the request of its first block.
+
+		:param transaction: the transaction that owns the last response
+		:param download: the download
+		:return: the edited transaction
+		"""
+		transaction.block_transfer = False
+		transaction.request = download.request
+		if transaction.response.mid is not None:
+			download.request.mid = transaction.response.mid
+		return transaction
+
+	def block_requests(self, transaction:Transaction) -> list[Request]:
+		"""
+		Return the requests of the following blocks of a blockwise transfer of a client.
+
+		:param transaction: the transaction whose response continues the transfer
+		:return: the requests to send
+		"""
+		host, port = transaction.response.source
+		download = self._downloads.get(utils.TransactionTable.key(host, port, transaction.response.token))
+		if download is None:
+			return [transaction.request]
+		requests = download.requests
+		download.requests = []
+		return requests
+
+	def _reserve(self, length:int) -> bool:
+		"""
+		Account the memory of a Block1 session that grows.
+
+		:param length: the number of bytes to allocate
+		:return: True if the bytes fit in the limit of all the sessions
+		"""
+		with self._block1_lock:
+			if self._block1_bytes + length > self._max_block1_total:
+				# the sessions expired since are not accounted for anymore
+				self._block1_bytes = sum(len(item.payload) for item in self._block1_receive.values())
+				if self._block1_bytes + length > self._max_block1_total:
+					return False
+			self._block1_bytes += length
+			return True
+
+	def _release(self, key_token:Tuple[str, int, Union[int, bytes]]) -> Optional[BlockItem]:
+		"""
+		Remove a Block1 session and its memory.
+
+		:param key_token: the key of the session
+		:return: the session, None if there is none
+		"""
+		item = self._block1_receive.pop(key_token)
+		if item is not None:
+			with self._block1_lock:
+				self._block1_bytes = max(0, self._block1_bytes - len(item.payload))
+		return item
+
+	def purge(self) -> None:
+		"""
+		Drop the Block1 and Block2 sessions without new blocks, and the pinned representations, not used
+		during their lifetime.
+
+		"""
+		if self._block1_receive.purge() > 0:
+			with self._block1_lock:
+				self._block1_bytes = sum(len(item.payload) for item in self._block1_receive.values())
+		self._block2_receive.purge()
+		with self._block2_lock:
+			self._expire()
+
+	@staticmethod
+	def _continue(transaction:Transaction, num:int, m:int, size:int) -> Transaction:
+		"""
+		Acknowledge a block of a request with 2.31 Continue.
+
+		:param transaction: the transaction that owns the request
+		:param num: the num field of the block
+		:param m: the M bit of the block
+		:param size: the size field of the block
+		:return: the edited transaction
+		"""
+		transaction.block_transfer = True
+		transaction.response = Response()
+		transaction.response.destination = transaction.request.source
+		transaction.response.token = transaction.request.token
+		transaction.response.code = defines.Codes.CONTINUE.number
+		transaction.response.block1 = (num, m, size)
+		return transaction
+
+	@staticmethod
+	def too_large(transaction:Transaction, size1:int) -> Transaction:
+		"""
+		Notifies a body too large to be received with 4.13 Request Entity Too Large.
+
+		:param transaction: the transaction that owns the request
+		:param size1: the maximum size of a body
+		:return: the edited transaction
+		"""
+		transaction.block_transfer = True
+		transaction.response = Response()
+		transaction.response.destination = transaction.request.source
+		transaction.response.token = transaction.request.token
+		transaction.response.code = defines.Codes.REQUEST_ENTITY_TOO_LARGE.number
+		transaction.response.size1 = size1
+		return transaction
+
+	@staticmethod
+	def unavailable(transaction:Transaction) -> Transaction:
+		"""
+		Notifies that the body cannot be received now with 5.03 Service Unavailable.
+
+		:param transaction: the transaction that owns the request
+		:return: the edited transaction
+		"""
+		transaction.block_transfer = True
+		transaction.response = Response()
+		transaction.response.destination = transaction.request.source
+		transaction.response.token = transaction.request.token
+		transaction.response.code = defines.Codes.SERVICE_UNAVAILABLE.number
+		transaction.response.max_age = defines.SHED_MAX_AGE
+		return transaction
+
 	@staticmethod
 	def incomplete(transaction:Transaction) -> Transaction:
 		"""
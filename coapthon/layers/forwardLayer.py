@@ -71,11 +71,7 @@ class ForwardLayer(object):
         else:
             new = False
             if transaction.request.code == defines.Codes.POST.number:
-                new_paths = self._server.root.with_prefix(path)
-                new_path = "/"
-                for tmp in new_paths:
-                    if len(tmp) > len(new_path):
-                        new_path = tmp
+                new_path = self._server.root.longest_prefix(path)
                 if path != new_path:
                     new = True
                 path = new_path
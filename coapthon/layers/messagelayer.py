@@ -4,12 +4,12 @@ from typing import Tuple, Optional, TYPE_CHECKING
 import logging
 import random
 import time
-import socket
 
 from coapthon import utils
 from coapthon.messages.message import Message
 from coapthon import defines
 from coapthon.messages.request import Request
+from coapthon.serializer import Serializer
 from coapthon.transaction import Transaction
 
 if TYPE_CHECKING:
@@ -25,14 +25,18 @@ class MessageLayer(object):
 	"""
 	Handles matching between messages (Message ID) and request/response (Token)
 	"""
-	def __init__(self, starting_mid:int) -> None:
+	def __init__(self, starting_mid:int, max_transactions:Optional[int]=defines.MAX_TRANSACTIONS,
+				 lifetime:Optional[float]=defines.EXCHANGE_LIFETIME) -> None:
 		"""
 		Set the layer internal structure.
 
 		:param starting_mid: the first mid used to send messages.
+		:param max_transactions: the maximum number of exchanges kept, None for no limit
+		:param lifetime: the time in seconds after which an exchange is evicted on insert, None to keep the
+			exchanges until purge() is called
 		"""
-		self._transactions:dict[int, Transaction] = {}
-		self._transactions_token:dict[int, Transaction] = {}
+		self._transactions = utils.TransactionTable(lifetime, max_transactions)
+		self._transactions_token = utils.TransactionTable(lifetime, max_transactions)
 		if starting_mid is not None:
 			self._current_mid = starting_mid
 		else:
@@ -50,18 +54,47 @@ class MessageLayer(object):
 		return current_mid
 
 	def purge(self, timeout_time:float=defines.EXCHANGE_LIFETIME) -> None:
-		for k in list(self._transactions.keys()):
-			now = time.time()
-			transaction = self._transactions[k]
-			if transaction.timestamp + timeout_time < now:
-				logger.debug("Delete transaction")
-				del self._transactions[k]
-		for k in list(self._transactions_token.keys()):
-			now = time.time()
-			transaction = self._transactions_token[k]
-			if transaction.timestamp + timeout_time < now:
-				logger.debug("Delete transaction")
-				del self._transactions_token[k]
+		"""
+		Delete the exchanges older than timeout_time. Expired exchanges are also evicted on every insert when
+		the layer has a lifetime.
+
+		:param timeout_time: the lifetime of the exchanges in seconds
+		"""
+		evicted = self._transactions.purge(timeout_time) + self._transactions_token.purge(timeout_time)
+		if evicted > 0:
+			logger.debug("Deleted %d transactions", evicted)
+
+	@staticmethod
+	def _all_coap_nodes(host:str) -> str:
+		"""
+		Return the CoAP multicast group of the address family of host.
+
+		:param host: the numeric address of the peer
+		:return: the multicast address
+		"""
+		return defines.ALL_COAP_NODES_IPV6 if ":" in host else defines.ALL_COAP_NODES
+
+	def _find(self, host:str, port:int, mid:int, token:bytes) -> Optional[Transaction]:
+		"""
+		Find the transaction of a message by MID then by token, from the peer first and then from the
+		multicast group. The multicast keys are only built when the unicast ones do not match.
+
+		:param host: the host of the peer
+		:param port: the port of the peer
+		:param mid: the MID of the message
+		:param token: the token of the message
+		:return: the transaction or None
+		"""
+		key = utils.TransactionTable.key
+		transaction = self._transactions.get(key(host, port, mid))
+		if transaction is None:
+			transaction = self._transactions_token.get(key(host, port, token))
+			if transaction is None:
+				all_coap_nodes = self._all_coap_nodes(host)
+				transaction = self._transactions.get(key(all_coap_nodes, port, mid))
+				if transaction is None:
+					transaction = self._transactions_token.get(key(all_coap_nodes, port, token))
+		return transaction
 
 	def receive_request(self, request:Request) -> Transaction:
 		"""
@@ -72,24 +105,37 @@ class MessageLayer(object):
 		:rtype : Transaction
 		:return: the edited transaction
 		"""
-		logger.debug("receive_request - " + str(request))
+		logger.debug("receive_request - %s", request)
 		try:
 			host, port = request.source
 		except AttributeError:
 			return None
-		key_mid = utils.str_append_hash(host, port, request.mid)
-		key_token = utils.str_append_hash(host, port, request.token)
-
-		if key_mid in list(self._transactions.keys()):
+		key_mid = utils.TransactionTable.key(host, port, request.mid)
+		transaction = self._transactions.get(key_mid)
+		if transaction is not None:
 			# Duplicated
-			self._transactions[key_mid].request.duplicated = True
-			transaction = self._transactions[key_mid]
+			transaction.request.duplicated = True
 		else:
 			request.timestamp = time.time()
 			transaction = Transaction(request=request, timestamp=request.timestamp)
-			with transaction:
-				self._transactions[key_mid] = transaction
-				self._transactions_token[key_token] = transaction
+			self._transactions[key_mid] = transaction
+			self._transactions_token[utils.TransactionTable.key(host, port, request.token)] = transaction
+		return transaction
+
+	def receive_duplicate(self, host:str, port:int, mid:int, datagram:bytes) -> Optional[Transaction]:
+		"""
+		Match a retransmitted request, known only from its header, with a completed exchange.
+
+		:param host: the host of the peer
+		:param port: the port of the peer
+		:param mid: the MID of the request
+		:param datagram: the raw request, which must be identical to the one of the exchange
+		:return: the completed transaction, or None if the request must be handled by receive_request
+		"""
+		transaction = self._transactions.get(utils.TransactionTable.key(host, port, mid))
+		if transaction is None or not transaction.completed or transaction.request.datagram != datagram:
+			return None
+		transaction.request.duplicated = True
 		return transaction
 
 	def receive_response(self, response:Response) -> Tuple[Transaction, bool]:
@@ -101,34 +147,35 @@ class MessageLayer(object):
 		:rtype : Transaction
 		:return: the transaction to which the response belongs to
 		"""
-		logger.debug("receive_response - " + str(response))
+		logger.debug("receive_response - %s", response)
 		try:
 			host, port = response.source
 		except AttributeError:
 			logger.warning("Cannot determine source")
 			return None, False
-		all_coap_nodes = defines.ALL_COAP_NODES_IPV6 if socket.getaddrinfo(host, None)[0][0] == socket.AF_INET6 else defines.ALL_COAP_NODES
-		key_mid = utils.str_append_hash(host, port, response.mid)
-		key_mid_multicast = utils.str_append_hash(all_coap_nodes, port, response.mid)
-		key_token = utils.str_append_hash(host, port, response.token)
-		key_token_multicast = utils.str_append_hash(all_coap_nodes, port, response.token)
-		if key_mid in list(self._transactions.keys()):
-			transaction = self._transactions[key_mid]
-			if response.token != transaction.request.token:
-				logger.warning("Tokens does not match -  response message " + str(host) + ":" + str(port))
-				return None, False
-		elif key_token in self._transactions_token:
-			transaction = self._transactions_token[key_token]
-		elif key_mid_multicast in list(self._transactions.keys()):
-			transaction = self._transactions[key_mid_multicast]
-		elif key_token_multicast in self._transactions_token:
-			transaction = self._transactions_token[key_token_multicast]
+		key = utils.TransactionTable.key
+		transaction = self._transactions.get(key(host, port, response.mid))
+		if transaction is not None:
 			if response.token != transaction.request.token:
 				logger.warning("Tokens does not match -  response message " + str(host) + ":" + str(port))
 				return None, False
 		else:
-			logger.warning("Un-Matched incoming response message " + str(host) + ":" + str(port))
-			return None, False
+			key_token = key(host, port, response.token)
+			transaction = self._transactions_token.get(key_token)
+			if transaction is not None:
+				# notifications keep the observation alive
+				self._transactions_token.touch(key_token)
+			else:
+				all_coap_nodes = self._all_coap_nodes(host)
+				transaction = self._transactions.get(key(all_coap_nodes, port, response.mid))
+				if transaction is None:
+					transaction = self._transactions_token.get(key(all_coap_nodes, port, response.token))
+					if transaction is None:
+						logger.warning("Un-Matched incoming response message " + str(host) + ":" + str(port))
+						return None, False
+					if response.token != transaction.request.token:
+						logger.warning("Tokens does not match -  response message " + str(host) + ":" + str(port))
+						return None, False
 		send_ack = False
 		if response.type == defines.Types["CON"]:
 			send_ack = True
@@ -136,8 +183,8 @@ class MessageLayer(object):
 		transaction.request.acknowledged = True
 		transaction.completed = True
 		transaction.response = response
-		if transaction.retransmit_stop is not None:
-			transaction.retransmit_stop.set()
+		if transaction.retransmit_handle is not None:
+			transaction.retransmit_handle.cancel()
 		return transaction, send_ack
 
 	def receive_empty(self, message:Message) -> Optional[Transaction]:
@@ -149,25 +196,13 @@ class MessageLayer(object):
 		:rtype : Transaction
 		:return: the transaction to which the message belongs to
 		"""
-		logger.debug("receive_empty - " + str(message))
+		logger.debug("receive_empty - %s", message)
 		try:
 			host, port = message.source
 		except AttributeError:
 			return None
-		all_coap_nodes = defines.ALL_COAP_NODES_IPV6 if socket.getaddrinfo(host, None)[0][0] == socket.AF_INET6 else defines.ALL_COAP_NODES
-		key_mid = utils.str_append_hash(host, port, message.mid)
-		key_mid_multicast = utils.str_append_hash(all_coap_nodes, port, message.mid)
-		key_token = utils.str_append_hash(host, port, message.token)
-		key_token_multicast = utils.str_append_hash(all_coap_nodes, port, message.token)
-		if key_mid in list(self._transactions.keys()):
-			transaction = self._transactions[key_mid]
-		elif key_token in self._transactions_token:
-			transaction = self._transactions_token[key_token]
-		elif key_mid_multicast in list(self._transactions.keys()):
-			transaction = self._transactions[key_mid_multicast]
-		elif key_token_multicast in self._transactions_token:
-			transaction = self._transactions_token[key_token_multicast]
-		else:
+		transaction = self._find(host, port, message.mid, message.token)
+		if transaction is None:
 			logger.warning("Un-Matched incoming empty message " + str(host) + ":" + str(port))
 			return None
 
@@ -188,8 +223,8 @@ class MessageLayer(object):
 		else:
 			logger.warning("Unhandled message type...")
 
-		if transaction.retransmit_stop is not None:
-			transaction.retransmit_stop.set()
+		if transaction.retransmit_handle is not None:
+			transaction.retransmit_handle.cancel()
 
 		return transaction
 
@@ -202,7 +237,7 @@ class MessageLayer(object):
 		:rtype : Transaction
 		:return: the created transaction
 		"""
-		logger.debug("send_request - " + str(request))
+		logger.debug("send_request - %s", request)
 		assert isinstance(request, Request)
 		try:
 			host, port = request.destination
@@ -217,13 +252,10 @@ class MessageLayer(object):
 		if transaction.request.mid is None:
 			transaction.request.mid = self.fetch_mid()
 
-		key_mid = utils.str_append_hash(host, port, request.mid)
-		self._transactions[key_mid] = transaction
+		self._transactions[utils.TransactionTable.key(host, port, request.mid)] = transaction
+		self._transactions_token[utils.TransactionTable.key(host, port, request.token)] = transaction
 
-		key_token = utils.str_append_hash(host, port, request.token)
-		self._transactions_token[key_token] = transaction
-
-		return self._transactions[key_mid]
+		return transaction
 
 	def send_response(self, transaction:Transaction) -> Optional[Transaction]:
 		"""
@@ -234,7 +266,7 @@ class MessageLayer(object):
 		:rtype : Transaction
 		:return: the edited transaction
 		"""
-		logger.debug("send_response - " + str(transaction.response))
+		logger.debug("send_response - %s", transaction.response)
 		if transaction.response.type is None:
 			if transaction.request.type == defines.Types["CON"] and not transaction.request.acknowledged:
 				transaction.response.type = defines.Types["ACK"]
@@ -253,12 +285,30 @@ class MessageLayer(object):
 				host, port = transaction.response.destination
 			except AttributeError:
 				return None
-			key_mid = utils.str_append_hash(host, port, transaction.response.mid)
-			self._transactions[key_mid] = transaction
+			self._transactions[utils.TransactionTable.key(host, port, transaction.response.mid)] = transaction
 
 		transaction.request.acknowledged = True
 		return transaction
 
+	def compact(self, transaction:Transaction) -> bool:
+		"""
+		Reduce an exchange answered with a piggybacked response, which is only kept to answer the
+		retransmissions of the request, to the datagrams of the request and of the response. The blocks
+		of a blockwise transfer answered by the block layer are compacted as well.
+
+		:param transaction: the transaction
+		:return: True if the transaction has been compacted
+		"""
+		if not transaction.completed or transaction.response is None \
+				or transaction.response.type != defines.Types["ACK"] or transaction.request.observe is not None:
+			return False
+		Serializer.compact(transaction.request)
+		Serializer.compact(transaction.response)
+		transaction.resource = None
+		transaction.cached_element = None
+		transaction.separate_timer = None
+		return True
+
 	def send_empty(self, transaction:Transaction, related:Message, message:Message) -> Optional[Message]:
 		"""
 		Manage ACK or RST related to a transaction. Sets if the transaction has been acknowledged or rejected.
@@ -269,22 +319,18 @@ class MessageLayer(object):
 		:type message: Message
 		:param message: the ACK or RST message to send
 		"""
-		logger.debug("send_empty - " + str(message))
+		logger.debug("send_empty - %s", message)
 		if transaction is None:
 			try:
 				host, port = message.destination
 			except AttributeError:
 				return None
-			key_mid = utils.str_append_hash(host, port, message.mid)
-			key_token = utils.str_append_hash(host, port, message.token)
-			if key_mid in self._transactions:
-				transaction = self._transactions[key_mid]
-				related = transaction.response
-			elif key_token in self._transactions_token:
-				transaction = self._transactions_token[key_token]
-				related = transaction.response
-			else:
+			transaction = self._transactions.get(utils.TransactionTable.key(host, port, message.mid))
+			if transaction is None:
+				transaction = self._transactions_token.get(utils.TransactionTable.key(host, port, message.token))
+			if transaction is None:
 				return message
+			related = transaction.response
 
 		if message.type == defines.Types["ACK"]:
 			if transaction.request == related:
@@ -1,12 +1,15 @@
 
 from __future__ import annotations
-from typing import Optional, TYPE_CHECKING
+from typing import Callable, Hashable, Optional, TYPE_CHECKING
 
 import logging
+import threading
 import time
 
 from coapthon import defines
 from coapthon import utils
+from coapthon.messages.response import Response
+from coapthon.scheduler import get_scheduler
 
 
 if TYPE_CHECKING:
@@ -14,6 +17,7 @@ if TYPE_CHECKING:
 	from coapthon.resources.resource import Resource
 	from coapthon.messages.message import Message
 	from coapthon.messages.request import Request
+	from coapthon.scheduler import Scheduler, TimerHandle
 	from coapthon.utils import Tree
 
 __author__ = 'Giacomo Tanganelli'
@@ -21,8 +25,75 @@ __author__ = 'Giacomo Tanganelli'
 logger = logging.getLogger(__name__)
 
 
+class ObserveAttributes(object):
+    """
+    Conditional attributes of an observe relation, given in the query of the registration: pmin and
+    pmax, the minimum and maximum period in seconds between two notifications, and gt, lt and st,
+    conditions on the numeric value of the resource.
+    """
+    __slots__ = ("pmin", "pmax", "gt", "lt", "st")
+
+    def __init__(self) -> None:
+        self.pmin:Optional[float] = None
+        self.pmax:Optional[float] = None
+        self.gt:Optional[float] = None
+        self.lt:Optional[float] = None
+        self.st:Optional[float] = None
+
+    @staticmethod
+    def parse(query:str) -> Optional[ObserveAttributes]:
+        """
+        Parse the conditional attributes of a query. Invalid values are ignored, as a pmax that is not
+        greater than pmin.
+
+        :param query: the Uri-Query of the registration
+        :return: the attributes, None if the query has none
+        """
+        attributes = None
+        for parameter in query.split("&") if query else ():
+            name, _, value = parameter.partition("=")
+            if name not in ObserveAttributes.__slots__:
+                continue
+            try:
+                number = float(value)
+            except ValueError:
+                continue
+            if name in ("pmin", "pmax", "st") and number < 0:
+                continue
+            if attributes is None:
+                attributes = ObserveAttributes()
+            setattr(attributes, name, number)
+        if attributes is not None and attributes.pmax is not None and attributes.pmax <= (attributes.pmin or 0):
+            attributes.pmax = None
+        return attributes
+
+    def accepts(self, previous:Optional[float], value:Optional[float]) -> bool:
+        """
+        Check the value conditions for a new state of the resource: gt and lt are met when the value
+        crosses them, st when it has changed by st since the last notification. Without value
+        conditions, or if a value is unknown, every change is accepted.
+
+        :param previous: the value of the last notification
+        :param value: the new value
+        :return: True if a notification is due
+        """
+        if self.gt is None and self.lt is None and self.st is None:
+            return True
+        if previous is None or value is None:
+            return True
+        if self.gt is not None and (previous > self.gt) != (value > self.gt):
+            return True
+        if self.lt is not None and (previous < self.lt) != (value < self.lt):
+            return True
+        return self.st is not None and abs(value - previous) >= self.st
+
+
 class ObserveItem(object):
-    def __init__(self, timestamp:float, non_counter:int, allowed:bool, transaction:Transaction) -> None:
+    __slots__ = ("timestamp", "non_counter", "allowed", "transaction", "attributes", "last_sent", "last_value",
+                 "pending", "keepalive")
+
+    def __init__(self, timestamp:float, non_counter:int, allowed:bool, transaction:Transaction,
+                 attributes:Optional[ObserveAttributes]=None) -> None:
         """
         Data structure for the Observe option
 
@@ -30,19 +101,112 @@ class ObserveItem(object):
         :param non_counter: the number of NON notification sent
         :param allowed: if the client is allowed as observer
         :param transaction: the transaction
+        :param attributes: the conditional attributes of the relation
         """
         self.timestamp = timestamp
         self.non_counter = non_counter
         self.allowed = allowed
         self.transaction = transaction
+        self.attributes = attributes
+        # rate control of the relations with attributes: monotonic time and value of the last
+        # notification, timers of the coalesced notification and of the pmax keep-alive
+        self.last_sent = 0.0
+        self.last_value:Optional[float] = None
+        self.pending:Optional[TimerHandle] = None
+        self.keepalive:Optional[TimerHandle] = None
+
+    def cancel(self) -> None:
+        """
+        Cancel the timers of the relation.
+        """
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        if self.keepalive is not None:
+            self.keepalive.cancel()
+            self.keepalive = None
 
 
 class ObserveLayer(object):
     """
     Manage the observing feature. It store observing relationships.
+
+    The notifications of relations registered with pmin or pmax are rate controlled: the changes of
+    the resource within pmin are coalesced into one notification sent at the end of the period, and
+    a notification is sent after pmax without change. The timers hand the relations of these
+    notifications to the send function given by the server, without it the attributes are ignored.
     """
-    def __init__(self) -> None:
-        self._relations:dict[int, ObserveItem] = {}
+    def __init__(self, send:Optional[Callable[[Hashable], None]]=None, scheduler:Optional[Scheduler]=None) -> None:
+        """
+        Initialize the layer.
+
+        :param send: the function queueing the notification of a relation, called on the scheduler
+            thread with the key of the relation; it must not block, the notification is prepared by
+            prepare_relations() and rendered by the server on an other thread
+        :param scheduler: the scheduler of the rate control timers, the shared one if None
+        """
+        self._send = send
+        self._scheduler = scheduler
+        self._relations = utils.TransactionTable(None)
+        # keys of the established relations by observed resource, in registration order
+        self._observers:dict[Resource, dict[Hashable, None]] = {}
+        self._observed:dict[Hashable, Resource] = {}
+        self._lock = threading.Lock()
+
+    def _index(self, key:Hashable, resource:Resource) -> None:
+        """
+        Record the resource observed by a relation.
+
+        :param key: the key of the relation
+        :param resource: the observed resource
+        """
+        with self._lock:
+            previous = self._observed.get(key)
+            if previous is resource:
+                return
+            if previous is not None:
+                self._unindex_locked(key, previous)
+            self._observed[key] = resource
+            self._observers.setdefault(resource, {})[key] = None
+
+    def _unindex_locked(self, key:Hashable, resource:Resource) -> None:
+        """
+        Drop a relation from the observers of a resource, the lock of the layer must be held.
+
+        :param key: the key of the relation
+        :param resource: the observed resource
+        """
+        observers = self._observers.get(resource)
+        if observers is not None:
+            observers.pop(key, None)
+            if not observers:
+                del self._observers[resource]
+
+    def _remove(self, key:Hashable) -> Optional[ObserveItem]:
+        """
+        Remove a relation.
+
+        :param key: the key of the relation
+        :return: the removed relation or None
+        """
+        item = self._relations.pop(key)
+        with self._lock:
+            if item is not None:
+                item.cancel()
+            resource = self._observed.pop(key, None)
+            if resource is not None:
+                self._unindex_locked(key, resource)
+        return item
+
+    def observers(self, resource:Resource) -> int:
+        """
+        Return the number of established relations on a resource.
+
+        :param resource: the resource
+        :return: the number of observers
+        """
+        with self._lock:
+            return len(self._observers.get(resource, ()))
 
     def send_request(self, request:Request) -> Request:
         """
@@ -54,7 +218,7 @@ class ObserveLayer(object):
         if request.observe == 0:
             # Observe request
             host, port = request.destination
-            key_token = utils.str_append_hash(host, port, request.token)
+            key_token = utils.TransactionTable.key(host, port, request.token)
 
             self._relations[key_token] = ObserveItem(time.time(), None, True, None)
 
@@ -70,7 +234,7 @@ class ObserveLayer(object):
         :return: the modified transaction
         """
         host, port = transaction.response.source
-        key_token = utils.str_append_hash(host, port, transaction.response.token)
+        key_token = utils.TransactionTable.key(host, port, transaction.response.token)
         if key_token in self._relations and transaction.response.type == defines.Types["CON"]:
             transaction.notification = True
         return transaction
@@ -84,9 +248,9 @@ class ObserveLayer(object):
         :return: the message unmodified
         """
         host, port = message.destination
-        key_token = utils.str_append_hash(host, port, message.token)
+        key_token = utils.TransactionTable.key(host, port, message.token)
         if key_token in self._relations and message.type == defines.Types["RST"]:
-            del self._relations[key_token]
+            self._remove(key_token)
         return message
 
     def receive_request(self, transaction:Transaction) -> Transaction:
@@ -102,22 +266,23 @@ class ObserveLayer(object):
         if transaction.request.observe == 0:
             # Observe request
             host, port = transaction.request.source
-            key_token = utils.str_append_hash(host, port, transaction.request.token)
+            key_token = utils.TransactionTable.key(host, port, transaction.request.token)
             non_counter = 0
-            if key_token in self._relations:
+            previous = self._relations.get(key_token)
+            if previous is not None:
                 # Renew registration
                 allowed = True
+                with self._lock:
+                    previous.cancel()
             else:
                 allowed = False
-            self._relations[key_token] = ObserveItem(time.time(), non_counter, allowed, transaction)
+            attributes = ObserveAttributes.parse(transaction.request.uri_query) if self._send is not None else None
+            self._relations[key_token] = ObserveItem(time.time(), non_counter, allowed, transaction, attributes)
         elif transaction.request.observe == 1:
             host, port = transaction.request.source
-            key_token = utils.str_append_hash(host, port, transaction.request.token)
+            key_token = utils.TransactionTable.key(host, port, transaction.request.token)
             logger.debug("Remove Subscriber")
-            try:
-                del self._relations[key_token]
-            except KeyError:
-                pass
+            self._remove(key_token)
 
         return transaction
 
@@ -134,12 +299,9 @@ class ObserveLayer(object):
         """
         if empty.type == defines.Types["RST"]:
             host, port = transaction.request.source
-            key_token = utils.str_append_hash(host, port, transaction.request.token)
+            key_token = utils.TransactionTable.key(host, port, transaction.request.token)
             logger.debug("Remove Subscriber")
-            try:
-                del self._relations[key_token]
-            except KeyError:
-                pass
+            self._remove(key_token)
             transaction.completed = True
         return transaction
 
@@ -152,19 +314,23 @@ class ObserveLayer(object):
         :return: the transaction unmodified
         """
         host, port = transaction.request.source
-        key_token = utils.str_append_hash(host, port, transaction.request.token)
+        key_token = utils.TransactionTable.key(host, port, transaction.request.token)
         if key_token in self._relations:
             if transaction.response.code == defines.Codes.CONTENT.number:
                 if transaction.resource is not None and transaction.resource.observable:
 
                     transaction.response.observe = transaction.resource.observe_count
-                    self._relations[key_token].allowed = True
-                    self._relations[key_token].transaction = transaction
-                    self._relations[key_token].timestamp = time.time()
+                    item = self._relations[key_token]
+                    item.allowed = True
+                    item.transaction = transaction
+                    item.timestamp = time.time()
+                    self._index(key_token, transaction.resource)
+                    if item.attributes is not None:
+                        self._sent(key_token, item, transaction.resource)
                 else:
-                    del self._relations[key_token]
+                    self._remove(key_token)
             elif transaction.response.code >= defines.Codes.ERROR_LOWER_BOUND:
-                del self._relations[key_token]
+                self._remove(key_token)
         return transaction
 
     def notify(self, resource:Resource, root:Optional[Tree]=None) -> list:
@@ -176,26 +342,230 @@ class ObserveLayer(object):
         :param root: deprecated
         :return: the list of transactions to be notified
         """
-        ret = []
         if root is not None:
             resource_list = root.with_prefix_resource(resource.path)
         else:
             resource_list = [resource]
-        for key in list(self._relations.keys()):
-            if self._relations[key].transaction.resource in resource_list:
-                if self._relations[key].non_counter > defines.MAX_NON_NOTIFICATIONS \
-                        or self._relations[key].transaction.request.type == defines.Types["CON"]:
-                    self._relations[key].transaction.response.type = defines.Types["CON"]
-                    self._relations[key].non_counter = 0
-                elif self._relations[key].transaction.request.type == defines.Types["NON"]:
-                    self._relations[key].non_counter += 1
-                    self._relations[key].transaction.response.type = defines.Types["NON"]
-                self._relations[key].transaction.resource = resource
-                del self._relations[key].transaction.response.mid
-                del self._relations[key].transaction.response.token
-                ret.append(self._relations[key].transaction)
+        ret = []
+        for key in self._due_relations(resource_list, resource):
+            item = self._relations.get(key)
+            if item is not None:
+                ret.append(self._prepare(item, resource))
+        return ret
+
+    def due_relations(self, resource:Resource) -> list[Hashable]:
+        """
+        Return the relations to notify of a change of the resource, as notify() but without preparing
+        their transactions, see prepare_relations().
+
+        :param resource: the changed resource
+        :return: the keys of the relations
+        """
+        return self._due_relations([resource], resource)
+
+    def _due_relations(self, resource_list:list[Resource], resource:Resource) -> list[Hashable]:
+        """
+        Return the relations on the resources to notify of a change, the relations with attributes are
+        left to their rate control.
+
+        :param resource_list: the observed resources
+        :param resource: the changed resource
+        :return: the keys of the relations
+        """
+        # only the relations on the resources are visited, not all the relations of the server
+        with self._lock:
+            keys = [key for r in resource_list for key in self._observers.get(r, ())]
+        ret = []
+        for key in keys:
+            item = self._relations.get(key)
+            if item is None:
+                continue
+            if item.attributes is not None and not self._due(key, item, resource):
+                continue
+            ret.append(key)
+        return ret
+
+    def prepare_relations(self, keys:list[Hashable]) -> list[Transaction]:
+        """
+        Prepare the notifications of relations with the current state of their resources. The relations
+        removed in the meantime are skipped.
+
+        :param keys: the keys of the relations
+        :return: the list of transactions to be notified
+        """
+        ret = []
+        for key in keys:
+            with self._lock:
+                resource = self._observed.get(key)
+            item = self._relations.get(key)
+            if item is None or resource is None:
+                continue
+            ret.append(self._prepare(item, resource))
         return ret
 
+    @staticmethod
+    def _prepare(item:ObserveItem, resource:Resource) -> Transaction:
+        """
+        Prepare the transaction of a relation for a new notification.
+
+        :param item: the relation
+        :param resource: the resource to notify
+        :return: the transaction of the relation
+        """
+        if item.non_counter > defines.MAX_NON_NOTIFICATIONS \
+                or item.transaction.request.type == defines.Types["CON"]:
+            item.transaction.response.type = defines.Types["CON"]
+            item.non_counter = 0
+        elif item.transaction.request.type == defines.Types["NON"]:
+            item.non_counter += 1
+            item.transaction.response.type = defines.Types["NON"]
+        item.transaction.resource = resource
+        del item.transaction.response.mid
+        del item.transaction.response.token
+        return item.transaction
+
+    @staticmethod
+    def _value(resource:Resource) -> Optional[float]:
+        """
+        Return the numeric value of a resource for the gt, lt and st conditions.
+
+        :param resource: the resource
+        :return: the value, None if the payload is not a number
+        """
+        try:
+            payload = resource.payload
+            if isinstance(payload, tuple):
+                payload = payload[1]
+            return float(payload)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _due(self, key:Hashable, item:ObserveItem, resource:Resource) -> bool:
+        """
+        Decide if a change of the resource is notified now to a relation with attributes. A change
+        within pmin of the last notification schedules a notification at the end of the period, which
+        carries the state of the resource at that time.
+
+        :param key: the key of the relation
+        :param item: the relation
+        :param resource: the changed resource
+        :return: True if the notification is sent now
+        """
+        attributes = item.attributes
+        with self._lock:
+            if item.pending is not None:
+                return False
+            if not attributes.accepts(item.last_value, self._value(resource)):
+                return False
+            elapsed = time.monotonic() - item.last_sent
+            if attributes.pmin is not None and elapsed < attributes.pmin:
+                item.pending = self._get_scheduler().call_later(attributes.pmin - elapsed, self._deferred, key)
+                return False
+        return True
+
+    def _sent(self, key:Hashable, item:ObserveItem, resource:Resource) -> None:
+        """
+        Record a notification sent to a relation with attributes and restart its pmax period.
+
+        :param key: the key of the relation
+        :param item: the relation
+        :param resource: the notified resource
+        """
+        with self._lock:
+            item.last_sent = time.monotonic()
+            item.last_value = self._value(resource)
+            if item.keepalive is not None:
+                item.keepalive.cancel()
+                item.keepalive = None
+            if item.attributes.pmax is not None:
+                item.keepalive = self._get_scheduler().call_later(item.attributes.pmax, self._keepalive, key)
+
+    def _deferred(self, key:Hashable) -> None:
+        """
+        Timer callback: queue the coalesced notification of a relation at the end of pmin.
+
+        :param key: the key of the relation
+        """
+        with self._lock:
+            item = self._relations.get(key)
+            resource = self._observed.get(key)
+            if item is None or resource is None:
+                return
+            item.pending = None
+        self._send(key)
+
+    def _keepalive(self, key:Hashable) -> None:
+        """
+        Timer callback: queue the notification of a relation without notification for pmax.
+
+        :param key: the key of the relation
+        """
+        with self._lock:
+            item = self._relations.get(key)
+            resource = self._observed.get(key)
+            if item is None or resource is None:
+                return
+            item.keepalive = None
+            if item.pending is not None:
+                return
+        # the current sequence number, the state of the resource and the other relations are left unchanged
+        self._send(key)
+
+    def _get_scheduler(self) -> Scheduler:
+        """
+        Return the scheduler of the timers, the shared one is only started when first needed.
+        """
+        if self._scheduler is None:
+            self._scheduler = get_scheduler()
+        return self._scheduler
+
+    @staticmethod
+    def representation_key(request:Request) -> Optional[Hashable]:
+        """
+        Return what the notifications of a relation depend on: the options of its GET request but the
+        Observe option, for instance the Accept option. Relations with the same key get the same
+        representation of the resource, see copy_notification(). None if the notification must be
+        rendered for this relation alone, as for Block2 transfers.
+
+        :param request: the request of the relation
+        :return: the key or None
+        """
+        if request.code != defines.Codes.GET.number or request.block2 is not None:
+            return None
+        return tuple((option.number, option.value) for option in request.options
+                     if option.number != defines.OptionRegistry.OBSERVE.number)
+
+    @staticmethod
+    def copy_notification(template:Response, resource:Resource, transaction:Transaction) -> None:
+        """
+        Set the response of a relation to a copy of a notification rendered for an other relation with
+        the same representation key.
+
+        :param template: the rendered notification
+        :param resource: the resource rendered for the notification
+        :param transaction: the transaction of the relation
+        """
+        response = Response()
+        response.destination = transaction.request.source
+        response.token = transaction.request.token
+        response.code = template.code
+        response.options = list(template.options)
+        response.payload = template.payload
+        transaction.response = response
+        transaction.resource = resource
+
+    @staticmethod
+    def is_copy_of(template:Response, response:Response) -> bool:
+        """
+        Check that a copied notification has been left unchanged by the layers, so that it has the
+        options and the payload of the notification it has been copied from.
+
+        :param template: the rendered notification
+        :param response: the copied notification
+        :return: True if only the header and the token differ
+        """
+        return response.block2 is None and response.observe == template.observe
+
     def remove_subscriber(self, message:Message) -> None:
         """
         Remove a subscriber based on token.
@@ -204,10 +574,10 @@ class ObserveLayer(object):
         """
         logger.debug("Remove Subcriber")
         host, port = message.destination
-        key_token = utils.str_append_hash(host, port, message.token)
-        try:
-            self._relations[key_token].transaction.completed = True
-            del self._relations[key_token]
-        except KeyError:
+        key_token = utils.TransactionTable.key(host, port, message.token)
+        item = self._remove(key_token)
+        if item is None:
             logger.warning("No Subscriber")
+        elif item.transaction is not None:
+            item.transaction.completed = True
 
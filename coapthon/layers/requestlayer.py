@@ -9,6 +9,7 @@ if TYPE_CHECKING:
 	from coapthon.resources.resource import Resource
 	from coapthon.transaction import Transaction
 	from coapthon.server.coap import CoAP
+	from coapthon.server.coap_asyncio import CoAP as AsyncioCoAP
 	from coapthon.client.coap import CoAP as CoAPClient
 
 __author__ = 'Giacomo Tanganelli'
@@ -18,7 +19,7 @@ class RequestLayer(object):
     """
     Class to handle the Request/Response layer
     """
-    def __init__(self, server:CoAP|CoAPClient):
+    def __init__(self, server:CoAP|AsyncioCoAP|CoAPClient):
         self._server = server
 
     def receive_request(self, transaction:Transaction) -> Transaction:
@@ -71,7 +72,7 @@ class RequestLayer(object):
             transaction = self._server.resourceLayer.discover(transaction) # type:ignore[union-attr]
         else:
             try:
-                resource = cast(Resource, self._server.root[path]) # type:ignore[union-attr]
+                resource = cast('Resource', self._server.root[path]) # type:ignore[union-attr]
             except KeyError:
                 resource = None
             if resource is None or path == '/':
@@ -96,7 +97,7 @@ class RequestLayer(object):
         transaction.response.destination = transaction.request.source
         transaction.response.token = transaction.request.token
         try:
-            resource = cast(Resource, self._server.root[path]) # type:ignore[union-attr]
+            resource = cast('Resource', self._server.root[path]) # type:ignore[union-attr]
         except KeyError:
             resource = None
         if resource is None:
@@ -139,7 +140,7 @@ class RequestLayer(object):
         transaction.response.destination = transaction.request.source
         transaction.response.token = transaction.request.token
         try:
-            resource = cast(Resource, self._server.root[path]) # type:ignore[union-attr]
+            resource = cast('Resource', self._server.root[path]) # type:ignore[union-attr]
         except KeyError:
             resource = None
 
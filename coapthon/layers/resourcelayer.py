@@ -1,25 +1,70 @@
 from __future__ import annotations
-from typing import Callable, Tuple, cast, TYPE_CHECKING
+from typing import Callable, Optional, Tuple, cast, TYPE_CHECKING
+
+import bisect
+import collections
+import hashlib
+import itertools
+import threading
 
 from coapthon import defines
 from coapthon.messages.response import Response
-from coapthon.resources.resource import Resource
+from coapthon.resources.resource import LinkAttributes, Resource
+from coapthon.resources.streamResource import StreamResource
 
 if TYPE_CHECKING:
 	from coapthon.transaction import Transaction
 	from coapthon.messages.request import Request
 	from coapthon.server.coap import CoAP
+	from coapthon.server.coap_asyncio import CoAP as AsyncioCoAP
 	from coapthon.forward_proxy.coap import CoAP as ForwardCoAP
 	from coapthon.reverse_proxy.coap import CoAP as ReverseCoAP
 
 __author__ = 'Giacomo Tanganelli'
 
 
+class LinkDocument(object):
+    """
+    A link-format document made of encoded links, whose slices are joined from the links they overlap
+    only. The block layer takes one block at a time out of it, the whole document is never built.
+    """
+    __slots__ = ("_links", "_offsets")
+
+    def __init__(self, links:list[bytes]) -> None:
+        """
+        Initialize the document.
+
+        :param links: the encoded links, in order
+        """
+        self._links = links
+        # offset of every link in the document, then the length of the document
+        self._offsets = [0]
+        self._offsets.extend(itertools.accumulate(len(link) for link in links))
+
+    def __len__(self) -> int:
+        return self._offsets[-1]
+
+    def __bytes__(self) -> bytes:
+        return b"".join(self._links)
+
+    def __getitem__(self, item:slice) -> bytes:
+        start, stop, step = item.indices(len(self))
+        if step != 1:
+            return bytes(self)[item]
+        if start >= stop:
+            return b""
+        first = bisect.bisect_right(self._offsets, start) - 1
+        last = bisect.bisect_left(self._offsets, stop)
+        data = b"".join(self._links[first:last])
+        base = self._offsets[first]
+        return data[start - base:stop - base]
+
+
 class ResourceLayer(object):
     """
     Handles the Resources.
     """
-    def __init__(self, parent:CoAP|ForwardCoAP|ReverseCoAP) -> None:
+    def __init__(self, parent:CoAP|AsyncioCoAP|ForwardCoAP|ReverseCoAP) -> None:
         """
         Initialize a Resource Layer.
 
@@ -27,6 +72,18 @@ class ResourceLayer(object):
         :param parent: the CoAP server
         """
         self._parent = parent
+        # resource -> ((path, version of the attributes), encoded link, (attribute, value) pairs)
+        self._links:dict[Resource, Tuple[Tuple[Optional[str], int], bytes, list[Tuple[str, str]]]] = {}
+        # resource -> position of its link in the document
+        self._positions:dict[Resource, int] = {}
+        # (version of the tree, changes of the attributes), links of the visible resources, document, ETag
+        self._discovery:Optional[Tuple[Tuple[int, int], list[Tuple[Resource, bytes]], bytes, bytes]] = None
+        # attribute -> value -> visible resources, and attribute -> sorted values for the prefix matches
+        self._attribute_index:dict[str, dict[str, set[Resource]]] = {}
+        self._attribute_values:dict[str, list[str]] = {}
+        # filters -> (version of the links, document) of the last filtered queries
+        self._documents:collections.OrderedDict[Tuple[Tuple[str, str], ...], Tuple[Tuple[int, int], LinkDocument]] = collections.OrderedDict()
+        self._links_lock = threading.Lock()
 
     def edit_resource(self, transaction:Transaction, path:str) -> Transaction:
         """
@@ -227,16 +284,10 @@ class ResourceLayer(object):
         :param transaction: the transaction
         :return: the response
         """
-        t = self._parent.root.with_prefix(path)
-        max_len = 0
-        imax = None
-        for i in t:
-            if i == path:
-                # Resource already present
-                return self.edit_resource(transaction, path)
-            elif len(i) > max_len:
-                imax = i
-                max_len = len(i)
+        imax = self._parent.root.longest_prefix(path)
+        if imax == path:
+            # Resource already present
+            return self.edit_resource(transaction, path)
 
         lp = path
         parent_resource = cast(Resource, self._parent.root[imax])
@@ -495,7 +546,13 @@ class ResourceLayer(object):
             transaction.response.code = defines.Codes.CONTENT.number
 
         try:
-            transaction.response.payload = bytes(cast(str, resource.payload), 'utf-8')
+            if isinstance(resource, StreamResource):
+                # the representation is read by the block layer, one window at a time
+                transaction.response.payload = resource.stream(transaction.request)
+                if resource.stream_content_type != defines.Content_types["text/plain"]:
+                    transaction.response.content_type = resource.stream_content_type
+            else:
+                transaction.response.payload = bytes(cast(str, resource.payload), 'utf-8')
             if resource.actual_content_type is not None \
                     and resource.actual_content_type != defines.Content_types["text/plain"]:
                 transaction.response.content_type = resource.actual_content_type
@@ -520,37 +577,207 @@ class ResourceLayer(object):
         :param transaction: the transaction
         :return: the transaction
         """
-        transaction.response.code = defines.Codes.CONTENT.number
-        payload = ""
-        for i in self._parent.root.dump():
-            if i == "/":
-                continue
-            resource = cast(Resource, self._parent.root[i])
-            if resource.visible:
-                ret = self.valid(transaction.request.uri_query, resource.attributes)
-                if ret:
-                    payload += self.corelinkformat(resource)
-
-        transaction.response.payload = bytes(payload, 'utf-8')
+        links, document, etag = self.links()
+        filters = self.filters(transaction.request.uri_query)
+        if filters:
+            # a large document is generated by the block layer one block at a time
+            payload = self.document(filters)
+            transaction.response.code = defines.Codes.CONTENT.number
+            transaction.response.payload = payload if len(payload) > defines.MAX_PAYLOAD else bytes(payload)
+        elif etag in transaction.request.etag:
+            transaction.response.code = defines.Codes.VALID.number
+            transaction.response.etag = etag
+            return transaction
+        else:
+            transaction.response.code = defines.Codes.CONTENT.number
+            transaction.response.payload = document
+            transaction.response.etag = etag
         transaction.response.content_type = defines.Content_types["application/link-format"]
         return transaction
 
+    def links(self) -> Tuple[list[Tuple[Resource, bytes]], bytes, bytes]:
+        """
+        Return the links of the visible resources in the order of the paths, with the discovery
+        document and its ETag. They are built again only after a resource has been added or removed or
+        attributes have changed, and only the links and the index entries of the changed resources are
+        built again.
+
+        :return: the (resource, encoded link) pairs, the document and the ETag
+        """
+        tree = self._parent.root
+        version = (tree.version, LinkAttributes.changes)
+        discovery = self._discovery
+        if discovery is not None and discovery[0] == version:
+            return discovery[1], discovery[2], discovery[3]
+        with self._links_lock:
+            discovery = self._discovery
+            if discovery is not None and discovery[0] == version:
+                return discovery[1], discovery[2], discovery[3]
+            cached = self._links
+            fresh:dict[Resource, Tuple[Tuple[Optional[str], int], bytes, list[Tuple[str, str]]]] = {}
+            links:list[Tuple[Resource, bytes]] = []
+            positions:dict[Resource, int] = {}
+            for i in tree.dump():
+                if i == "/":
+                    continue
+                resource = cast(Resource, tree[i])
+                if not resource.visible:
+                    continue
+                key = (resource.path, resource.attributes.version)
+                entry = cached.get(resource)
+                if entry is None or entry[0] != key:
+                    if entry is not None:
+                        self._unindex(resource, entry[2])
+                    values = self.link_values(resource.attributes)
+                    self._index(resource, values)
+                    entry = (key, bytes(self.corelinkformat(resource), 'utf-8'), values)
+                fresh[resource] = entry
+                positions[resource] = len(links)
+                links.append((resource, entry[1]))
+            for resource, entry in cached.items():
+                if resource not in fresh:
+                    self._unindex(resource, entry[2])
+            document = b"".join(link for resource, link in links)
+            etag = hashlib.blake2b(document, digest_size=8).digest()
+            self._links = fresh
+            self._positions = positions
+            self._discovery = (version, links, document, etag)
+            return links, document, etag
+
+    def document(self, filters:list[Tuple[str, str]]) -> LinkDocument:
+        """
+        Return the document of the links matching the filters. The documents of the last queries are
+        kept until the links change, so that the blocks of a document are sliced out of the same one.
+
+        :param filters: the (attribute, value) pairs
+        :return: the document
+        """
+        self.links()
+        key = tuple(filters)
+        with self._links_lock:
+            version = cast(tuple, self._discovery)[0]
+            cached = self._documents.get(key)
+            if cached is not None and cached[0] == version:
+                self._documents.move_to_end(key)
+                return cached[1]
+        document = LinkDocument([link for resource, link in self.find(filters)])
+        with self._links_lock:
+            self._documents[key] = (version, document)
+            if len(self._documents) > defines.DISCOVERY_DOCUMENTS:
+                self._documents.popitem(last=False)
+        return document
+
+    def _index(self, resource:Resource, values:list[Tuple[str, str]]) -> None:
+        """
+        Add a resource to the attribute index. Must be called with the lock held.
+
+        :param resource: the resource
+        :param values: the (attribute, value) pairs of the resource
+        """
+        for k, v in values:
+            index = self._attribute_index.setdefault(k, {})
+            resources = index.get(v)
+            if resources is None:
+                resources = index[v] = set()
+                bisect.insort(self._attribute_values.setdefault(k, []), v)
+            resources.add(resource)
+
+    def _unindex(self, resource:Resource, values:list[Tuple[str, str]]) -> None:
+        """
+        Remove a resource from the attribute index. Must be called with the lock held.
+
+        :param resource: the resource
+        :param values: the (attribute, value) pairs of the resource when it was indexed
+        """
+        for k, v in values:
+            index = self._attribute_index[k]
+            resources = index[v]
+            resources.discard(resource)
+            if not resources:
+                del index[v]
+                values_k = self._attribute_values[k]
+                del values_k[bisect.bisect_left(values_k, v)]
+
+    def find(self, filters:list[Tuple[str, str]]) -> list[Tuple[Resource, bytes]]:
+        """
+        Return the links of the visible resources matching all the filters, in the order of the paths.
+        A value ending with "*" matches the values starting with the rest of it.
+
+        :param filters: the (attribute, value) pairs
+        :return: the (resource, encoded link) pairs
+        """
+        self.links()
+        with self._links_lock:
+            # the links and the positions of the same build
+            links = cast(tuple, self._discovery)[1]
+            if not filters:
+                return list(links)
+            matches:Optional[set[Resource]] = None
+            for k, v in filters:
+                index = self._attribute_index.get(k, {})
+                if v.endswith("*"):
+                    prefix = v[:-1]
+                    values = self._attribute_values.get(k, [])
+                    found:set[Resource] = set()
+                    for i in range(bisect.bisect_left(values, prefix), len(values)):
+                        if not values[i].startswith(prefix):
+                            break
+                        found.update(index[values[i]])
+                else:
+                    found = index.get(v, set())
+                matches = found if matches is None else matches & found
+                if not matches:
+                    return []
+            positions = self._positions
+            return [links[i] for i in sorted(positions[resource] for resource in cast(set, matches))]
+
     @staticmethod
-    def valid(query:str, attributes:dict) -> bool:
-        for q in query.split("&"):
-            q = str(q)
-            assert(isinstance(q, str))
+    def filters(query:Optional[str]) -> list[Tuple[str, str]]:
+        """
+        Parse the (attribute, value) pairs of a discovery query, the parameters without value are ignored.
+
+        :param query: the Uri-Query of the request
+        :return: the pairs
+        """
+        ret = []
+        for q in query.split("&") if query else ():
             tmp = q.split("=")
             if len(tmp) > 1:
-                k = tmp[0]
-                v = tmp[1]
-                if k in attributes:
-                    if v == attributes[k]:
-                        continue
-                    else:
-                        return False
-                else:
+                ret.append((tmp[0], tmp[1]))
+        return ret
+
+    @staticmethod
+    def link_values(attributes:dict) -> list[Tuple[str, str]]:
+        """
+        Return the (attribute, value) pairs a resource is found with, one per element of a list value.
+
+        :param attributes: the attributes of the resource
+        :return: the pairs
+        """
+        ret:list[Tuple[str, str]] = []
+        for k, v in attributes.items():
+            if isinstance(v, list):
+                ret.extend((k, str(e)) for e in v)
+            elif v is not None:
+                ret.append((k, str(v)))
+        return ret
+
+    @staticmethod
+    def valid(query:str, attributes:dict) -> bool:
+        """
+        Check a resource against the filters of a discovery query, as find does with the index.
+
+        :param query: the Uri-Query of the request
+        :param attributes: the attributes of the resource
+        :return: True, if the resource matches all the filters
+        """
+        values = ResourceLayer.link_values(attributes)
+        for k, v in ResourceLayer.filters(query):
+            if v.endswith("*"):
+                if not any(a == k and e.startswith(v[:-1]) for a, e in values):
                     return False
+            elif (k, v) not in values:
+                return False
         return True
 
     @staticmethod
@@ -560,16 +787,15 @@ class ResourceLayer(object):
 
         :return: the string
         """
-        msg = "<" + resource.path + ">;"
         assert(isinstance(resource, Resource))
-        keys = sorted(list(resource.attributes.keys()))
-        for k in keys:
+        parts = ["<" + resource.path + ">"]
+        for k in sorted(resource.attributes.keys()):
             method = getattr(resource, defines.corelinkformat[k], None)
             if method is not None and method != "":
-                v = method
-                msg = msg[:-1] + ";" + str(v) + ","
+                parts.append(str(method))
             else:
                 v = resource.attributes[k]
                 if v is not None:
-                    msg = msg[:-1] + ";" + k + "=" + v + ","
-        return msg
+                    parts.append(k + "=" + v)
+        # a resource without attributes ends with ";" instead of ","
+        return ";".join(parts) + ("," if len(parts) > 1 else ";")
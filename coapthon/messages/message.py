@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import annotations
-from typing import Optional, Union, cast, Tuple
+from typing import Any, Callable, Optional, Union, cast, Tuple, TYPE_CHECKING
 import binascii
 
 from coapthon import defines
 from coapthon import utils
-from coapthon.messages.option import Option
+from coapthon.messages.option import Option, OptionList
+from coapthon.resources.streamResource import Stream
+
+if TYPE_CHECKING:
+	from coapthon.serializer import LazyOptions, CompactOptions
+	from coapthon.layers.resourcelayer import LinkDocument
 
 __author__ = 'Giacomo Tanganelli'
 
+_NO_OPTIONS:list[Option] = []
+
 
 class Message(object):
     """
     Class to handle the Messages.
     """
+    __slots__ = ("_type", "_mid", "_token", "_options", "_payload", "_destination", "_source", "_code",
+                 "_acknowledged", "_rejected", "_timeouted", "_cancelled", "_duplicated", "_timestamp",
+                 "_version", "_raw_options", "_raw_payload", "_datagram", "_datagram_version", "_index",
+                 "_index_version", "_values")
+
     def __init__(self) -> None:
         """
         Data structure that represent a CoAP message
@@ -22,8 +34,8 @@ class Message(object):
         self._type:Optional[int] = None
         self._mid:Optional[int] = None
         self._token:Optional[bytes] = None
-        self._options:list[Option] = []
-        self._payload:Optional[bytes] = None
+        self._options:OptionList = OptionList()
+        self._payload:Optional[Union[bytes, bytearray, memoryview, LinkDocument, Stream]] = None
         self._destination:Optional[defines.ServerT] = None
         self._source:Optional[defines.ServerT] = None
         self._code:Optional[int] = None
@@ -34,6 +46,17 @@ class Message(object):
         self._duplicated:Optional[bool] = None
         self._timestamp:Optional[float] = None
         self._version:int = 1
+        # undecoded options and payload of a received message, see Serializer.deserialize
+        self._raw_options:Optional[LazyOptions|CompactOptions] = None
+        self._raw_payload:Optional[memoryview] = None
+        self._datagram:Optional[bytes] = None
+        # the version of the list of options and the changes of the options the datagram has been encoded with
+        self._datagram_version:Tuple[int, int] = (0, 0)
+        # options by number and typed option values, rebuilt when the options change
+        self._index:Optional[dict[int, list[Option]]] = None
+        # the version of the list of options the index has been built from
+        self._index_version = 0
+        self._values:dict[int, Any] = {}
 
     @property
     def version(self) -> int:
@@ -55,6 +78,7 @@ class Message(object):
         if not isinstance(v, int) or v != 1:
             raise AttributeError
         self._version = v
+        self._datagram = None
 
     @property
     def type(self) -> int:
@@ -77,6 +101,7 @@ class Message(object):
         if value not in list(defines.Types.values()):
             raise AttributeError
         self._type = value
+        self._datagram = None
 
     @property
     def mid(self) -> int:
@@ -99,6 +124,7 @@ class Message(object):
         if not isinstance(value, int) or value > 65536:
             raise AttributeError
         self._mid = value
+        self._datagram = None
 
     @mid.deleter
     def mid(self) -> None:
@@ -106,6 +132,7 @@ class Message(object):
         Unset the MID of the message.
         """
         self._mid = None
+        self._datagram = None
 
     @property
     def token(self) -> bytes:
@@ -127,6 +154,7 @@ class Message(object):
         """
         if value is None:
             self._token = value
+            self._datagram = None
             return
         if not isinstance(value, bytes):
             value = bytes(value, 'utf-8')
@@ -134,6 +162,7 @@ class Message(object):
         if len(value) > 256:
             raise AttributeError
         self._token = value
+        self._datagram = None
 
     @token.deleter
     def token(self) -> None:
@@ -141,15 +170,23 @@ class Message(object):
         Unset the Token of the message.
         """
         self._token = None
+        self._datagram = None
 
     @property
-    def options(self) -> list[Option]:
+    def options(self) -> OptionList:
         """
         Return the options of the CoAP message.
 
         :rtype: list
         :return: the options
         """
+        if self._raw_options is not None:
+            raw_options = self._raw_options
+            self._raw_options = None
+            self._options = raw_options.decode()
+            self._index = None
+            # the options are those of the datagram
+            self._datagram_version = (self._options.version, Option.changes)
         return self._options
 
     @options.setter
@@ -163,24 +200,32 @@ class Message(object):
         if value is None:
             value = []
         assert isinstance(value, list)
-        self._options = value
+        self._raw_options = None
+        self._options = value if isinstance(value, OptionList) else OptionList(value)
+        self._index = None
+        self._datagram = None
 
     @property
-    def payload(self) -> bytes:
+    def payload(self) -> Union[bytes, bytearray, memoryview, LinkDocument, Stream]:
         """
         Return the payload.
 
         :return: the payload
         """
+        if self._raw_payload is not None:
+            self._payload = self._raw_payload.tobytes()
+            self._raw_payload = None
         return self._payload
 
     @payload.setter
-    def payload(self, value:Union[bytes,Tuple[int, bytes]]) -> None:
+    def payload(self, value:Union[bytes, bytearray, memoryview, LinkDocument, Stream, Tuple[int, bytes]]) -> None:
         """
         Sets the payload of the message and eventually the Content-Type
 
         :param value: the payload
         """
+        self._raw_payload = None
+        self._datagram = None
         if isinstance(value, tuple):
             content_type, payload = value
             self.content_type = content_type
@@ -188,6 +233,31 @@ class Message(object):
         else:
             self._payload = value
 
+    @property
+    def datagram(self) -> Optional[bytes]:
+        """
+        Return the wire encoding of the message: the datagram in which it has been received, or its
+        last serialization. It is reset by every change of the header, of the options or of the payload,
+        also by the changes of the list of options or of an option in place.
+
+        :return: the serialized message, or None
+        """
+        datagram = self._datagram
+        if datagram is not None and self._raw_options is None and \
+                self._datagram_version != (self._options.version, Option.changes):
+            self._datagram = datagram = None
+        return datagram
+
+    @datagram.setter
+    def datagram(self, value:Optional[bytes]) -> None:
+        """
+        Set the wire encoding of the message, for its current options.
+
+        :param value: the serialized message
+        """
+        self._datagram = value
+        self._datagram_version = (self._options.version, Option.changes)
+
     @property
     def destination(self) -> defines.ServerT:
         """
@@ -253,9 +323,10 @@ class Message(object):
         :param value: the code
         :raise AttributeError: if value is not a valid code
         """
-        if value not in list(defines.Codes.LIST.keys()) and value is not None:
+        if value not in defines.Codes.LIST and value is not None:
             raise AttributeError
         self._code = value
+        self._datagram = None
 
     @property
     def acknowledged(self) -> bool:
@@ -368,6 +439,64 @@ class Message(object):
         """
         self._timestamp = value
 
+    def _option_index(self) -> dict[int, list[Option]]:
+        """
+        Return the options of the message by number. The index is rebuilt if the list of options has
+        been changed without the methods of the message.
+
+        :return: the index
+        """
+        index = self._index
+        if index is not None and self._raw_options is None and self._index_version == self._options.version:
+            return index
+        options = self.options
+        if self._index is None or self._index_version != options.version:
+            index = {}
+            for option in options:
+                number = option.number
+                if number in index:
+                    index[number].append(option)
+                else:
+                    index[number] = [option]
+            self._index = index
+            self._index_version = options.version
+            self._values = {}
+        return index
+
+    def get_options(self, number:int) -> list[Option]:
+        """
+        Return the options with a number, in the order of the message. The list must not be modified.
+
+        :param number: the option number
+        :return: the options
+        """
+        return self._option_index().get(number, _NO_OPTIONS)
+
+    def get_option(self, number:int) -> Optional[Option]:
+        """
+        Return the first option with a number.
+
+        :param number: the option number
+        :return: the option or None
+        """
+        options = self._option_index().get(number)
+        return options[0] if options else None
+
+    def _option_value(self, number:int, convert:Callable[[list[Option]], Any]) -> Any:
+        """
+        Return the typed value of the options with a number, cached until these options change.
+
+        :param number: the option number
+        :param convert: the function computing the value from the options
+        :return: the value
+        """
+        index = self._option_index()
+        try:
+            return self._values[number]
+        except KeyError:
+            value = self._values[number] = convert(index.get(number, _NO_OPTIONS))
+            return value
+
     def _already_in(self, option:Option) -> bool:
         """
         Check if an option is already in the message.
@@ -376,10 +505,7 @@ class Message(object):
         :param option: the option to be checked
         :return: True if already present, False otherwise
         """
-        for opt in self._options:
-            if option.number == opt.number:
-                return True
-        return False
+        return option.number in self._option_index()
 
     def add_option(self, option:Option) -> None:
         """
@@ -390,15 +516,19 @@ class Message(object):
         :raise TypeError: if the option is not repeatable and such option is already present in the message
         """
         assert isinstance(option, Option)
-        repeatable = defines.OptionRegistry.LIST[option.number].repeatable
-        if not repeatable:
-            ret = self._already_in(option)
-            if ret:
+        self._datagram = None
+        number = option.number
+        repeatable = defines.OptionRegistry.LIST[number].repeatable
+        index = self._option_index()
+        if number in index:
+            if not repeatable:
                 raise TypeError("Option : %s is not repeatable", option.name)
-            else:
-                self._options.append(option)
+            index[number].append(option)
         else:
-            self._options.append(option)
+            index[number] = [option]
+        self._options.append(option)
+        self._index_version = self._options.version
+        self._values.pop(number, None)
 
     def del_option(self, option:Option) -> None:
         """
@@ -408,8 +538,10 @@ class Message(object):
         :param option: the option
         """
         # assert isinstance(option, Option)
-        while option in list(self._options):
+        while option in list(self.options):
             self._options.remove(option)
+            self._index = None
+            self._datagram = None
 
     def del_option_by_name(self, name:str) -> None:
         """
@@ -418,10 +550,12 @@ class Message(object):
         :type name: String
         :param name: option name
         """
-        for o in list(self._options):
+        for o in list(self.options):
             # assert isinstance(o, Option)
             if o.name == name:
                 self._options.remove(o)
+                self._index = None
+                self._datagram = None
 
     def del_option_by_number(self, number:int) -> None:
         """
@@ -430,10 +564,13 @@ class Message(object):
         :type number: Integer
         :param number: option naumber
         """
-        for o in list(self._options):
-            # assert isinstance(o, Option)
-            if o.number == number:
-                self._options.remove(o)
+        index = self._option_index()
+        if number in index:
+            del index[number]
+            self._options[:] = [o for o in self._options if o.number != number]
+            self._index_version = self._options.version
+            self._values.pop(number, None)
+            self._datagram = None
 
     @property
     def etag(self) -> list[bytes]:
@@ -443,11 +580,7 @@ class Message(object):
         :rtype: list
         :return: the ETag values or [] if not specified by the request
         """
-        value:list[bytes] = []
-        for option in self.options:
-            if option.number == defines.OptionRegistry.ETAG.number:
-                value.append(cast(bytes, option.value))
-        return value
+        return [cast(bytes, option.value) for option in self.get_options(defines.OptionRegistry.ETAG.number)]
 
     @etag.setter
     def etag(self, etag:Union[bytes,list]) -> None:
@@ -481,11 +614,8 @@ class Message(object):
 
         :return: the Content-Type value or 0 if not specified by the response
         """
-        value = 0
-        for option in self.options:
-            if option.number == defines.OptionRegistry.CONTENT_TYPE.number:
-                value = int(option.value)
-        return value
+        return self._option_value(defines.OptionRegistry.CONTENT_TYPE.number,
+                                  lambda options: int(options[-1].value) if options else 0)
 
     @content_type.setter
     def content_type(self, content_type:int) -> None:
@@ -515,14 +645,12 @@ class Message(object):
 
         :return: 0, if the request is an observing request
         """
-        for option in self.options:
-            if option.number == defines.OptionRegistry.OBSERVE.number:
-                # if option.value is None:
-                #    return 0
-                if option.value is None:
-                    return 0
-                return cast(int, option.value)
-        return None
+        option = self.get_option(defines.OptionRegistry.OBSERVE.number)
+        if option is None:
+            return None
+        if option.value is None:
+            return 0
+        return cast(int, option.value)
 
     @observe.setter
     def observe(self, ob:int) -> None:
@@ -551,11 +679,8 @@ class Message(object):
 
         :return: the Block1 value
         """
-        value:Optional[defines.BlockT] = None
-        for option in self.options:
-            if option.number == defines.OptionRegistry.BLOCK1.number:
-                value = utils.parse_blockwise(cast(int, option.value))
-        return value
+        return self._option_value(defines.OptionRegistry.BLOCK1.number,
+                                  lambda options: utils.parse_blockwise(cast(int, options[-1].value)) if options else None)
 
     @block1.setter
     def block1(self, value:defines.BlockT) -> None:
@@ -603,11 +728,8 @@ class Message(object):
 
         :return: the Block2 value
         """
-        value = None
-        for option in self.options:
-            if option.number == defines.OptionRegistry.BLOCK2.number:
-                value = utils.parse_blockwise(cast(int, option.value))
-        return value
+        return self._option_value(defines.OptionRegistry.BLOCK2.number,
+                                  lambda options: utils.parse_blockwise(cast(int, options[-1].value)) if options else None)
 
     @block2.setter
     def block2(self, value:defines.BlockT) -> None:
@@ -650,11 +772,10 @@ class Message(object):
 
     @property
     def size1(self) -> Optional[int]:
-        value:Optional[int] = None
-        for option in self.options:
-            if option.number == defines.OptionRegistry.SIZE1.number:
-                value = cast(int, option.value) if option.value is not None else 0
-        return value
+        options = self.get_options(defines.OptionRegistry.SIZE1.number)
+        if not options:
+            return None
+        return cast(int, options[-1].value) if options[-1].value is not None else 0
 
     @size1.setter
     def size1(self, value:int) -> None:
@@ -674,11 +795,8 @@ class Message(object):
 
         :return: the Size2 value
         """
-        value:Optional[int] = None
-        for option in self.options:
-            if option.number == defines.OptionRegistry.SIZE2.number:
-                value = cast(int, option.value)
-        return value
+        options = self.get_options(defines.OptionRegistry.SIZE2.number)
+        return cast(int, options[-1].value) if options else None
 
     @size2.setter
     def size2(self, value:int) -> None:
@@ -716,7 +834,7 @@ class Message(object):
         msg = "From {source}, To {destination}, {type}-{mid}, {code}-{token}, ["\
             .format(source=self._source, destination=self._destination, type=inv_types[self._type], mid=self._mid,
                     code=defines.Codes.LIST[self._code].name, token=token)
-        for opt in self._options:
+        for opt in self.options:
             if 'Block' in opt.name:
                 msg += f"{opt.name}: {utils.parse_blockwise(cast(int, opt.value))}, "
             else:
@@ -725,9 +843,12 @@ class Message(object):
         if self.payload is not None:
             if isinstance(self.payload, dict):
                 tmp = list(self.payload.values())[0][0:20]
+                msg += f" {tmp!r}...{len(self.payload)} bytes"
+            elif isinstance(self.payload, Stream):
+                # read by the block layer, one block at a time
+                msg += f" Stream of {self.payload.length} bytes"
             else:
-                tmp = self.payload[0:20]
-            msg += f" {tmp!r}...{len(self.payload)} bytes"
+                msg += f" {self.payload[0:20]!r}...{len(self.payload)} bytes"
         else:
             msg += " No payload"
         return msg
@@ -751,8 +872,8 @@ class Message(object):
         token = binascii.hexlify(self._token).decode("utf-8") if self._token is not None else str(None)
         msg += "Code: " + str(defines.Codes.LIST[self._code].name) + "\n"
         msg += "Token: " + token + "\n"
-        for opt in self._options:
+        for opt in self.options:
             msg += str(opt)
         msg += "Payload: " + "\n"
-        msg += str(self._payload) + "\n"
+        msg += str(self.payload) + "\n"
         return msg
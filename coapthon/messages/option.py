@@ -12,9 +12,12 @@
 #	Overview about the patches:
 #
 #	- added __repl__ method
+#	- __slots__, and __eq__ compares number and value
+#	- OptionList counts the changes of the options of a message
+#	- Option counts the changes of the options already set
 #
 
-from typing import Union
+from typing import Any, Iterable, Self, SupportsIndex, Union
 
 from coapthon import defines
 from coapthon.utils import byte_len
@@ -26,6 +29,11 @@ class Option(object):
 	"""
 	Class to handle the CoAP Options.
 	"""
+	__slots__ = ("_number", "_value")
+
+	# The changes of the number or the value of an option already set, of every message.
+	changes = 0
+
 	def __init__(self) -> None:
 		"""
 		Data structure to store options.
@@ -50,6 +58,8 @@ class Option(object):
 		:type value: int
 		:param value: the option number
 		"""
+		if self._number is not None:
+			Option.changes += 1
 		self._number = value
 
 	@property
@@ -91,6 +101,8 @@ class Option(object):
 			else:
 				if value is not None:
 					value = bytes(value, "utf-8")	# type:ignore[arg-type]
+		if self._value is not None:
+			Option.changes += 1
 		self._value = value
 
 	@property
@@ -160,4 +172,67 @@ class Option(object):
 		:rtype : Boolean
 		:return: True, if option are equal
 		"""
-		return self.__dict__ == other.__dict__
+		if not isinstance(other, Option):
+			return NotImplemented
+		return self._number == other._number and self._value == other._value
+
+
+
+class OptionList(list[Option]):
+	"""
+	The options of a message. Every change of the list is counted, so that the index of the options by
+	number is rebuilt when an option is added, removed or replaced without the methods of the message.
+	"""
+	__slots__ = ("version",)
+
+	def __init__(self, *args:Any) -> None:
+		super(OptionList, self).__init__(*args)
+		self.version = 0
+
+	def __setitem__(self, index:Any, value:Any) -> None:
+		self.version += 1
+		super(OptionList, self).__setitem__(index, value)
+
+	def __delitem__(self, index:Any) -> None:
+		self.version += 1
+		super(OptionList, self).__delitem__(index)
+
+	def __iadd__(self, values:Iterable[Option]) -> Self:  # type: ignore[override, misc]
+		self.version += 1
+		return super(OptionList, self).__iadd__(values)
+
+	def __imul__(self, n:SupportsIndex) -> Self:
+		self.version += 1
+		return super(OptionList, self).__imul__(n)
+
+	def append(self, option:Option) -> None:
+		self.version += 1
+		super(OptionList, self).append(option)
+
+	def extend(self, options:Iterable[Option]) -> None:
+		self.version += 1
+		super(OptionList, self).extend(options)
+
+	def insert(self, index:SupportsIndex, option:Option) -> None:
+		self.version += 1
+		super(OptionList, self).insert(index, option)
+
+	def pop(self, index:SupportsIndex=-1) -> Option:
+		self.version += 1
+		return super(OptionList, self).pop(index)
+
+	def remove(self, option:Option) -> None:
+		self.version += 1
+		super(OptionList, self).remove(option)
+
+	def clear(self) -> None:
+		self.version += 1
+		super(OptionList, self).clear()
+
+	def sort(self, **kwargs:Any) -> None:
+		self.version += 1
+		super(OptionList, self).sort(**kwargs)
+
+	def reverse(self) -> None:
+		self.version += 1
+		super(OptionList, self).reverse()
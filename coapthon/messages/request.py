@@ -24,6 +24,8 @@ class Request(Message):
 	"""
 	Class to handle the Requests.
 	"""
+	__slots__ = ()
+
 	def __init__(self, client:HelperClient = None):
 		"""
 		Initialize a Request message.
@@ -43,13 +45,8 @@ class Request(Message):
 		:rtype : String
 		:return: the Uri-Path
 		"""
-		valueList = []
-		for option in self.options:
-			if option.number == defines.OptionRegistry.URI_PATH.number:
-				valueList.append(str(option.value) + '/')
-		value = "".join(valueList)
-		value = value[:-1]
-		return value
+		return self._option_value(defines.OptionRegistry.URI_PATH.number,
+								  lambda options: "/".join([str(option.value) for option in options]))
 
 	@uri_path.setter
 	def uri_path(self, path:str) -> None:
@@ -86,11 +83,8 @@ class Request(Message):
 		:rtype : String
 		:return: the Uri-Query string
 		"""
-		value = []
-		for option in self.options:
-			if option.number == defines.OptionRegistry.URI_QUERY.number:
-				value.append(str(option.value))
-		return "&".join(value)
+		return self._option_value(defines.OptionRegistry.URI_QUERY.number,
+								  lambda options: "&".join([str(option.value) for option in options]))
 
 	@uri_query.setter
 	def uri_query(self, value:str) -> None:
@@ -122,10 +116,8 @@ class Request(Message):
 		:return: the Accept value or None if not specified by the request
 		:rtype : String
 		"""
-		for option in self.options:
-			if option.number == defines.OptionRegistry.ACCEPT.number:
-				return cast(int, option.value)
-		return None
+		option = self.get_option(defines.OptionRegistry.ACCEPT.number)
+		return cast(int, option.value) if option is not None else None
 
 	@accept.setter
 	def accept(self, value:int) -> None:
@@ -155,11 +147,7 @@ class Request(Message):
 		:return: the If-Match values or [] if not specified by the request
 		:rtype : list
 		"""
-		value:list[bytes] = []
-		for option in self.options:
-			if option.number == defines.OptionRegistry.IF_MATCH.number:
-				value.append(cast(bytes, option.value))
-		return value
+		return [cast(bytes, option.value) for option in self.get_options(defines.OptionRegistry.IF_MATCH.number)]
 
 	@if_match.setter
 	def if_match(self, values:list[bytes]) -> None:
@@ -191,10 +179,7 @@ class Request(Message):
 		:return: True, if if-none-match is present
 		:rtype : bool
 		"""
-		for option in self.options:
-			if option.number == defines.OptionRegistry.IF_NONE_MATCH.number:
-				return True
-		return False
+		return self.get_option(defines.OptionRegistry.IF_NONE_MATCH.number) is not None
 
 	@if_none_match.setter
 	def if_none_match(self, value:bool) -> None:
@@ -245,10 +230,8 @@ class Request(Message):
 		:return: the Proxy-Uri values or None if not specified by the request
 		:rtype : String
 		"""
-		for option in self.options:
-			if option.number == defines.OptionRegistry.PROXY_URI.number:
-				return cast(str, option.value)
-		return None
+		option = self.get_option(defines.OptionRegistry.PROXY_URI.number)
+		return cast(str, option.value) if option is not None else None
 
 	@proxy_uri.setter
 	def proxy_uri(self, value:str) -> None:
@@ -277,10 +260,8 @@ class Request(Message):
 		:return: the Proxy-Schema values or None if not specified by the request
 		:rtype : String
 		"""
-		for option in self.options:
-			if option.number == defines.OptionRegistry.PROXY_SCHEME.number:
-				return cast(str, option.value)
-		return None
+		option = self.get_option(defines.OptionRegistry.PROXY_SCHEME.number)
+		return cast(str, option.value) if option is not None else None
 
 	@proxy_schema.setter
 	def proxy_schema(self, value:str) -> None:
@@ -11,6 +11,8 @@ class Response(Message):
     """
     Class to handle the Responses.
     """
+    __slots__ = ()
+
     @property
     def location_path(self) -> str:
         """
@@ -19,11 +21,8 @@ class Response(Message):
         :rtype : String
         :return: the Location-Path option
         """
-        value = []
-        for option in self.options:
-            if option.number == defines.OptionRegistry.LOCATION_PATH.number:
-                value.append(str(option.value))
-        return "/".join(value)
+        return self._option_value(defines.OptionRegistry.LOCATION_PATH.number,
+                                  lambda options: "/".join([str(option.value) for option in options]))
 
     @location_path.setter
     def location_path(self, path:str) -> None:
@@ -62,23 +61,22 @@ class Response(Message):
         :return: the Location-Query option
         """
         value:list[str] = []
-        for option in self.options:
-            if option.number == defines.OptionRegistry.LOCATION_QUERY.number:
-                if not isinstance(option.value, str):
-                    raise ValueError("Location-Query must be a string")
-                value.append(option.value)
+        for option in self.get_options(defines.OptionRegistry.LOCATION_QUERY.number):
+            if not isinstance(option.value, str):
+                raise ValueError("Location-Query must be a string")
+            value.append(option.value)
         return value
 
     @location_query.setter
-    def location_query(self, value:str) -> None:
+    def location_query(self, value:str|list[str]) -> None:
         """
         Set the Location-Query of the response.
 
         :type path: String
-        :param path: the Location-Query as a string
+        :param path: the Location-Query as a string, or the list of the queries
         """
         del self.location_query
-        queries = value.split("&")
+        queries = value.split("&") if isinstance(value, str) else value
         for q in queries:
             option = Option()
             option.number = defines.OptionRegistry.LOCATION_QUERY.number
@@ -100,11 +98,8 @@ class Response(Message):
         :rtype : int
         :return: the MaxAge option
         """
-        value = defines.OptionRegistry.MAX_AGE.default
-        for option in self.options:
-            if option.number == defines.OptionRegistry.MAX_AGE.number:
-                value = int(option.value)
-        return value
+        return self._option_value(defines.OptionRegistry.MAX_AGE.number,
+                                  lambda options: int(options[-1].value) if options else defines.OptionRegistry.MAX_AGE.default)
 
     @max_age.setter
     def max_age(self, value:int) -> None:
@@ -5,6 +5,7 @@ from coapthon import defines
 
 if TYPE_CHECKING:
 	from coapthon.server.coap import CoAP
+	from coapthon.server.coap_asyncio import CoAP as AsyncCoAP
 	from coapthon.reverse_proxy.coap import CoAP as ReverseCoAP
 	from coapthon.forward_proxy.coap import CoAP as ForwardCoAP
 	from coapthon.messages.request import Request
@@ -14,12 +15,63 @@ if TYPE_CHECKING:
 __author__ = 'Giacomo Tanganelli'
 
 
+class LinkAttributes(dict):
+	"""
+	The CoRE Link Format attributes of a resource, counting their changes so that the discovery
+	document and the link of the resource are built again only when an attribute has changed.
+	"""
+	__slots__ = ("version",)
+
+	# The changes of the attributes of every resource.
+	changes = 0
+
+	def __init__(self, *args:Any, **kwargs:Any) -> None:
+		super(LinkAttributes, self).__init__(*args, **kwargs)
+		self.version = 0
+		self._changed()
+
+	def _changed(self) -> None:
+		self.version += 1
+		LinkAttributes.changes += 1
+
+	def __setitem__(self, key:str, value:Any) -> None:
+		super(LinkAttributes, self).__setitem__(key, value)
+		self._changed()
+
+	def __delitem__(self, key:str) -> None:
+		super(LinkAttributes, self).__delitem__(key)
+		self._changed()
+
+	def clear(self) -> None:
+		super(LinkAttributes, self).clear()
+		self._changed()
+
+	def pop(self, *args:Any) -> Any:
+		value = super(LinkAttributes, self).pop(*args)
+		self._changed()
+		return value
+
+	def popitem(self) -> Tuple[str, Any]:
+		item = super(LinkAttributes, self).popitem()
+		self._changed()
+		return item
+
+	def setdefault(self, key:str, default:Any=None) -> Any:
+		value = super(LinkAttributes, self).setdefault(key, default)
+		self._changed()
+		return value
+
+	def update(self, *args:Any, **kwargs:Any) -> None:
+		super(LinkAttributes, self).update(*args, **kwargs)
+		self._changed()
+
+
 class Resource(object):
 	"""
 	The Resource class. Represents the base class for all resources.
 	"""
 	def __init__(self, 	name:str, 
-				 		coap_server:Optional[CoAP|ReverseCoAP|ForwardCoAP|ForwardLayer]=None, 
+				 		coap_server:Optional[CoAP|AsyncCoAP|ReverseCoAP|ForwardCoAP|ForwardLayer]=None, 
 						visible:Optional[bool]=True, 
 						observable:Optional[bool]=True,
 						allow_children:Optional[bool]=True) -> None:
@@ -33,7 +85,7 @@ class Resource(object):
 		:param allow_children: if the resource could has children
 		"""
 		# The attributes of this resource.
-		self._attributes:dict[str, Any] = {}
+		self._attributes:LinkAttributes = LinkAttributes()
 
 		# The resource name.
 		self.name = name
@@ -210,7 +262,7 @@ class Resource(object):
 			self._payload = {defines.Content_types["text/plain"]: p}
 
 	@property
-	def attributes(self) -> dict:
+	def attributes(self) -> LinkAttributes:
 		"""
 		Get the CoRE Link Format attribute of the resource.
 
@@ -226,7 +278,7 @@ class Resource(object):
 
 		:param att: the attributes
 		"""
-		self._attributes = att
+		self._attributes = att if isinstance(att, LinkAttributes) else LinkAttributes(att)
 
 	@property
 	def visible(self) -> bool:
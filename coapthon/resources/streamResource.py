@@ -0,0 +1,224 @@
+from __future__ import annotations
+from typing import Any, BinaryIO, Callable, Iterable, Optional, Tuple, Union, TYPE_CHECKING
+
+import os
+import threading
+
+from coapthon import defines
+from coapthon.resources.resource import Resource
+
+if TYPE_CHECKING:
+	from coapthon.server.coap import CoAP
+	from coapthon.messages.request import Request
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Stream(object):
+    """
+    A representation read by window, one block at a time, instead of being held in memory. The block
+    layer keeps the stream of a Block2 transfer, or of a Block1 upload of a client, until its last block
+    and closes it.
+    """
+    def __init__(self, length:Optional[int]=None) -> None:
+        """
+        Initialize the stream.
+
+        :param length: the size of the representation, None if it is not known in advance
+        """
+        self.length = length
+        # called with the bytes acknowledged by the server and the length, during a Block1 upload
+        self.progress:Optional[Callable[[int, Optional[int]], None]] = None
+
+    def block(self, offset:int, size:int) -> Tuple[bytes, bool]:
+        """
+        Read a window of the representation.
+
+        :param offset: the offset of the window
+        :param size: the size of the window
+        :return: the bytes of the window, shorter at the end of the representation, and True if more
+            bytes follow the window
+        :raise ValueError: if the window cannot be read anymore
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+        Release the source of the representation.
+
+        """
+        pass
+
+
+class FileStream(Stream):
+    """
+    A representation read from a file from a start offset to the end of the file when the stream is
+    opened.
+    """
+    def __init__(self, file:Union[str, os.PathLike, BinaryIO], start:int=0) -> None:
+        """
+        Initialize the stream.
+
+        :param file: the path of the file, opened by the stream, or a binary file object, left open
+        :param start: the offset in the file of the first byte of the representation
+        """
+        self._file:BinaryIO
+        if isinstance(file, (str, os.PathLike)):
+            self._file = open(file, "rb")
+            self._owned = True
+        else:
+            self._file = file
+            self._owned = False
+        self._start = start
+        self._lock = threading.Lock()
+        try:
+            self._fd:Optional[int] = self._file.fileno()
+        except (AttributeError, OSError):
+            self._fd = None
+        if self._fd is not None:
+            length = os.fstat(self._fd).st_size
+        else:
+            with self._lock:
+                length = self._file.seek(0, os.SEEK_END)
+        super(FileStream, self).__init__(max(0, length - start))
+
+    def block(self, offset:int, size:int) -> Tuple[bytes, bool]:
+        size = max(0, min(size, self.length - offset))
+        if self._fd is not None and hasattr(os, "pread"):
+            data = os.pread(self._fd, size, self._start + offset)
+        else:
+            # the file object may be shared by other transfers
+            with self._lock:
+                self._file.seek(self._start + offset)
+                data = self._file.read(size)
+        return data, offset + size < self.length
+
+    def close(self) -> None:
+        if self._owned:
+            self._file.close()
+
+
+class BufferStream(Stream):
+    """
+    A representation read from an object supporting the buffer protocol, such as a mmap. The pages of
+    a mapped file are loaded only for the windows that are read.
+    """
+    def __init__(self, buffer:Any) -> None:
+        """
+        Initialize the stream.
+
+        :param buffer: the bytes-like object
+        """
+        self._view = memoryview(buffer).cast("B")
+        super(BufferStream, self).__init__(len(self._view))
+
+    def block(self, offset:int, size:int) -> Tuple[bytes, bool]:
+        return self._view[offset:offset + size].tobytes(), offset + size < self.length
+
+    def close(self) -> None:
+        self._view.release()
+
+
+class IteratorStream(Stream):
+    """
+    A representation produced by an iterator of chunks, read once from the start to the end. The bytes
+    from the last window read on are kept, so that its block can be sent again.
+    """
+    def __init__(self, chunks:Iterable[bytes], length:Optional[int]=None) -> None:
+        """
+        Initialize the stream.
+
+        :param chunks: the chunks of the representation, in order
+        :param length: the size of the representation, None if it is known only at the end
+        """
+        super(IteratorStream, self).__init__(length)
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        # offset of the first byte of the buffer
+        self._start = 0
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    def block(self, offset:int, size:int) -> Tuple[bytes, bool]:
+        with self._lock:
+            if offset < self._start:
+                raise ValueError("window already read")
+            # one byte more tells if the window is the last one
+            end = offset + size - self._start
+            while not self._exhausted and len(self._buffer) <= end:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    self._exhausted = True
+                    self.length = self._start + len(self._buffer)
+                else:
+                    self._buffer += chunk
+            del self._buffer[:offset - self._start]
+            self._start = offset
+            return bytes(self._buffer[:size]), len(self._buffer) > size
+
+    def close(self) -> None:
+        close = getattr(self._chunks, "close", None)
+        if close is not None:
+            close()
+
+
+class StreamResource(Resource):
+    """
+    Base class for the resources whose representation is too large to be held in memory. The
+    representation is a file, a bytes-like object such as a mmap, or a function returning the chunks
+    of a new representation, and is opened again for every GET request. The block layer reads the
+    window of each Block2 response only, and sets Size2 when the size is known.
+    """
+    def __init__(self, name:str, source:Union[str, os.PathLike, Any, Callable[[], Iterable[bytes]], None]=None,
+                 content_type:int=defines.Content_types["application/octet-stream"], length:Optional[int]=None,
+                 coap_server:Optional[CoAP]=None, visible:Optional[bool]=True, observable:Optional[bool]=False,
+                 allow_children:Optional[bool]=False) -> None:
+        """
+        Initialize a new StreamResource.
+
+        :param name: the name of the resource
+        :param source: the path of a file, a bytes-like object or a function returning the chunks of the
+            representation, None if open_stream is overridden
+        :param content_type: the Content-Format of the representation
+        :param length: the size of the representation produced by a function, None if not known
+        :param coap_server: the server that own the resource
+        :param visible: if the resource is visible
+        :param observable: if the resource is observable
+        :param allow_children: if the resource could has children
+        """
+        super(StreamResource, self).__init__(name, coap_server, visible=visible, observable=observable,
+                                             allow_children=allow_children)
+        self.source = source
+        self.stream_content_type = content_type
+        self.length = length
+        self.add_content_type(content_type)
+
+    def open_stream(self, request:Request) -> Stream:
+        """
+        Open the representation of the resource for a GET request.
+
+        :param request: the request
+        :return: the stream of the representation
+        """
+        if isinstance(self.source, (str, os.PathLike)):
+            return FileStream(self.source)
+        if callable(self.source):
+            return IteratorStream(self.source(), self.length)
+        if self.source is None:
+            raise NotImplementedError
+        return BufferStream(self.source)
+
+    def stream(self, request:Request) -> Stream:
+        """
+        Open the representation of the resource in the Content-Format accepted by the request.
+
+        :param request: the request
+        :return: the stream of the representation
+        :raise KeyError: if the Content-Format is not accepted
+        """
+        if self.actual_content_type is not None and self.actual_content_type != self.stream_content_type:
+            raise KeyError("Content-Type not available")
+        return self.open_stream(request)
+
+    def render_GET(self, request:Request) -> StreamResource:
+        return self
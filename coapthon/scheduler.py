@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+from typing import Any, Callable, Optional, TYPE_CHECKING
+
+import collections
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from coapthon import defines
+
+if TYPE_CHECKING:
+	from coapthon.messages.message import Message
+	from coapthon.transaction import Transaction
+
+__author__ = 'Giacomo Tanganelli'
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimerHandle(object):
+    """
+    Handle of a callback scheduled on a Scheduler. Cancelling is O(1): the entry is only marked and
+    dropped when it reaches the top of the heap.
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled', '_scheduler')
+
+    def __init__(self, deadline:float, callback:Callable, args:tuple[Any, ...], scheduler:Scheduler|DeadlineQueue) -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._scheduler:Optional[Scheduler|DeadlineQueue] = scheduler
+
+    def cancel(self) -> None:
+        """
+        Cancel the callback. Has no effect if the callback already ran.
+        """
+        scheduler = self._scheduler
+        if scheduler is not None:
+            scheduler._cancel(self)
+
+
+class Scheduler(object):
+    """
+    Heap of deadlines served by a single thread.
+
+    Callbacks run on the scheduler thread and must not block, since every other timer waits for them.
+    """
+    def __init__(self, name:str="CoAPScheduler") -> None:
+        """
+        Initialize the scheduler. The thread is started with the first scheduled callback.
+
+        :param name: the name of the scheduler thread
+        """
+        self._name = name
+        self._heap:list[tuple[float, int, TimerHandle]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._cancelled_count = 0
+        self._thread:Optional[threading.Thread] = None
+        self._stopped = False
+
+    def __len__(self) -> int:
+        """
+        Return the number of pending callbacks, cancelled ones excluded.
+        """
+        with self._condition:
+            return len(self._heap) - self._cancelled_count
+
+    def call_later(self, delay:float, callback:Callable, *args:Any) -> TimerHandle:
+        """
+        Schedule a callback to be run after delay seconds.
+
+        :param delay: the delay in seconds
+        :param callback: the function to call
+        :param args: the arguments of the function
+        :return: the handle to cancel the callback
+        """
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline:float, callback:Callable, *args:Any) -> TimerHandle:
+        """
+        Schedule a callback to be run at a time.monotonic() deadline.
+
+        :param deadline: the deadline
+        :param callback: the function to call
+        :param args: the arguments of the function
+        :return: the handle to cancel the callback
+        """
+        handle = TimerHandle(deadline, callback, args, self)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Scheduler stopped")
+            heapq.heappush(self._heap, (deadline, next(self._counter), handle))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0][2] is handle:
+                self._condition.notify()
+        return handle
+
+    def stop(self) -> None:
+        """
+        Stop the scheduler thread. Pending callbacks are discarded.
+        """
+        with self._condition:
+            self._stopped = True
+            for _, _, handle in self._heap:
+                handle._scheduler = None
+            self._heap.clear()
+            self._cancelled_count = 0
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _cancel(self, handle:TimerHandle) -> None:
+        """
+        Mark an entry as cancelled and rebuild the heap when the cancelled entries are the majority.
+
+        :param handle: the handle of the entry
+        """
+        with self._condition:
+            # the entry may have been run or dropped since the handle was read
+            if handle.cancelled or handle._scheduler is not self:
+                return
+            handle.cancelled = True
+            self._cancelled_count += 1
+            if self._cancelled_count > 64 and self._cancelled_count * 2 > len(self._heap):
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled_count = 0
+
+    def _run(self) -> None:
+        """
+        Thread function running the callbacks whose deadline expired.
+        """
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    deadline, _, handle = self._heap[0]
+                    if handle.cancelled:
+                        heapq.heappop(self._heap)
+                        self._cancelled_count -= 1
+                        continue
+                    delay = deadline - time.monotonic()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    handle._scheduler = None
+                    handle.cancelled = True
+                    break
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception("Exception in scheduled callback")
+
+
+_scheduler:Optional[Scheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """
+    Return the scheduler shared by all the engines of the process.
+
+    :return: the shared scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+class DeadlineQueue(object):
+    """
+    Callbacks that all run after the same fixed delay, such as the separate ACK timers.
+
+    Since every new deadline is later than the previous ones, a FIFO replaces the heap: adding and
+    cancelling a callback are O(1). Only the head of the queue is armed on the Scheduler.
+    """
+    def __init__(self, delay:float, scheduler:Optional[Scheduler]=None) -> None:
+        """
+        Initialize the queue.
+
+        :param delay: the delay in seconds of every callback
+        :param scheduler: the scheduler to use, the shared one if None
+        """
+        self.delay = delay
+        self._scheduler = scheduler if scheduler is not None else get_scheduler()
+        self._queue:collections.deque[TimerHandle] = collections.deque()
+        self._lock = threading.Lock()
+        self._cancelled_count = 0
+        self._timer:Optional[TimerHandle] = None
+
+    def __len__(self) -> int:
+        """
+        Return the number of pending callbacks, cancelled ones excluded.
+        """
+        with self._lock:
+            return len(self._queue) - self._cancelled_count
+
+    def add(self, callback:Callable, *args:Any) -> TimerHandle:
+        """
+        Schedule a callback to be run after the delay of the queue.
+
+        :param callback: the function to call
+        :param args: the arguments of the function
+        :return: the handle to cancel the callback
+        """
+        handle = TimerHandle(time.monotonic() + self.delay, callback, args, self)
+        with self._lock:
+            self._queue.append(handle)
+            if self._timer is None:
+                self._timer = self._scheduler.call_at(handle.deadline, self._run)
+        return handle
+
+    def _cancel(self, handle:TimerHandle) -> None:
+        """
+        Mark an entry as cancelled. It is dropped when it reaches the head of the queue.
+
+        :param handle: the handle of the entry
+        """
+        with self._lock:
+            if handle.cancelled or handle._scheduler is not self:
+                return
+            handle.cancelled = True
+            self._cancelled_count += 1
+
+    def _run(self) -> None:
+        """
+        Scheduler callback running the expired callbacks and arming the next deadline.
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            self._timer = None
+            while self._queue:
+                handle = self._queue[0]
+                if handle.cancelled:
+                    self._queue.popleft()
+                    self._cancelled_count -= 1
+                elif handle.deadline <= now:
+                    self._queue.popleft()
+                    handle._scheduler = None
+                    handle.cancelled = True
+                    expired.append(handle)
+                else:
+                    self._timer = self._scheduler.call_at(handle.deadline, self._run)
+                    break
+        for handle in expired:
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception("Exception in scheduled callback")
+
+
+_deadline_queues:dict[float, DeadlineQueue] = {}
+
+
+def get_deadline_queue(delay:float) -> DeadlineQueue:
+    """
+    Return the deadline queue for a delay, shared by all the engines of the process.
+
+    :param delay: the delay in seconds
+    :return: the shared deadline queue
+    """
+    with _scheduler_lock:
+        queue = _deadline_queues.get(delay)
+    if queue is None:
+        queue = DeadlineQueue(delay)
+        with _scheduler_lock:
+            queue = _deadline_queues.setdefault(delay, queue)
+    return queue
+
+
+class Retransmitter(object):
+    """
+    Retransmission of confirmable messages with exponential back-off, driven by a Scheduler.
+    """
+    def __init__(self, send:Callable[[Message], None], give_up:Optional[Callable[[Transaction, Message], None]]=None,
+                 stopped:Optional[threading.Event]=None, scheduler:Optional[Scheduler]=None) -> None:
+        """
+        Initialize the retransmitter.
+
+        :param send: the function sending a message
+        :param give_up: the function called when a message has not been acknowledged after MAX_RETRANSMIT attempts
+        :param stopped: the event signalling that the engine has been stopped
+        :param scheduler: the scheduler to use, the shared one if None
+        """
+        self._send = send
+        self._give_up = give_up
+        self._stopped = stopped
+        self._scheduler = scheduler if scheduler is not None else get_scheduler()
+
+    def start(self, transaction:Transaction, message:Message) -> None:
+        """
+        Start the retransmission of a message. A retransmission already running for the transaction is cancelled.
+
+        :param transaction: the transaction that owns the message that needs retransmission
+        :param message: the message that needs the retransmission task
+        """
+        if message.type != defines.Types['CON']:
+            return
+        if transaction.retransmit_handle is not None:
+            transaction.retransmit_handle.cancel()
+        future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
+        transaction.retransmit_handle = self._scheduler.call_later(future_time, self._retransmit,
+                                                                   transaction, message, future_time, 0)
+
+    def _retransmit(self, transaction:Transaction, message:Message, future_time:float, retransmit_count:int) -> None:
+        """
+        Timer callback: retransmit the message and reschedule with a doubled timeout, or give up.
+
+        :param transaction: the transaction that owns the message that needs retransmission
+        :param message: the message that needs the retransmission task
+        :param future_time: the amount of time waited before this attempt
+        :param retransmit_count: the number of retransmissions already done
+        """
+        if message.acknowledged or message.rejected:
+            message.timeouted = False
+            transaction.retransmit_handle = None
+            return
+        if self._stopped is not None and self._stopped.is_set():
+            transaction.retransmit_handle = None
+            return
+        if retransmit_count < defines.MAX_RETRANSMIT:
+            future_time *= 2
+            transaction.retransmit_handle = self._scheduler.call_later(future_time, self._retransmit,
+                                                                       transaction, message, future_time, retransmit_count + 1)
+            self._send(message)
+            return
+
+        logger.warning("Give up on message {message}".format(message=message.line_print))
+        message.timeouted = True
+        transaction.retransmit_handle = None
+        if self._give_up is not None:
+            self._give_up(transaction, message)
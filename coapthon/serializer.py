@@ -13,18 +13,22 @@
 #
 #	- In convert_to_raw(): Corrected a wrong serialization of empty strings. This returned a byte array instead of an empty string.
 #	- Changed some code to use match-case statements
+#	- serialize() writes in a single pass into a per-thread bytearray with precompiled structs
+#	- deserialize() works on a memoryview and defers building the options and the payload to their first access
+#	- serialize() returns the cached wire encoding of an unchanged message, compact() keeps only that encoding
+#	- serialize_like() reuses the options and the payload already encoded for another message
 #
 
 from __future__ import annotations
-from typing import Tuple, Optional, cast, Union
+from typing import Tuple, Optional, Union
 
 import logging
 import struct
-import ctypes
+import threading
 
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
-from coapthon.messages.option import Option
+from coapthon.messages.option import Option, OptionList
 from coapthon import defines
 from coapthon.messages.message import Message
 
@@ -32,35 +36,117 @@ __author__ = 'Giacomo Tanganelli'
 
 logger = logging.getLogger(__name__)
 
+_HEADER = struct.Struct("!BBH")
+_UINT16 = struct.Struct("!H")
+_UINT8_BYTES = [b""] + [bytes((i,)) for i in range(1, 256)]
+_BUFFER_SIZE = 2048
+# smaller payloads are kept by compact(), a memoryview on the datagram would take more memory
+_MIN_VIEW_PAYLOAD = 256
+_local = threading.local()
+_COMMON_OPTIONS = {option.number: option.value_type for option in (defines.OptionRegistry.URI_PATH,
+																	defines.OptionRegistry.CONTENT_TYPE,
+																	defines.OptionRegistry.OBSERVE,
+																	defines.OptionRegistry.BLOCK1,
+																	defines.OptionRegistry.BLOCK2)}
+
+
+class LazyOptions(object):
+	"""
+	The options of a received message, located but not yet decoded.
+	"""
+	__slots__ = ('view', 'spans')
+
+	def __init__(self, view:memoryview, spans:list[tuple[int, int, int, int, Optional[str]]]) -> None:
+		"""
+		:param view: the datagram
+		:param spans: (number, value type, start, end, decoded string value) of every option
+		"""
+		self.view = view
+		self.spans = spans
+
+	def decode(self) -> OptionList:
+		"""
+		Build the Option objects.
+
+		:return: the options, in the order of the datagram
+		"""
+		options = OptionList()
+		view = self.view
+		for number, value_type, start, end, text in self.spans:
+			option = Option()
+			option._number = number
+			if value_type == defines.INTEGER:
+				option._value = int.from_bytes(view[start:end], "big")
+			elif value_type == defines.STRING:
+				option._value = text
+			else:
+				option._value = view[start:end].tobytes()
+			options.append(option)
+		return options
+
+
+class CompactOptions(object):
+	"""
+	The options of a compacted message, decoded again from its datagram.
+	"""
+	__slots__ = ('datagram', )
+
+	def __init__(self, datagram:bytes) -> None:
+		"""
+		:param datagram: the wire encoding of the message
+		"""
+		self.datagram = datagram
+
+	def decode(self) -> OptionList:
+		"""
+		Build the Option objects.
+
+		:return: the options
+		"""
+		view = memoryview(self.datagram)
+		spans, _ = Serializer.locate_options(view, 4 + (view[0] & 0x0F))
+		return LazyOptions(view, spans).decode()
+
 
 class Serializer(object):
 	"""
 	Serializer class to serialize and deserialize CoAP message to/from udp streams.
 	"""
 	@staticmethod
-	def deserialize(datagram:bytes, source:defines.ServerT) -> Message:
+	def peek(datagram:bytes) -> Optional[Tuple[int, int, int]]:
+		"""
+		Read the type, the code and the MID of a datagram without de-serializing it.
+
+		:param datagram: the incoming udp message
+		:return: (type, code, mid), or None if the datagram is not a CoAP message
+		"""
+		if len(datagram) < 4:
+			return None
+		first, code, mid = _HEADER.unpack_from(datagram)
+		if first >> 6 != defines.VERSION:
+			return None
+		return (first >> 4) & 0x03, code, mid
+
+	@staticmethod
+	def deserialize(datagram:bytes|memoryview, source:defines.ServerT) -> Message:
 		"""
 		De-serialize a stream of byte to a message.
 
+		The header and the token are decoded eagerly. The options are only validated and located in a
+		single pass over a memoryview of the datagram, and the payload is left as a slice of it: the
+		Option objects and the payload bytes are built on first access (see Message.options and
+		Message.payload).
+
 		:param datagram: the incoming udp message
 		:param source: the source address and port (ip, port)
 		:return: the message
 		:rtype: Message
 		"""
 		try:
-			fmt = "!BBH"
-			pos = struct.calcsize(fmt)
-			s = struct.Struct(fmt)
-
-			_u = s.unpack_from(datagram)
-			first = _u[0]
-			code = _u[1]
-			mid = _u[2]
-			
-			version = (first & 0xC0) >> 6
-			message_type = (first & 0x30) >> 4
-			token_length = (first & 0x0F)
-			
+			view = datagram if isinstance(datagram, memoryview) else memoryview(datagram)
+			first, code, mid = _HEADER.unpack_from(view)
+			token_length = first & 0x0F
+
 			message:Response|Request|Message
 			if Serializer.is_response(code):
 				message = Response()
@@ -73,87 +159,20 @@ class Serializer(object):
 
 			message.source = source
 			message.destination = None
-			message.version = version
-			message.type = message_type
-			message.mid = mid
-			if token_length > 0:
-				message.token = datagram[pos:pos+token_length]
-			else:
-				message.token = None
-			payload_type = None
-
-			pos += token_length
-			current_option = 0
-
-			values = datagram[pos:]
-			length_packet = len(values)
-			pos = 0
-			while pos < length_packet:
-				next_byte = struct.unpack("B", values[pos].to_bytes(1, "big"))[0]
-				pos += 1
-				if next_byte != int(defines.PAYLOAD_MARKER):
-					# the first 4 bits of the byte represent the option delta
-					# delta = self._reader.read(4).uint
-					num, option_length, pos = Serializer.read_option_value_len_from_byte(next_byte, pos, values)
-					# logger.debug("option value (delta): %d len: %d", num, option_length)
-					current_option += num
-					# read option
-					value:int|bytes|str = None
-					try:
-						option_item = defines.OptionRegistry.LIST[current_option]
-					except KeyError:
-						(opt_critical, _, _) = defines.OptionRegistry.get_option_flags(current_option)
-						if opt_critical:
-							raise AttributeError("Critical option %s unknown" % current_option)
-						else:
-							# If the non-critical option is unknown
-							# (vendor-specific, proprietary) - just skip it
-							logger.warning("unrecognized option %d", current_option)
-					else:
-						if option_length == 0:
-							value = None
-						elif option_item.value_type == defines.INTEGER:
-							tmp = values[pos: pos + option_length]
-							value = 0
-							for b in tmp:
-								value = (value << 8) | struct.unpack("B", b.to_bytes(1, "big"))[0]	# type: ignore[operator]
-						elif option_item.value_type == defines.OPAQUE:
-							value = values[pos: pos + option_length]
-						else:
-							value = values[pos: pos + option_length]
-
-						option = Option()
-						option.number = current_option
-						option.value = Serializer.convert_to_raw(current_option, value, option_length)
-
-						message.add_option(option)
-						if option.number == defines.OptionRegistry.CONTENT_TYPE.number:
-							payload_type = option.value
-					finally:
-						pos += option_length
-				else:
-
-					if length_packet <= pos:
-						# log.err("Payload Marker with no payload")
-						raise AttributeError("Packet length %s, pos %s" % (length_packet, pos))
-					message.payload = b""
-					payload = values[pos:]
-					if payload_type is not None and payload_type in [
-						defines.Content_types["application/octet-stream"],
-						defines.Content_types["application/exi"],
-						defines.Content_types["application/cbor"]
-					]:
-						message.payload = payload
-					else:
-						try:
-							# message.payload = payload.decode("utf-8") # TODO: check if this is corrects
-							message.payload = payload
-						except AttributeError:
-							message.payload = payload
-					pos += len(payload)
-
+			message.version = (first & 0xC0) >> 6
+			message._type = (first & 0x30) >> 4
+			message._mid = mid
+			message.datagram = datagram if isinstance(datagram, bytes) else view.tobytes()
+			pos = 4 + token_length
+			message._token = view[4:pos].tobytes() if token_length > 0 else None
+
+			spans, pos = Serializer.locate_options(view, pos)
+			if pos < len(view):
+				message._raw_payload = view[pos:]
+			if spans:
+				message._raw_options = LazyOptions(view, spans)
 			return message
-		except AttributeError:
+		except (AttributeError, IndexError):
 			return defines.Codes.BAD_REQUEST.number
 		except struct.error:
 			return defines.Codes.BAD_REQUEST.number
@@ -161,123 +180,260 @@ class Serializer(object):
 			logger.debug(e)
 			return defines.Codes.BAD_REQUEST.number
 
+	@staticmethod
+	def locate_options(view:memoryview, pos:int) -> Tuple[list[tuple[int, int, int, int, Optional[str]]], int]:
+		"""
+		Validate and locate the options of a datagram, without building Option objects.
+
+		:param view: the datagram
+		:param pos: the position of the first option, after the token
+		:raise AttributeError: if the options are malformed or a critical option is unknown
+		:raise UnicodeDecodeError: if a string option is not valid UTF-8
+		:return: (number, value type, start, end, decoded string value) of every option, and the
+			position of the payload (the length of the datagram if there is none)
+		"""
+		spans:list[tuple[int, int, int, int, Optional[str]]] = []
+		length_packet = len(view)
+		current_option = 0
+		while pos < length_packet:
+			next_byte = view[pos]
+			pos += 1
+			if next_byte == defines.PAYLOAD_MARKER:
+				if length_packet <= pos:
+					raise AttributeError("Packet length %s, pos %s" % (length_packet, pos))
+				return spans, pos
+
+			# option delta and length nibbles, followed by their extended fields
+			delta = next_byte >> 4
+			if delta == 13:
+				delta = view[pos] + 13
+				pos += 1
+			elif delta == 14:
+				delta = ((view[pos] << 8) | view[pos + 1]) + 269
+				pos += 2
+			elif delta == 15:
+				raise AttributeError("Unsupported option number nibble 15")
+			option_length = next_byte & 0x0F
+			if option_length == 13:
+				option_length = view[pos] + 13
+				pos += 1
+			elif option_length == 14:
+				option_length = ((view[pos] << 8) | view[pos + 1]) + 269
+				pos += 2
+			elif option_length == 15:
+				raise AttributeError("Unsupported option length nibble 15")
+			current_option += delta
+			value_end = pos + option_length
+			if value_end > length_packet:
+				raise AttributeError("Option %s exceeds the packet length" % current_option)
+
+			# fast path for the options found in nearly every message, the registry otherwise
+			value_type = _COMMON_OPTIONS.get(current_option)
+			if value_type is None:
+				option_item = defines.OptionRegistry.LIST.get(current_option)
+				if option_item is None:
+					(opt_critical, _, _) = defines.OptionRegistry.get_option_flags(current_option)
+					if opt_critical:
+						raise AttributeError("Critical option %s unknown" % current_option)
+					# If the non-critical option is unknown
+					# (vendor-specific, proprietary) - just skip it
+					logger.warning("unrecognized option %d", current_option)
+					pos = value_end
+					continue
+				value_type = option_item.value_type
+			# strings are decoded here, so that invalid UTF-8 is still rejected with a 4.00
+			text = str(view[pos:value_end], "utf-8") if value_type == defines.STRING else None
+			spans.append((current_option, value_type, pos, value_end, text))
+			pos = value_end
+		return spans, length_packet
+
 	@staticmethod
 	def serialize(message:Message) -> bytes:
 		"""
-		Serialize a message to a udp packet
+		Serialize a message to a udp packet.
+
+		The header, the options and the payload are written in a single pass into a per-thread
+		bytearray with precompiled structs, then copied out as bytes.
+
+		The result is kept as the wire encoding of the message (Message.datagram) and returned again
+		until the message, its list of options or one of its options is changed.
 
 		:type message: Message
 		:param message: the message to be serialized
 		:rtype: stream of byte
 		:return: the message serialized
 		"""
-		fmt = "!BBH"
-
-		if message.token is None:
-			tkl = 0
-		else:
-			tkl = len(message.token)
-		tmp = (defines.VERSION << 2)
-		tmp |= message.type
-		tmp <<= 4
-		tmp |= tkl
-
-		values:list[int|bytes|str] = [tmp, message.code, message.mid]
-
-		if message.token is not None and tkl > 0:
-			fmt += "%ss" % tkl
-			values.append(message.token)
-
-		options = Serializer.as_sorted_list(message.options)  # already sorted
-		lastoptionnumber = 0
-		for option in options:
-
-			# write 4-bit option delta
-			optiondelta = option.number - lastoptionnumber
-			optiondeltanibble = Serializer.get_option_nibble(optiondelta)
-			tmp = (optiondeltanibble << defines.OPTION_DELTA_BITS)
-
-			# write 4-bit option length
-			optionlength = option.length
-			optionlengthnibble = Serializer.get_option_nibble(optionlength)
-			tmp |= optionlengthnibble
-			fmt += "B"
-			values.append(tmp)
-
-			# write extended option delta field (0 - 2 bytes)
-			match optiondeltanibble:
-				case 13:
-					fmt += "B"
-					values.append(optiondelta - 13)
-				case 14:
-					fmt += "H"
-					values.append(optiondelta - 269)
-
-
-			# write extended option length field (0 - 2 bytes)
-			match optionlengthnibble:
-				case 13:
-					fmt += "B"
-					values.append(optionlength - 13)
-				case 14:
-					fmt += "H"
-					values.append(optionlength - 269)
-
-			# write option value
-			if optionlength > 0:
-				opt_type = defines.OptionRegistry.LIST[option.number].value_type
-
-				match opt_type:
-					case defines.INTEGER:
-						words = Serializer.int_to_words(option.value, optionlength, 8) # type: ignore[arg-type]
-						for num in range(0, optionlength):
-							fmt += "B"
-							values.append(words[num])
-					case defines.STRING:
-						fmt += str(len(bytes(option.value, "utf-8"))) + "s" # type: ignore[arg-type]
-						values.append(bytes(option.value, "utf-8")) # type: ignore[arg-type]
-					case _:  # OPAQUE
-						for b in option.value: # type: ignore
-							fmt += "B"
-							values.append(b)
-
-			# update last option number
-			lastoptionnumber = option.number
-
-		payload = message.payload
-
-		if payload is not None and len(payload) > 0:
-			# if payload is present and of non-zero length, it is prefixed by
-			# an one-byte Payload Marker (0xFF) which indicates the end of
-			# options and the start of the payload
-
-			fmt += "B"
-			values.append(defines.PAYLOAD_MARKER)
-
-			if isinstance(payload, bytes):
-				fmt += str(len(payload)) + "s"
-				values.append(payload)
-			else:
-				fmt += str(len(bytes(payload, "utf-8"))) + "s"
-				values.append(bytes(payload, "utf-8"))
-
-		datagram = None
-		if values[1] is None:
-			values[1] = 0
-		if values[2] is None:
-			values[2] = 0
+		datagram = message.datagram
+		if datagram is not None:
+			return datagram
+		token = message.token
+		tkl = 0 if token is None else len(token)
+		buf = Serializer._buffer()
+		size = len(buf)
 		try:
-			s = struct.Struct(fmt)
-			datagram = ctypes.create_string_buffer(s.size)
-			s.pack_into(datagram, 0, *values)
-		except struct.error:
+			_HEADER.pack_into(buf, 0, (defines.VERSION << 6) | (message.type << 4) | tkl, message.code or 0, message.mid or 0)
+			pos = 4
+			if tkl > 0:
+				buf[pos:pos + tkl] = token
+				pos += tkl
+
+			lastoptionnumber = 0
+			for option in Serializer.as_sorted_list(message.options):
+				number = option._number
+				value = option._value
+				raw:bytes
+				if value is None:
+					raw = b""
+				elif type(value) is int:
+					raw = Serializer.int_to_bytes(value)
+				elif type(value) is str:
+					raw = value.encode("utf-8")
+				elif isinstance(value, (bytes, bytearray, memoryview)):
+					raw = bytes(value)
+				else:
+					raise ValueError("Option %s has a value of type %s" % (number, type(value).__name__))
+				optionlength = len(raw)
+				optiondelta = number - lastoptionnumber
+				lastoptionnumber = number
+
+				if pos + optionlength + 5 > size:
+					buf, size = Serializer._grow(pos + optionlength + 5)
+
+				# option delta and length nibbles, then the extended fields (0 - 2 bytes each)
+				deltanibble = optiondelta if optiondelta <= 12 else Serializer.get_option_nibble(optiondelta)
+				lengthnibble = optionlength if optionlength <= 12 else Serializer.get_option_nibble(optionlength)
+				buf[pos] = (deltanibble << defines.OPTION_DELTA_BITS) | lengthnibble
+				pos += 1
+				if deltanibble == 13:
+					buf[pos] = optiondelta - 13
+					pos += 1
+				elif deltanibble == 14:
+					_UINT16.pack_into(buf, pos, optiondelta - 269)
+					pos += 2
+				if lengthnibble == 13:
+					buf[pos] = optionlength - 13
+					pos += 1
+				elif lengthnibble == 14:
+					_UINT16.pack_into(buf, pos, optionlength - 269)
+					pos += 2
+
+				if optionlength > 0:
+					buf[pos:pos + optionlength] = raw
+					pos += optionlength
+
+			payload = message.payload
+			if isinstance(payload, str):
+				payload = payload.encode("utf-8")
+			elif payload is not None and not isinstance(payload, (bytes, bytearray, memoryview)):
+				# the documents and the streams larger than a block are sliced by the block layer
+				raise ValueError("Payload must be sent by the block layer")
+			if payload is not None and len(payload) > 0:
+				# if payload is present and of non-zero length, it is prefixed by
+				# an one-byte Payload Marker (0xFF) which indicates the end of
+				# options and the start of the payload
+				if pos + len(payload) + 1 > size:
+					buf, size = Serializer._grow(pos + len(payload) + 1)
+				buf[pos] = defines.PAYLOAD_MARKER
+				pos += 1
+				buf[pos:pos + len(payload)] = payload
+				pos += len(payload)
+		except (struct.error, ValueError):
 			# The .exception method will report on the exception encountered
 			# and provide a traceback.
-			logger.debug(fmt)
-			logger.debug(values)
 			logging.exception('Failed to pack structure')
+			return None	# type: ignore[return-value]
+
+		with memoryview(buf) as view:
+			datagram = bytes(view[:pos])
+		message.datagram = datagram
+		return datagram
+
+
+	@staticmethod
+	def serialize_like(message:Message, template:Message) -> bytes:
+		"""
+		Serialize a message with the same options and payload as an other message, such as the
+		notifications of the same representation to several observers. Only the header and the token
+		are encoded, the rest of the datagram of the template is reused.
+
+		:param message: the message to be serialized
+		:param template: the message with the same options and payload
+		:return: the message serialized
+		"""
+		encoded = Serializer.serialize(template)
+		token = message.token or b""
+		datagram = _HEADER.pack((defines.VERSION << 6) | (message.type << 4) | len(token), message.code or 0, message.mid or 0) \
+			+ token + encoded[4 + (encoded[0] & 0x0F):]
+		message.datagram = datagram
+		return datagram
+
+
+	@staticmethod
+	def compact(message:Message) -> None:
+		"""
+		Drop the decoded options and payload of a message whose wire encoding is known. They are
+		decoded again from the datagram on access, the payload as bytes.
+
+		:param message: the message
+		"""
+		datagram = message.datagram
+		if datagram is None:
+			return
+		payload = message._payload
+		if message._raw_payload is None and isinstance(payload, (str, bytes, bytearray, memoryview)) and \
+				len(payload) >= _MIN_VIEW_PAYLOAD:
+			length = len(payload.encode("utf-8") if isinstance(payload, str) else payload)
+			message._raw_payload = memoryview(datagram)[len(datagram) - length:]
+			message._payload = None
+		if message._raw_options is not None or message._options:
+			message._raw_options = CompactOptions(datagram)
+			message._options = OptionList()
+			message._index = None
+			message._values.clear()
+
+
+	@staticmethod
+	def _buffer() -> bytearray:
+		"""
+		Return the serialization buffer of the calling thread.
+
+		:return: the buffer
+		"""
+		try:
+			return _local.buffer
+		except AttributeError:
+			_local.buffer = bytearray(_BUFFER_SIZE)
+			return _local.buffer
+
 
-		return cast(bytes, datagram)
+	@staticmethod
+	def _grow(needed:int) -> tuple[bytearray, int]:
+		"""
+		Enlarge the serialization buffer of the calling thread, keeping its content.
+
+		:param needed: the minimum size of the buffer
+		:return: the buffer and its new size
+		"""
+		buf = _local.buffer
+		buf.extend(bytes(max(needed, 2 * len(buf)) - len(buf)))
+		return buf, len(buf)
+
+
+	@staticmethod
+	def int_to_bytes(value:int) -> bytes:
+		"""
+		Convert a non-negative int option value to its minimal big-endian representation (0 is empty).
+
+		:param value: the value
+		:return: the bytes
+		:raise ValueError: if the value is negative
+		"""
+		if 0 <= value < 256:
+			return _UINT8_BYTES[value]
+		try:
+			return value.to_bytes((value.bit_length() + 7) // 8, "big")
+		except OverflowError:
+			raise ValueError('integer %r is out of bounds!' % hex(value))
 
 
 	@staticmethod
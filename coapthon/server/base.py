@@ -0,0 +1,118 @@
+from __future__ import annotations
+from typing import Optional, cast
+
+import socket
+import struct
+
+from coapthon import defines
+from coapthon.resources.resource import Resource
+from coapthon.utils import Tree
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class ServerBase(object):
+    """
+    The socket setup and the resource directory shared by the threaded and the asyncio server.
+    """
+    root:Tree
+
+    @staticmethod
+    def create_socket(server_address:defines.ServerT, multicast:bool) -> socket.socket:
+        """
+        Create the UDP socket of a server, bound to its address or joined to the group of all CoAP nodes.
+
+        :param server_address: Server address for incoming connections
+        :param multicast: if the ip is a multicast address
+        :return: the bound socket
+        """
+        addrinfo = socket.getaddrinfo(server_address[0], None)[0]
+
+        if multicast:  # pragma: no cover
+
+            # Create a socket
+            # self._socket.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 255)
+            # self._socket.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
+
+            # Join group
+            if addrinfo[0] == socket.AF_INET:  # IPv4
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(('', server_address[1]))
+                mreq = struct.pack("4sl", socket.inet_aton(defines.ALL_COAP_NODES), socket.INADDR_ANY)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            else:
+                # Bugfix for Python 3.6 for Windows ... missing IPPROTO_IPV6 constant
+                if not hasattr(socket, 'IPPROTO_IPV6'):
+                    setattr(socket, 'IPPROTO_IPV6', 41)
+
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+
+                # Allow multiple copies of this program on one machine
+                # (not strictly needed)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(('', server_address[1]))
+
+                addrinfo_multicast = socket.getaddrinfo(defines.ALL_COAP_NODES_IPV6, 5683)[0]
+                group_bin = socket.inet_pton(socket.AF_INET6, cast(str, addrinfo_multicast[4][0]))
+                mreq = group_bin + struct.pack('@I', 0)
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+        else:
+            if addrinfo[0] == socket.AF_INET:  # IPv4
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            else:
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            sock.bind(server_address)
+        return sock
+
+    def add_resource(self, path:str, resource:Resource) -> bool:
+        """
+        Helper function to add resources to the resource directory during server initialization.
+
+        :param path: the path for the new created resource
+        :type resource: Resource
+        :param resource: the resource to be added
+        """
+
+        assert isinstance(resource, Resource)
+        path = path.strip("/")
+        paths = path.split("/")
+        actual_path = ""
+        i = 0
+        for p in paths:
+            i += 1
+            actual_path += "/" + p
+            try:
+                res = self.root[actual_path]
+            except KeyError:
+                res = None
+            if res is None:
+                resource.path = actual_path
+                self.root[actual_path] = resource
+        return True
+
+    def remove_resource(self, path:str) -> Optional[Resource]:
+        """
+        Helper function to remove resources.
+
+        :param path: the path for the unwanted resource
+        :rtype : the removed object
+        """
+
+        path = path.strip("/")
+        paths = path.split("/")
+        actual_path = ""
+        i = 0
+        for p in paths:
+            i += 1
+            actual_path += "/" + p
+        try:
+            res = cast(Resource, self.root[actual_path])
+        except KeyError:
+            res = None
+        if res is not None:
+            del(self.root[actual_path])
+        return res
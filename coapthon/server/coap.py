@@ -1,10 +1,8 @@
 from __future__ import annotations
-from typing import Callable, Optional, cast, TYPE_CHECKING
+from typing import Any, Callable, Hashable, Optional, Tuple, TYPE_CHECKING
 
 import logging
-import random
 import socket
-import struct
 import threading
 
 
@@ -18,10 +16,15 @@ from coapthon.messages.message import Message
 from coapthon.messages.request import Request
 from coapthon.messages.response import Response
 from coapthon.resources.resource import Resource
+from coapthon.scheduler import Retransmitter, get_deadline_queue
 from coapthon.serializer import Serializer
+from coapthon.server.base import ServerBase
+from coapthon.server.dispatcher import NotificationDispatcher
+from coapthon.server.workerpool import WorkerPool
 from coapthon.utils import Tree
 
 if TYPE_CHECKING:
+	from coapthon.scheduler import TimerHandle
 	from coapthon.transaction import Transaction
 
 
@@ -31,11 +34,14 @@ __author__ = 'Giacomo Tanganelli'
 logger = logging.getLogger(__name__)
 
 
-class CoAP(object):
+class CoAP(ServerBase):
     """
     Implementation of the CoAP server
     """
-    def __init__(self, server_address:defines.ServerT, multicast:bool=False, starting_mid:int=None, sock:socket.socket=None, cb_ignore_listen_exception:Callable=None) -> None:
+    def __init__(self, server_address:defines.ServerT, multicast:bool=False, starting_mid:int=None, sock:socket.socket=None, cb_ignore_listen_exception:Callable=None,
+                 workers:Optional[int]=None, queue_size:int=defines.WORKER_QUEUE_SIZE, shed_max_age:int=defines.SHED_MAX_AGE,
+                 max_transactions:Optional[int]=defines.MAX_TRANSACTIONS, notifiers:Optional[int]=None,
+                 notification_queue_size:int=defines.NOTIFICATION_QUEUE_SIZE) -> None:
         """
         Initialize the server.
 
@@ -44,18 +50,39 @@ class CoAP(object):
         :param starting_mid: used for testing purposes
         :param sock: if a socket has been created externally, it can be used directly
         :param cb_ignore_listen_exception: Callback function to handle exception raised during the socket listen operation
+        :param workers: the number of worker threads handling the requests, None to start a thread per request
+        :param queue_size: the maximum number of requests waiting for a worker
+        :param shed_max_age: the Max-Age of the 5.03 responses sent when the queue is full
+        :param max_transactions: the maximum number of exchanges kept by the message layer, None for no limit
+        :param notifiers: the number of threads notifying the observers of the resources changed by requests,
+            None to notify them on the request thread
+        :param notification_queue_size: the maximum number of changed resources waiting for a notifier, the
+            further changes are dropped
         """
         self.stopped = threading.Event()
         self.stopped.clear()
-        self.to_be_stopped:list[threading.Event] = []
         self.purgeThread = threading.Thread(target=self.purge)
         self.purgeThread.start()
 
-        self._messageLayer = MessageLayer(starting_mid)
+        self._workerPool:Optional[WorkerPool] = None
+        if workers is not None:
+            self._workerPool = WorkerPool(workers, queue_size)
+        self._shed_max_age = shed_max_age
+
+        self._messageLayer = MessageLayer(starting_mid, max_transactions)
         self._blockLayer = BlockLayer()
-        self._observeLayer = ObserveLayer()
+        self._observeLayer = ObserveLayer(self._notify_relation)
         self._requestLayer = RequestLayer(self)
         self.resourceLayer = ResourceLayer(self)
+        self._retransmitter = Retransmitter(self.send_datagram, self._retransmission_timeout, self.stopped)
+        self._separate_timers = get_deadline_queue(defines.ACK_TIMEOUT)
+        self._ack_lock = threading.Lock()
+
+        self._dispatcher:Optional[NotificationDispatcher] = None
+        if notifiers is not None:
+            self._dispatcher = NotificationDispatcher(self._observeLayer.due_relations, self._send_relations,
+                                                      notifiers, notification_queue_size,
+                                                      defines.NOTIFICATION_BATCH_SIZE)
 
         # Resource directory
         root = Resource('root', self, visible=False, observable=False, allow_children=False)
@@ -68,51 +95,12 @@ class CoAP(object):
         self.multicast = multicast
         self._cb_ignore_listen_exception = cb_ignore_listen_exception
 
-        addrinfo = socket.getaddrinfo(self.server_address[0], None)[0]
-
         if sock is not None:
 
             # Use given socket, could be a DTLS socket
             self._socket = sock
-
-        elif self.multicast:  # pragma: no cover
-
-            # Create a socket
-            # self._socket.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 255)
-            # self._socket.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
-
-            # Join group
-            if addrinfo[0] == socket.AF_INET:  # IPv4
-                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self._socket.bind(('', self.server_address[1]))
-                mreq = struct.pack("4sl", socket.inet_aton(defines.ALL_COAP_NODES), socket.INADDR_ANY)
-                self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-            else:
-                # Bugfix for Python 3.6 for Windows ... missing IPPROTO_IPV6 constant
-                if not hasattr(socket, 'IPPROTO_IPV6'):
-                    socket.IPPROTO_IPV6 = 41
-
-                self._socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-
-                # Allow multiple copies of this program on one machine
-                # (not strictly needed)
-                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self._socket.bind(('', self.server_address[1]))
-
-                addrinfo_multicast = socket.getaddrinfo(defines.ALL_COAP_NODES_IPV6, 5683)[0]
-                group_bin = socket.inet_pton(socket.AF_INET6, addrinfo_multicast[4][0])
-                mreq = group_bin + struct.pack('@I', 0)
-                self._socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
         else:
-            if addrinfo[0] == socket.AF_INET:  # IPv4
-                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            else:
-                self._socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-            self._socket.bind(self.server_address)
+            self._socket = self.create_socket(self.server_address, self.multicast)
 
     def purge(self) -> None:
         """
@@ -122,6 +110,7 @@ class CoAP(object):
         while not self.stopped.isSet():
             self.stopped.wait(timeout=defines.EXCHANGE_LIFETIME)
             self._messageLayer.purge()
+            self._blockLayer.purge()
 
     def listen(self, timeout:int=10) -> None:
         """
@@ -143,6 +132,8 @@ class CoAP(object):
                         continue
                 raise
             try:
+                if self._reply_duplicate(data, client_address):
+                    continue
                 serializer = Serializer()
                 message = serializer.deserialize(data, client_address)
                 if isinstance(message, int):
@@ -156,7 +147,7 @@ class CoAP(object):
                     self.send_datagram(rst)
                     continue
 
-                logger.debug("receive_datagram - " + str(message))
+                logger.debug("receive_datagram - %s", message)
                 if isinstance(message, Request):
                     transaction = self._messageLayer.receive_request(message)
                     if transaction.request.duplicated and transaction.completed:
@@ -168,9 +159,12 @@ class CoAP(object):
                         logger.debug("message duplicated, transaction NOT completed")
                         self._send_ack(transaction)
                         continue
-                    args = (transaction, )
-                    t = threading.Thread(target=self.receive_request, args=args)
-                    t.start()
+                    if self._workerPool is None:
+                        args = (transaction, )
+                        t = threading.Thread(target=self.receive_request, args=args)
+                        t.start()
+                    elif not self._workerPool.submit(self.receive_request, transaction):
+                        self._shed_request(transaction)
                 # self.receive_datagram(data, client_address)
                 elif isinstance(message, Response):
                     logger.error("Received response from %s", message.source)
@@ -194,13 +188,53 @@ class CoAP(object):
 
     def close(self) -> None:
         """
-        Stop the server.
+        Stop the server. The worker and notifier threads are waited for at most
+        defines.SHUTDOWN_TIMEOUT seconds each.
 
         """
         logger.debug("Stop server")
         self.stopped.set()
-        for event in self.to_be_stopped:
-            event.set()
+        if self._workerPool is not None:
+            self._workerPool.shutdown(defines.SHUTDOWN_TIMEOUT)
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown(defines.SHUTDOWN_TIMEOUT)
+
+    def worker_stats(self) -> Optional[dict[str, Any]]:
+        """
+        Return the counters of the worker pool: queue depth, queue wait time and shed requests.
+
+        :return: the statistics, or None if the server starts a thread per request
+        """
+        if self._workerPool is None:
+            return None
+        return self._workerPool.stats()
+
+    def notification_stats(self) -> Optional[dict[str, Any]]:
+        """
+        Return the counters of the notification dispatcher: queue depth, coalesced notifications and
+        queue wait time.
+
+        :return: the statistics, or None if the observers are notified on the request thread
+        """
+        if self._dispatcher is None:
+            return None
+        return self._dispatcher.stats()
+
+    def _shed_request(self, transaction:Transaction) -> None:
+        """
+        Reject a request that cannot be queued with a 5.03 Service Unavailable response.
+
+        :param transaction: the transaction that owns the request
+        """
+        logger.warning("Worker queue full, shedding request from %s", transaction.request.source)
+        with transaction:
+            transaction.response = Response()
+            transaction.response.destination = transaction.request.source
+            transaction.response.token = transaction.request.token
+            transaction.response.code = defines.Codes.SERVICE_UNAVAILABLE.number
+            transaction.response.max_age = self._shed_max_age
+            self._messageLayer.send_response(transaction)
+            self.send_datagram(transaction.response)
 
     def receive_request(self, transaction:Transaction) -> None:
         """
@@ -217,8 +251,10 @@ class CoAP(object):
 
             if transaction.block_transfer:
                 self._stop_separate_timer(transaction.separate_timer)
-                self._messageLayer.send_response(transaction)
+                with self._ack_lock:
+                    self._messageLayer.send_response(transaction)
                 self.send_datagram(transaction.response)
+                self._messageLayer.compact(transaction)
                 return
 
             self._observeLayer.receive_request(transaction)
@@ -226,10 +262,10 @@ class CoAP(object):
             self._requestLayer.receive_request(transaction)
 
             if transaction.resource is not None and transaction.resource.changed:
-                self.notify(transaction.resource)
+                self._notify_changed(transaction.resource)
                 transaction.resource.changed = False
             elif transaction.resource is not None and transaction.resource.deleted:
-                self.notify(transaction.resource)
+                self._notify_changed(transaction.resource)
                 transaction.resource.deleted = False
 
             if transaction.response is not None:
@@ -239,10 +275,32 @@ class CoAP(object):
             self._stop_separate_timer(transaction.separate_timer)
 
             if transaction.response is not None:
-                self._messageLayer.send_response(transaction)
+                with self._ack_lock:
+                    self._messageLayer.send_response(transaction)
                 if transaction.response.type == defines.Types["CON"]:
                     self._start_retransmission(transaction, transaction.response)
                 self.send_datagram(transaction.response)
+                self._messageLayer.compact(transaction)
+
+    def _reply_duplicate(self, data:bytes, client_address:tuple) -> bool:
+        """
+        Answer the retransmission of a request from its header only, by resending the datagram of the
+        response of the completed exchange. No message object is built.
+
+        :param data: the raw datagram
+        :param client_address: the address of the sender
+        :return: True if the datagram has been handled
+        """
+        header = Serializer.peek(data)
+        if header is None or not Serializer.is_request(header[1]):
+            return False
+        transaction = self._messageLayer.receive_duplicate(client_address[0], client_address[1], header[2], data)
+        if transaction is None or transaction.response is None or transaction.response.datagram is None:
+            return False
+        logger.debug("message duplicated, transaction completed")
+        # the kept datagram is sent again as it is
+        self.send_datagram(transaction.response)
+        return True
 
     def send_datagram(self, message:Message) -> None:
         """
@@ -253,60 +311,11 @@ class CoAP(object):
         """
         if not self.stopped.isSet():
             host, port = message.destination
-            logger.debug("send_datagram - " + str(message))
+            logger.debug("send_datagram - %s", message)
             serializer = Serializer()
             datagram = serializer.serialize(message)
             self._socket.sendto(datagram, (host, port))
 
-    def add_resource(self, path:str, resource:Resource) -> bool:
-        """
-        Helper function to add resources to the resource directory during server initialization.
-
-        :param path: the path for the new created resource
-        :type resource: Resource
-        :param resource: the resource to be added
-        """
-
-        assert isinstance(resource, Resource)
-        path = path.strip("/")
-        paths = path.split("/")
-        actual_path = ""
-        i = 0
-        for p in paths:
-            i += 1
-            actual_path += "/" + p
-            try:
-                res = self.root[actual_path]
-            except KeyError:
-                res = None
-            if res is None:
-                resource.path = actual_path
-                self.root[actual_path] = resource
-        return True
-
-    def remove_resource(self, path:str) -> Optional[Resource]:
-        """
-        Helper function to remove resources.
-
-        :param path: the path for the unwanted resource
-        :rtype : the removed object
-        """
-
-        path = path.strip("/")
-        paths = path.split("/")
-        actual_path = ""
-        i = 0
-        for p in paths:
-            i += 1
-            actual_path += "/" + p
-        try:
-            res = cast(Resource, self.root[actual_path])
-        except KeyError:
-            res = None
-        if res is not None:
-            del(self.root[actual_path])
-        return res
-
     def _start_retransmission(self, transaction:Transaction, message:Message) -> None:
         """
         Start the retransmission task.
@@ -316,67 +325,34 @@ class CoAP(object):
         :type message: Message
         :param message: the message that needs the retransmission task
         """
-        with transaction:
-            if message.type == defines.Types['CON']:
-                future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
-                transaction.retransmit_thread = threading.Thread(target=self._retransmit,
-                                                                 args=(transaction, message, future_time, 0))
-                transaction.retransmit_stop = threading.Event()
-                self.to_be_stopped.append(transaction.retransmit_stop)
-                transaction.retransmit_thread.start()
+        self._retransmitter.start(transaction, message)
 
-    def _retransmit(self, transaction:Transaction, message:Message, future_time:float, retransmit_count:int) -> None:
+    def _retransmission_timeout(self, transaction:Transaction, message:Message) -> None:
         """
-        Thread function to retransmit the message in the future
+        Called when a message has not been acknowledged after all the retransmissions.
 
-        :param transaction: the transaction that owns the message that needs retransmission
-        :param message: the message that needs the retransmission task
-        :param future_time: the amount of time to wait before a new attempt
-        :param retransmit_count: the number of retransmissions
+        :param transaction: the transaction that owns the message
+        :param message: the message that timed out
         """
-        with transaction:
-            while retransmit_count < defines.MAX_RETRANSMIT and (not message.acknowledged and not message.rejected) \
-                    and not self.stopped.isSet():
-                if transaction.retransmit_stop is not None:
-                    transaction.retransmit_stop.wait(timeout=future_time)
-                if not message.acknowledged and not message.rejected and not self.stopped.isSet():
-                    retransmit_count += 1
-                    future_time *= 2
-                    self.send_datagram(message)
-
-            if message.acknowledged or message.rejected:
-                message.timeouted = False
-            else:
-                logger.warning("Give up on message {message}".format(message=message.line_print))
-                message.timeouted = True
-                if message.observe is not None:
-                    self._observeLayer.remove_subscriber(message)
+        if message.observe is not None:
+            self._observeLayer.remove_subscriber(message)
 
-            try:
-                self.to_be_stopped.remove(transaction.retransmit_stop)
-            except ValueError:
-                pass
-            transaction.retransmit_stop = None
-            transaction.retransmit_thread = None
-
-    def _start_separate_timer(self, transaction:Transaction) -> threading.Timer:
+    def _start_separate_timer(self, transaction:Transaction) -> TimerHandle:
         """
-        Start a thread to handle separate mode.
+        Schedule the empty ACK sent in separate mode if the request is not answered within ACK_TIMEOUT.
 
         :type transaction: Transaction
         :param transaction: the transaction that is in processing
-        :rtype : the Timer object
+        :rtype : the handle of the timer
         """
-        t = threading.Timer(defines.ACK_TIMEOUT, self._send_ack, (transaction,))
-        t.start()
-        return t
+        return self._separate_timers.add(self._send_ack, transaction)
 
     @staticmethod
-    def _stop_separate_timer(timer:threading.Timer) -> None:
+    def _stop_separate_timer(timer:TimerHandle) -> None:
         """
-        Stop the separate Thread if an answer has been already provided to the client.
+        Stop the separate timer if an answer has been already provided to the client.
 
-        :param timer: The Timer object
+        :param timer: The handle of the timer
         """
         timer.cancel()
 
@@ -384,12 +360,15 @@ class CoAP(object):
         """
         Sends an ACK message for the request.
 
+        The ACK lock, instead of the transaction lock held by the request handler, serializes the
+        empty ACK against the piggybacked response.
+
         :param transaction: the transaction that owns the request
         """
 
         ack = Message()
         ack.type = defines.Types['ACK']
-        with transaction:
+        with self._ack_lock:
             if not transaction.request.acknowledged and transaction.request.type == defines.Types["CON"]:
                 ack = self._messageLayer.send_empty(transaction, transaction.request, ack)
                 if ack.type is not None and ack.mid is not None:
@@ -403,14 +382,72 @@ class CoAP(object):
         """
         observers = self._observeLayer.notify(resource)
         logger.debug("Notify")
+        self._send_notifications(observers)
+
+    def _notify_changed(self, resource:Resource) -> None:
+        """
+        Hand the notification of a resource changed by a request over to the notification dispatcher.
+        The observers are notified on the request thread if there is no dispatcher, the change is
+        dropped if the backlog of the dispatcher is full.
+
+        :param resource: the changed resource
+        """
+        if self._dispatcher is None:
+            self.notify(resource)
+        elif not self._dispatcher.submit(resource):
+            logger.warning("Notification backlog full, change of %s not notified", resource.path)
+
+    def _notify_relation(self, key:Hashable) -> None:
+        """
+        Hand a notification delayed by pmin or a pmax keep-alive of the observe layer, whose timers run
+        in the scheduler thread, over to the notification dispatcher or to the worker pool, or else to a
+        new thread.
+
+        :param key: the key of the relation
+        """
+        if self._dispatcher is not None:
+            self._dispatcher.submit_relation(key)
+        elif self._workerPool is None:
+            t = threading.Thread(target=self._send_relations, args=([key], ))
+            t.start()
+        elif not self._workerPool.submit(self._send_relations, [key]):
+            logger.warning("Worker queue full, notification of an observe relation dropped")
+
+    def _send_relations(self, keys:list[Hashable]) -> None:
+        """
+        Send the notifications of observe relations with the current state of their resources.
+
+        :param keys: the keys of the relations
+        """
+        self._send_notifications(self._observeLayer.prepare_relations(keys))
+
+    def _send_notifications(self, observers:list[Transaction]) -> None:
+        """
+        Render and send the notifications of observe relations.
+
+        :param observers: the transactions of the relations
+        """
+        # the resource is rendered once per representation, the other observers get a copy
+        templates:dict[Hashable, Tuple[Response, Resource]] = {}
         for transaction in observers:
             with transaction:
-                transaction.response = None
-                transaction = self._requestLayer.receive_request(transaction)
+                key = ObserveLayer.representation_key(transaction.request)
+                template = templates.get(key) if key is not None else None
+                if template is not None:
+                    ObserveLayer.copy_notification(template[0], template[1], transaction)
+                else:
+                    transaction.response = None
+                    transaction = self._requestLayer.receive_request(transaction)
                 transaction = self._observeLayer.send_response(transaction)
                 transaction = self._blockLayer.send_response(transaction)
                 transaction = self._messageLayer.send_response(transaction)
                 if transaction.response is not None:
+                    if template is not None:
+                        if ObserveLayer.is_copy_of(template[0], transaction.response):
+                            Serializer.serialize_like(transaction.response, template[0])
+                    elif key is not None and transaction.response.code == defines.Codes.CONTENT.number \
+                            and transaction.response.block2 is None:
+                        templates[key] = (transaction.response, transaction.resource)
                     if transaction.response.type == defines.Types["CON"]:
                         self._start_retransmission(transaction, transaction.response)
 
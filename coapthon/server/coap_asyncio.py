@@ -0,0 +1,444 @@
+from __future__ import annotations
+from typing import Callable, Hashable, Optional, Tuple, cast, TYPE_CHECKING
+
+import asyncio
+import logging
+import random
+import socket
+import threading
+
+
+from coapthon import defines
+from coapthon.layers.blocklayer import BlockLayer
+from coapthon.layers.messagelayer import MessageLayer
+from coapthon.layers.observelayer import ObserveLayer
+from coapthon.layers.requestlayer import RequestLayer
+from coapthon.layers.resourcelayer import ResourceLayer
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
+from coapthon.server.base import ServerBase
+from coapthon.utils import Tree
+
+if TYPE_CHECKING:
+	from coapthon.transaction import Transaction
+
+
+__author__ = 'Giacomo Tanganelli'
+
+
+logger = logging.getLogger(__name__)
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol that hands every received datagram to the server engine.
+    """
+    def __init__(self, server:CoAP) -> None:
+        self._server = server
+
+    def connection_made(self, transport:asyncio.BaseTransport) -> None:
+        self._server._transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(self, data:bytes, addr:tuple) -> None:
+        self._server.receive_datagram(data, addr)
+
+    def error_received(self, exc:Exception) -> None:
+        logger.warning("error_received - " + str(exc))
+
+
+class CoAP(ServerBase):
+    """
+    Implementation of the CoAP server on top of an asyncio event loop.
+
+    All datagrams are handled on the loop thread, one after the other, by the same
+    Message/Block/Observe/Request/Resource layers that the threaded server uses. No
+    thread is started per request and retransmissions are scheduled as loop timers.
+    Render methods of the resources are called on the loop thread and must not block.
+    """
+    def __init__(self, server_address:defines.ServerT, multicast:bool=False, starting_mid:int=None, sock:socket.socket=None, cb_ignore_listen_exception:Callable=None,
+                 max_transactions:Optional[int]=defines.MAX_TRANSACTIONS) -> None:
+        """
+        Initialize the server.
+
+        :param server_address: Server address for incoming connections
+        :param multicast: if the ip is a multicast address
+        :param starting_mid: used for testing purposes
+        :param sock: if a socket has been created externally, it can be used directly
+        :param cb_ignore_listen_exception: Callback function to handle exception raised while handling a datagram
+        :param max_transactions: the maximum number of exchanges kept by the message layer, None for no limit
+        """
+        self.stopped = threading.Event()
+        self.stopped.clear()
+
+        self._messageLayer = MessageLayer(starting_mid, max_transactions)
+        self._blockLayer = BlockLayer()
+        self._observeLayer = ObserveLayer(self._notify_relation_threadsafe)
+        self._requestLayer = RequestLayer(self)
+        self.resourceLayer = ResourceLayer(self)
+
+        # Resource directory
+        root = Resource('root', self, visible=False, observable=False, allow_children=False)
+        root.path = '/'
+        self.root = Tree()
+        self.root["/"] = root
+        self._serializer = None
+
+        self.server_address = server_address
+        self.multicast = multicast
+        self._cb_ignore_listen_exception = cb_ignore_listen_exception
+
+        self._loop:Optional[asyncio.AbstractEventLoop] = None
+        self._transport:Optional[asyncio.DatagramTransport] = None
+        self._stop_serving:Optional[asyncio.Event] = None
+        self._purge_handle:Optional[asyncio.TimerHandle] = None
+        # resources changed by requests whose observers are notified once the loop is done with the requests
+        self._changed:dict[Resource, None] = {}
+
+        if sock is not None:
+
+            # Use given socket, could be a DTLS socket
+            self._socket = sock
+        else:
+            self._socket = self.create_socket(self.server_address, self.multicast)
+
+    def listen(self, timeout:int=10) -> None:
+        """
+        Run the server on a new event loop until close() is called. This call blocks.
+
+        :param timeout: unused, kept for compatibility with the threaded server
+        """
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        """
+        Serve requests on the running event loop until close() is called.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop_serving = asyncio.Event()
+        if self.stopped.is_set():
+            self._stop_serving.set()
+        self._socket.setblocking(False)
+        await self._loop.create_datagram_endpoint(lambda: _ServerProtocol(self), sock=self._socket)
+        self._purge_handle = self._loop.call_later(defines.EXCHANGE_LIFETIME, self.purge)
+        try:
+            await self._stop_serving.wait()
+        finally:
+            if self._purge_handle is not None:
+                self._purge_handle.cancel()
+            if self._transport is not None:
+                self._transport.close()
+            self._transport = None
+            self._loop = None
+
+    def purge(self) -> None:
+        """
+        Clean old transactions and reschedule itself.
+
+        """
+        self._messageLayer.purge()
+        self._blockLayer.purge()
+        if self._loop is not None and not self.stopped.is_set():
+            self._purge_handle = self._loop.call_later(defines.EXCHANGE_LIFETIME, self.purge)
+
+    def close(self) -> None:
+        """
+        Stop the server. Can be called from any thread.
+
+        """
+        logger.debug("Stop server")
+        self.stopped.set()
+        loop = self._loop
+        if loop is not None and self._stop_serving is not None:
+            try:
+                loop.call_soon_threadsafe(self._stop_serving.set)
+            except RuntimeError:
+                # loop already closed
+                pass
+
+    def receive_datagram(self, data:bytes, client_address:tuple) -> None:
+        """
+        Handle a datagram coming from the udp socket.
+
+        :param data: the raw datagram
+        :param client_address: the address of the sender
+        """
+        if len(client_address) > 2:
+            client_address = (client_address[0], client_address[1])
+        try:
+            if self._reply_duplicate(data, client_address):
+                return
+            serializer = Serializer()
+            message = serializer.deserialize(data, client_address)
+            if isinstance(message, int):
+                logger.error("receive_datagram - BAD REQUEST")
+
+                rst = Message()
+                rst.destination = client_address
+                rst.type = defines.Types["RST"]
+                rst.code = message
+                rst.mid = self._messageLayer.fetch_mid()
+                self.send_datagram(rst)
+                return
+
+            logger.debug("receive_datagram - %s", message)
+            if isinstance(message, Request):
+                transaction = self._messageLayer.receive_request(message)
+                if transaction.request.duplicated and transaction.completed:
+                    logger.debug("message duplicated, transaction completed")
+                    if transaction.response is not None:
+                        self.send_datagram(transaction.response)
+                    return
+                elif transaction.request.duplicated and not transaction.completed:
+                    logger.debug("message duplicated, transaction NOT completed")
+                    self._send_ack(transaction)
+                    return
+                self.receive_request(transaction)
+
+            elif isinstance(message, Response):
+                logger.error("Received response from %s", message.source)
+
+            else:  # is Message
+                transaction = self._messageLayer.receive_empty(message)
+                if transaction is not None:
+                    with transaction:
+                        self._blockLayer.receive_empty(message, transaction)
+                        self._observeLayer.receive_empty(message, transaction)
+
+        except Exception as e:
+            if self._cb_ignore_listen_exception is not None and callable(self._cb_ignore_listen_exception):
+                if self._cb_ignore_listen_exception(e, self):
+                    return
+            logger.exception("Exception while handling datagram")
+
+    def receive_request(self, transaction:Transaction) -> None:
+        """
+        Handle requests coming from the udp socket. The request is processed on the loop thread,
+        so no separate-ACK timer is needed: separate handlers send their empty ACK explicitly.
+
+        :param transaction: the transaction created to manage the request
+        """
+
+        with transaction:
+
+            self._blockLayer.receive_request(transaction)
+
+            if transaction.block_transfer:
+                self._messageLayer.send_response(transaction)
+                self.send_datagram(transaction.response)
+                self._messageLayer.compact(transaction)
+                return
+
+            self._observeLayer.receive_request(transaction)
+
+            self._requestLayer.receive_request(transaction)
+
+            if transaction.resource is not None and transaction.resource.changed:
+                self._notify_changed(transaction.resource)
+                transaction.resource.changed = False
+            elif transaction.resource is not None and transaction.resource.deleted:
+                self._notify_changed(transaction.resource)
+                transaction.resource.deleted = False
+
+            if transaction.response is not None:
+                self._observeLayer.send_response(transaction)
+                self._blockLayer.send_response(transaction)
+
+                self._messageLayer.send_response(transaction)
+                if transaction.response.type == defines.Types["CON"]:
+                    self._start_retransmission(transaction, transaction.response)
+                self.send_datagram(transaction.response)
+                self._messageLayer.compact(transaction)
+
+    def _reply_duplicate(self, data:bytes, client_address:tuple) -> bool:
+        """
+        Answer the retransmission of a request from its header only, by resending the datagram of the
+        response of the completed exchange. No message object is built.
+
+        :param data: the raw datagram
+        :param client_address: the address of the sender
+        :return: True if the datagram has been handled
+        """
+        header = Serializer.peek(data)
+        if header is None or not Serializer.is_request(header[1]):
+            return False
+        transaction = self._messageLayer.receive_duplicate(client_address[0], client_address[1], header[2], data)
+        if transaction is None or transaction.response is None or transaction.response.datagram is None:
+            return False
+        logger.debug("message duplicated, transaction completed")
+        # the kept datagram is sent again as it is
+        self.send_datagram(transaction.response)
+        return True
+
+    def send_datagram(self, message:Message) -> None:
+        """
+        Send a message through the datagram transport.
+
+        :type message: Message
+        :param message: the message to send
+        """
+        if not self.stopped.is_set() and self._transport is not None:
+            host, port = message.destination
+            logger.debug("send_datagram - %s", message)
+            serializer = Serializer()
+            datagram = serializer.serialize(message)
+            self._transport.sendto(datagram, (host, port))
+
+    def _start_retransmission(self, transaction:Transaction, message:Message) -> None:
+        """
+        Schedule the first retransmission of a confirmable message on the event loop.
+
+        :type transaction: Transaction
+        :param transaction: the transaction that owns the message that needs retransmission
+        :type message: Message
+        :param message: the message that needs the retransmission task
+        """
+        if message.type == defines.Types['CON'] and self._loop is not None:
+            if transaction.retransmit_handle is not None:
+                transaction.retransmit_handle.cancel()
+            future_time = random.uniform(defines.ACK_TIMEOUT, (defines.ACK_TIMEOUT * defines.ACK_RANDOM_FACTOR))
+            transaction.retransmit_handle = self._loop.call_later(future_time, self._retransmit, transaction, message, future_time, 0)
+
+    def _retransmit(self, transaction:Transaction, message:Message, future_time:float, retransmit_count:int) -> None:
+        """
+        Timer callback to retransmit the message. Reschedules itself with a doubled timeout
+        until the message is acknowledged, rejected or MAX_RETRANSMIT is reached.
+
+        :param transaction: the transaction that owns the message that needs retransmission
+        :param message: the message that needs the retransmission task
+        :param future_time: the amount of time waited before this attempt
+        :param retransmit_count: the number of retransmissions already done
+        """
+        with transaction:
+            transaction.retransmit_handle = None
+            if message.acknowledged or message.rejected:
+                message.timeouted = False
+                return
+            if self.stopped.is_set():
+                return
+            if retransmit_count < defines.MAX_RETRANSMIT:
+                retransmit_count += 1
+                future_time *= 2
+                self.send_datagram(message)
+                if self._loop is not None:
+                    transaction.retransmit_handle = self._loop.call_later(future_time, self._retransmit, transaction, message, future_time, retransmit_count)
+                return
+
+            logger.warning("Give up on message {message}".format(message=message.line_print))
+            message.timeouted = True
+            if message.observe is not None:
+                self._observeLayer.remove_subscriber(message)
+
+    def _send_ack(self, transaction:Transaction) -> None:
+        """
+        Sends an ACK message for the request.
+
+        :param transaction: the transaction that owns the request
+        """
+
+        ack = Message()
+        ack.type = defines.Types['ACK']
+        with transaction:
+            if not transaction.request.acknowledged and transaction.request.type == defines.Types["CON"]:
+                ack = self._messageLayer.send_empty(transaction, transaction.request, ack)
+                if ack.type is not None and ack.mid is not None:
+                    self.send_datagram(ack)
+
+    def notify(self, resource:Resource) -> None:
+        """
+        Notifies the observers of a certain resource. When called from a thread other than
+        the loop thread, the notification is handed over to the event loop.
+
+        :param resource: the resource
+        """
+        loop = self._loop
+        if loop is not None:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not loop:
+                loop.call_soon_threadsafe(self.notify, resource)
+                return
+
+        observers = self._observeLayer.notify(resource)
+        logger.debug("Notify")
+        self._send_notifications(observers)
+
+    def _notify_changed(self, resource:Resource) -> None:
+        """
+        Notify the observers of a resource changed by a request in a later iteration of the loop, after
+        the response has been sent. The changes of a resource until then give one notification.
+
+        :param resource: the changed resource
+        """
+        loop = self._loop
+        if loop is None:
+            self.notify(resource)
+            return
+        if resource in self._changed:
+            return
+        self._changed[resource] = None
+        if len(self._changed) == 1:
+            loop.call_soon(self._notify_changed_resources)
+
+    def _notify_changed_resources(self) -> None:
+        """
+        Notify the observers of the resources changed since the last call.
+        """
+        changed, self._changed = self._changed, {}
+        for resource in changed:
+            self.notify(resource)
+
+    def _notify_relation_threadsafe(self, key:Hashable) -> None:
+        """
+        Send the notifications delayed by pmin and the pmax keep-alives of the observe layer, whose
+        timers run in the scheduler thread, from the event loop.
+
+        :param key: the key of the relation
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._send_relations, [key])
+
+    def _send_relations(self, keys:list[Hashable]) -> None:
+        """
+        Send the notifications of observe relations with the current state of their resources.
+
+        :param keys: the keys of the relations
+        """
+        self._send_notifications(self._observeLayer.prepare_relations(keys))
+
+    def _send_notifications(self, observers:list[Transaction]) -> None:
+        """
+        Render and send the notifications of observe relations.
+
+        :param observers: the transactions of the relations
+        """
+        # the resource is rendered once per representation, the other observers get a copy
+        templates:dict[Hashable, Tuple[Response, Resource]] = {}
+        for transaction in observers:
+            with transaction:
+                key = ObserveLayer.representation_key(transaction.request)
+                template = templates.get(key) if key is not None else None
+                if template is not None:
+                    ObserveLayer.copy_notification(template[0], template[1], transaction)
+                else:
+                    transaction.response = None
+                    transaction = self._requestLayer.receive_request(transaction)
+                transaction = self._observeLayer.send_response(transaction)
+                transaction = self._blockLayer.send_response(transaction)
+                transaction = self._messageLayer.send_response(transaction)
+                if transaction.response is not None:
+                    if template is not None:
+                        if ObserveLayer.is_copy_of(template[0], transaction.response):
+                            Serializer.serialize_like(transaction.response, template[0])
+                    elif key is not None and transaction.response.code == defines.Codes.CONTENT.number \
+                            and transaction.response.block2 is None:
+                        templates[key] = (transaction.response, transaction.resource)
+                    if transaction.response.type == defines.Types["CON"]:
+                        self._start_retransmission(transaction, transaction.response)
+
+                    self.send_datagram(transaction.response)
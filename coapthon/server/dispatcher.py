@@ -0,0 +1,248 @@
+from __future__ import annotations
+from typing import Any, Callable, Hashable, Optional, TYPE_CHECKING
+
+import logging
+import threading
+import time
+
+if TYPE_CHECKING:
+	from coapthon.resources.resource import Resource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDispatcher(object):
+    """
+    Dispatcher threads sending the observe notifications of changed resources, so that the request
+    that changed a resource is answered without waiting for its observers.
+
+    A changed resource is expanded by a dispatcher thread into the observe relations to notify, and
+    the backlog holds at most one entry per relation: a relation still waiting when the resource
+    changes again gets a single notification with the latest state. The waiting relations are sent
+    in batches, a relation is never notified by two threads at once. At most queue_size changed
+    resources wait to be expanded, the further changes of other resources are dropped and counted.
+    """
+    def __init__(self, expand:Callable[[Resource], list[Hashable]], send:Callable[[list[Hashable]], None],
+                 workers:int, queue_size:int, batch_size:int, name:str="CoAPNotifier") -> None:
+        """
+        Initialize the dispatcher and start its threads.
+
+        :param expand: the function returning the keys of the relations to notify of a change of a resource
+        :param send: the function sending the notifications of a list of relations
+        :param workers: the number of dispatcher threads
+        :param queue_size: the maximum number of changed resources waiting to be expanded
+        :param batch_size: the maximum number of relations sent by a thread at once
+        :param name: the prefix for the names of the dispatcher threads
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self._expand = expand
+        self._send = send
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._condition = threading.Condition()
+        self._stopped = False
+        # resource -> time of its first change not yet expanded, in insertion order
+        self._changed:dict[Resource, float] = {}
+        # relation key -> time of the first change not yet notified to it, in insertion order
+        self._pending:dict[Hashable, float] = {}
+        self._active:set[Hashable] = set()
+        self._submitted = 0
+        self._coalesced = 0
+        self._overflow = 0
+        self._dispatched = 0
+        self._batches = 0
+        self._depth_max = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._threads:list[threading.Thread] = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name="{0}-{1}".format(name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, resource:Resource) -> bool:
+        """
+        Queue the notification of a changed resource.
+
+        :param resource: the changed resource
+        :return: True if the notification has been queued or merged with a waiting one, False if it has
+            been dropped because the backlog is full or the dispatcher is stopped
+        """
+        with self._condition:
+            if self._stopped:
+                return False
+            if resource in self._changed:
+                self._coalesced += 1
+                return True
+            if len(self._changed) >= self._queue_size:
+                self._overflow += 1
+                return False
+            self._changed[resource] = time.monotonic()
+            self._submitted += 1
+            self._record_depth()
+            self._condition.notify()
+        return True
+
+    def submit_relation(self, key:Hashable) -> bool:
+        """
+        Queue the notification of a relation, as the delayed and keep-alive notifications of the relations
+        with attributes. The relations are not counted in the queue size, a relation has one entry at most.
+
+        :param key: the key of the relation
+        :return: True if the notification has been queued or merged with a waiting one, False if the
+            dispatcher is stopped
+        """
+        with self._condition:
+            if self._stopped:
+                return False
+            self._queue([key], time.monotonic())
+            self._condition.notify()
+        return True
+
+    def _record_depth(self) -> None:
+        """
+        Record the maximum queue depth. Must be called with the condition held.
+        """
+        depth = len(self._changed) + len(self._pending)
+        if depth > self._depth_max:
+            self._depth_max = depth
+
+    def _queue(self, keys:list[Hashable], queued_at:float) -> None:
+        """
+        Queue the relations to notify of a change, a relation already waiting keeps its entry. Must be
+        called with the condition held.
+
+        :param keys: the keys of the relations
+        :param queued_at: the time of the change
+        """
+        for key in keys:
+            if key in self._pending:
+                self._coalesced += 1
+            else:
+                self._pending[key] = queued_at
+        self._record_depth()
+
+    def _take(self) -> list[Hashable]:
+        """
+        Take the next batch of waiting relations that no other thread is notifying. Must be called
+        with the condition held.
+
+        :return: the keys of the batch, empty if there is none
+        """
+        now = time.monotonic()
+        batch = []
+        for key, queued_at in self._pending.items():
+            if key in self._active:
+                continue
+            batch.append(key)
+            wait = now - queued_at
+            self._wait_total += wait
+            if wait > self._wait_max:
+                self._wait_max = wait
+            if len(batch) == self._batch_size:
+                break
+        for key in batch:
+            del self._pending[key]
+            self._active.add(key)
+        return batch
+
+    def _worker(self) -> None:
+        """
+        Thread function expanding the changed resources and notifying the waiting relations.
+        """
+        while True:
+            resource:Optional[Resource] = None
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    if self._changed:
+                        resource = next(iter(self._changed))
+                        queued_at = self._changed.pop(resource)
+                        break
+                    batch = self._take()
+                    if batch:
+                        self._batches += 1
+                        break
+                    self._condition.wait()
+            if resource is not None:
+                try:
+                    keys = self._expand(resource)
+                except Exception:
+                    logger.exception("Exception in notification dispatcher")
+                    continue
+                with self._condition:
+                    if not self._stopped:
+                        self._queue(keys, queued_at)
+                        self._condition.notify_all()
+                continue
+            try:
+                self._send(batch)
+            except Exception:
+                logger.exception("Exception in notification dispatcher")
+            with self._condition:
+                self._active.difference_update(batch)
+                self._dispatched += len(batch)
+                if self._pending:
+                    # a relation changed again while it was notified can now be taken
+                    self._condition.notify()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Return the number of changed resources and of relations waiting to be notified.
+
+        :return: the queue depth
+        """
+        with self._condition:
+            return len(self._changed) + len(self._pending)
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Return a snapshot of the dispatcher counters.
+
+        :return: a dictionary with the workers, the queue depth, its maximum so far and the queue size,
+            the queued changes, the coalesced notifications, the dropped changes, the notified relations,
+            the batches and the average and maximum queue wait time in seconds
+        """
+        with self._condition:
+            taken = self._dispatched + len(self._active)
+            return {
+                "workers": len(self._threads),
+                "queue_depth": len(self._changed) + len(self._pending),
+                "queue_max": self._depth_max,
+                "queue_size": self._queue_size,
+                "submitted": self._submitted,
+                "coalesced": self._coalesced,
+                "overflow": self._overflow,
+                "dispatched": self._dispatched,
+                "batches": self._batches,
+                "wait_avg": self._wait_total / taken if taken > 0 else 0.0,
+                "wait_max": self._wait_max,
+            }
+
+    def shutdown(self, timeout:Optional[float]=None) -> None:
+        """
+        Stop the dispatcher. The notifications still waiting are discarded.
+
+        :param timeout: the time to wait for every dispatcher thread, None to not wait
+        """
+        with self._condition:
+            self._stopped = True
+            self._changed.clear()
+            self._pending.clear()
+            self._condition.notify_all()
+        if timeout is not None:
+            for t in self._threads:
+                # the dispatcher may be shut down from one of its own threads
+                if t is not threading.current_thread():
+                    t.join(timeout=timeout)
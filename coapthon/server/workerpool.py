@@ -0,0 +1,133 @@
+from __future__ import annotations
+from typing import Any, Callable, Optional
+
+import logging
+import queue
+import threading
+import time
+
+__author__ = 'Giacomo Tanganelli'
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Fixed-size pool of worker threads fed by a bounded queue.
+
+    Tasks that do not fit into the queue are refused instead of being accepted and left waiting,
+    so that the caller can shed the load early.
+    """
+    def __init__(self, workers:int, queue_size:int, name:str="CoAPWorker") -> None:
+        """
+        Initialize the pool and start the worker threads.
+
+        :param workers: the number of worker threads
+        :param queue_size: the maximum number of tasks waiting for a worker
+        :param name: the prefix for the names of the worker threads
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1")
+        self._queue:queue.Queue[tuple[float, Callable, tuple[Any, ...]]] = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._submitted = 0
+        self._started = 0
+        self._processed = 0
+        self._shed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._threads:list[threading.Thread] = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name="{0}-{1}".format(name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn:Callable, *args:Any) -> bool:
+        """
+        Queue a task for execution.
+
+        :param fn: the function to be executed by a worker
+        :param args: the arguments of the function
+        :return: True if the task has been queued, False if the queue is full or the pool is stopped
+        """
+        if self._stopped.is_set():
+            return False
+        try:
+            self._queue.put_nowait((time.monotonic(), fn, args))
+        except queue.Full:
+            with self._stats_lock:
+                self._shed += 1
+            return False
+        with self._stats_lock:
+            self._submitted += 1
+        return True
+
+    def _worker(self) -> None:
+        """
+        Thread function executing the queued tasks.
+        """
+        while not self._stopped.is_set():
+            try:
+                queued_at, fn, args = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            wait = time.monotonic() - queued_at
+            with self._stats_lock:
+                self._started += 1
+                self._wait_total += wait
+                if wait > self._wait_max:
+                    self._wait_max = wait
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Exception in worker")
+            finally:
+                with self._stats_lock:
+                    self._processed += 1
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Return the number of tasks waiting for a worker.
+
+        :return: the queue depth
+        """
+        return self._queue.qsize()
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Return a snapshot of the pool counters.
+
+        :return: a dictionary with the workers, queue depth and size, the submitted, processed and shed
+            tasks and the average and maximum queue wait time in seconds
+        """
+        with self._stats_lock:
+            started = self._started
+            return {
+                "workers": len(self._threads),
+                "queue_depth": self._queue.qsize(),
+                "queue_size": self._queue.maxsize,
+                "submitted": self._submitted,
+                "processed": self._processed,
+                "shed": self._shed,
+                "wait_avg": self._wait_total / started if started > 0 else 0.0,
+                "wait_max": self._wait_max,
+            }
+
+    def shutdown(self, timeout:Optional[float]=None) -> None:
+        """
+        Stop the workers. Tasks still waiting in the queue are discarded.
+
+        :param timeout: the time to wait for every worker thread, None to not wait
+        """
+        self._stopped.set()
+        if timeout is not None:
+            for t in self._threads:
+                # the pool may be shut down by one of its own tasks
+                if t is not threading.current_thread():
+                    t.join(timeout=timeout)
@@ -4,18 +4,26 @@ from typing import Optional, TYPE_CHECKING
 import threading
 
 if TYPE_CHECKING:
+	import asyncio
 	from coapthon.caching.cache import CacheElement
 	from coapthon.messages.request import Request
 	from coapthon.messages.response import Response
 	from coapthon.resources.resource import Resource
+	from coapthon.scheduler import TimerHandle
 
 __author__ = 'Giacomo Tanganelli'
 
+# guards the creation of the transaction locks
+_lock_guard = threading.Lock()
+
 
 class Transaction(object):
     """
     Transaction object to bind together a request, a response and a resource.
     """
+    __slots__ = ("_response", "_request", "_resource", "_timestamp", "_completed", "_block_transfer",
+                 "notification", "separate_timer", "retransmit_handle", "_lock", "cacheHit", "cached_element")
+
     def __init__(self, request:Optional[Request]=None, response:Optional[Response]=None, resource:Optional[Resource]=None, timestamp:Optional[float]=None) -> None:
         """
         Initialize a Transaction object.
@@ -32,16 +40,22 @@ class Transaction(object):
         self._completed = False
         self._block_transfer = False
         self.notification = False
-        self.separate_timer:Optional[threading.Timer] = None
-        self.retransmit_thread:Optional[threading.Thread] = None
-        self.retransmit_stop:Optional[threading.Event] = None
-        self._lock = threading.RLock()
+        self.separate_timer:Optional[TimerHandle] = None
+        self.retransmit_handle:Optional[TimerHandle|asyncio.TimerHandle] = None
+        # created on first use, most transactions are never entered by more than one thread
+        self._lock:Optional[threading.RLock] = None
 
         self.cacheHit = False
         self.cached_element:Optional[CacheElement] = None
 
     def __enter__(self):	# type:ignore
-        self._lock.acquire()
+        lock = self._lock
+        if lock is None:
+            with _lock_guard:
+                lock = self._lock
+                if lock is None:
+                    lock = self._lock = threading.RLock()
+        lock.acquire()
 
     def __exit__(self, exc_type, exc_val, exc_tb): # type:ignore
         self._lock.release()
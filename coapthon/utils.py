@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import annotations
-from typing import Tuple, Union, TYPE_CHECKING
+from typing import Any, Hashable, Iterator, Optional, Tuple, Union, TYPE_CHECKING
 
 import binascii
+import bisect
+import collections
 import random
+import threading
+import time
 
 from coapthon import defines
 if TYPE_CHECKING:
@@ -164,9 +168,280 @@ def create_logging() -> None:  # pragma: no cover
         f.writelines("datefmt=")
 
 
+class ExpiringTable(object):
+    """
+    Dictionary that keeps its entries in insertion order, which is also their expiry order since all the
+    entries share the same lifetime. Expired entries are evicted incrementally on every insert, and the
+    oldest ones are evicted first when the table is full.
+    """
+    def __init__(self, lifetime:Optional[float]=defines.EXCHANGE_LIFETIME, max_size:Optional[int]=None) -> None:
+        """
+        Initialize the table.
+
+        :param lifetime: the time in seconds after which an entry expires, None if the entries do not expire
+        :param max_size: the maximum number of entries, None for no limit
+        """
+        self.lifetime = lifetime
+        self.max_size = max_size
+        self._items:dict[Hashable, Any] = {}
+        self._times:collections.OrderedDict[Hashable, float] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key:Hashable) -> Any:
+        return self._items[key]
+
+    def __setitem__(self, key:Hashable, value:Any) -> None:
+        now = time.time()
+        with self._lock:
+            if key not in self._items:
+                self._added(key)
+            self._items[key] = value
+            self._times[key] = now
+            self._times.move_to_end(key)
+            self._evict(None if self.lifetime is None else now - self.lifetime)
+
+    def __delitem__(self, key:Hashable) -> None:
+        with self._lock:
+            del self._items[key]
+            del self._times[key]
+            self._removed(key)
+
+    def __contains__(self, key:Hashable) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._items))
+
+    def get(self, key:Hashable, default:Any=None) -> Any:
+        return self._items.get(key, default)
+
+    def pop(self, key:Hashable, default:Any=None) -> Any:
+        with self._lock:
+            if key not in self._items:
+                return default
+            del self._times[key]
+            self._removed(key)
+            return self._items.pop(key)
+
+    def keys(self) -> list[Hashable]:
+        return list(self._items.keys())
+
+    def values(self) -> list[Any]:
+        return list(self._items.values())
+
+    def items(self) -> list[Tuple[Hashable, Any]]:
+        return list(self._items.items())
+
+    def touch(self, key:Hashable) -> None:
+        """
+        Restart the lifetime of an entry that is still in use.
+
+        :param key: the key of the entry
+        """
+        with self._lock:
+            if key in self._times:
+                self._times[key] = time.time()
+                self._times.move_to_end(key)
+
+    def purge(self, lifetime:Optional[float]=None) -> int:
+        """
+        Evict the expired entries.
+
+        :param lifetime: the lifetime to apply, the one of the table if None
+        :return: the number of evicted entries
+        """
+        if lifetime is None:
+            lifetime = self.lifetime
+        with self._lock:
+            return self._evict(None if lifetime is None else time.time() - lifetime)
+
+    def _evict(self, threshold:Optional[float]) -> int:
+        """
+        Evict the entries inserted before threshold, then the oldest ones beyond max_size.
+        Must be called with the lock held.
+
+        :param threshold: the insertion time before which the entries are expired, None to only apply max_size
+        :return: the number of evicted entries
+        """
+        evicted = 0
+        times = self._times
+        while times:
+            key, inserted = next(iter(times.items()))
+            if (threshold is None or inserted >= threshold) and (self.max_size is None or len(times) <= self.max_size):
+                break
+            times.popitem(last=False)
+            del self._items[key]
+            self._removed(key)
+            evicted += 1
+        return evicted
+
+    def _added(self, key:Hashable) -> None:
+        """
+        Hook called, with the lock held, when a new key is inserted.
+        """
+
+    def _removed(self, key:Hashable) -> None:
+        """
+        Hook called, with the lock held, when a key is deleted or evicted.
+        """
+
+
+class TransactionTable(ExpiringTable):
+    """
+    Table of exchanges keyed by (host, port, MID or token) tuples, with a secondary index of the keys
+    of every peer.
+    """
+    def __init__(self, lifetime:Optional[float]=defines.EXCHANGE_LIFETIME, max_size:Optional[int]=None) -> None:
+        """
+        Initialize the table.
+
+        :param lifetime: the time in seconds after which an entry expires, None if the entries do not expire
+        :param max_size: the maximum number of entries, None for no limit
+        """
+        super(TransactionTable, self).__init__(lifetime, max_size)
+        self._peers:dict[Tuple[str, int], set[Tuple[str, int, Union[int, bytes]]]] = {}
+
+    @staticmethod
+    def key(host:str, port:int, value:Optional[Union[int, bytes]]) -> Tuple[str, int, Union[int, bytes]]:
+        """
+        Build the key of an exchange. Hosts are compared case-insensitively and a missing token
+        matches the empty one.
+
+        :param host: the host of the peer
+        :param port: the port of the peer
+        :param value: the MID or the token
+        :return: the key
+        """
+        return host.lower(), port, b"" if value is None else value
+
+    def peer_keys(self, host:str, port:int) -> list[Tuple[str, int, Union[int, bytes]]]:
+        """
+        Return the keys of the exchanges with a peer.
+
+        :param host: the host of the peer
+        :param port: the port of the peer
+        :return: the keys
+        """
+        with self._lock:
+            return list(self._peers.get((host.lower(), port), ()))
+
+    def pop_peer(self, host:str, port:int) -> list[Any]:
+        """
+        Remove all the exchanges with a peer.
+
+        :param host: the host of the peer
+        :param port: the port of the peer
+        :return: the removed values
+        """
+        removed = []
+        with self._lock:
+            for key in self._peers.pop((host.lower(), port), ()):
+                removed.append(self._items.pop(key))
+                del self._times[key]
+        return removed
+
+    def _added(self, key:Any) -> None:
+        peer = (key[0], key[1])
+        keys = self._peers.get(peer)
+        if keys is None:
+            self._peers[peer] = {key}
+        else:
+            keys.add(key)
+
+    def _removed(self, key:Any) -> None:
+        peer = (key[0], key[1])
+        keys = self._peers.get(peer)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._peers[peer]
+
+
+class _TreeNode(object):
+    """
+    Node of the resource tree, one per path segment.
+    """
+    __slots__ = ("key", "children", "names")
+
+    def __init__(self) -> None:
+        # the path registered at the node, None if the node is only on the way to other paths
+        self.key:Optional[str] = None
+        self.children:dict[str, _TreeNode] = {}
+        # the segments of the children, kept sorted
+        self.names:list[str] = []
+
+
 class Tree(object):
+    """
+    Resources of a server by path. The paths are kept in a dictionary for the exact lookups and in a
+    trie of path segments for the prefix lookups and the ordered iteration, so that both cost the depth
+    of the path instead of the number of resources.
+    """
     def __init__(self) -> None:
         self.tree:dict = {}
+        self._root = _TreeNode()
+        self._lock = threading.Lock()
+        # the result of dump, until a path is added or removed
+        self._paths:Optional[list[str]] = None
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        """
+        Return the number of changes of the tree, a path being added, removed or given another resource.
+
+        :return: the version
+        """
+        return self._version
+
+    @staticmethod
+    def _segments(path:str) -> list[str]:
+        """
+        Split a path into the segments of its nodes, "/" being the parent of every absolute path.
+
+        :param path: the path
+        :return: the segments
+        """
+        if path == "/":
+            return [""]
+        if not path:
+            return []
+        return path.split("/")
+
+    def _find(self, path:str) -> Optional[_TreeNode]:
+        """
+        Return the node of a path. Must be called with the lock held.
+
+        :param path: the path
+        :return: the node, None if there is none
+        """
+        node:Optional[_TreeNode] = self._root
+        for segment in self._segments(path):
+            node = node.children.get(segment)  # type:ignore[union-attr]
+            if node is None:
+                return None
+        return node
+
+    @staticmethod
+    def _walk(node:_TreeNode) -> list[str]:
+        """
+        Return the paths registered at a node and below it, parents before children and siblings in
+        lexicographic order of their segment. Must be called with the lock held.
+
+        :param node: the first node
+        :return: the paths
+        """
+        ret = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.key is not None:
+                ret.append(node.key)
+            stack.extend(map(node.children.__getitem__, reversed(node.names)))
+        return ret
 
     def dump(self) -> list:
         """
@@ -174,36 +449,136 @@ class Tree(object):
 
         :return: registered resources.
         """
-        return sorted(list(self.tree.keys()))
+        with self._lock:
+            if self._paths is None:
+                self._paths = self._walk(self._root)
+            return list(self._paths)
 
-    def with_prefix(self, path:str) -> list:
+    def _prefixes(self, path:str) -> list[str]:
+        """
+        Return the registered paths that are a prefix of a path, from the shortest. As with str.startswith,
+        a prefix may end inside a segment: /test is a prefix of /test_post.
+
+        :param path: the path
+        :return: the paths
+        """
         ret = []
-        for key in list(self.tree.keys()):
-            if path.startswith(key):
-                ret.append(key)
+        with self._lock:
+            node:Optional[_TreeNode] = self._root
+            if node.key is not None:  # type:ignore[union-attr]
+                ret.append(node.key)  # type:ignore[union-attr]
+            for segment in self._segments(path):
+                children = node.children  # type:ignore[union-attr]
+                # the paths ending inside the segment
+                for i in range(len(segment)):
+                    child = children.get(segment[:i])
+                    if child is not None and child.key is not None:
+                        ret.append(child.key)
+                node = children.get(segment)
+                if node is None:
+                    break
+                if node.key is not None:
+                    ret.append(node.key)
+        return ret
+
+    def with_prefix(self, path:str) -> list:
+        """
+        Return the registered paths that are a prefix of a path, from the shortest.
 
+        :param path: the path
+        :return: the paths
+        :raise KeyError: if there is none
+        """
+        ret = self._prefixes(path)
         if len(ret) > 0:
             return ret
         raise KeyError
 
     def with_prefix_resource(self, path:str) -> list:
-        ret = []
-        for key, value in self.tree.items():
-            if path.startswith(key):
-                ret.append(value)
+        """
+        Return the resources whose path is a prefix of a path, from the shortest.
 
+        :param path: the path
+        :return: the resources
+        :raise KeyError: if there is none
+        """
+        ret = [self.tree[key] for key in self._prefixes(path)]
         if len(ret) > 0:
             return ret
         raise KeyError
 
+    def longest_prefix(self, path:str) -> str:
+        """
+        Return the longest registered path that is a prefix of a path.
+
+        :param path: the path
+        :return: the registered path, the path itself if it is registered
+        :raise KeyError: if there is none
+        """
+        return self.with_prefix(path)[-1]
+
+    def subtree(self, path:str) -> list:
+        """
+        Return a registered path and the ones below it, in the order of dump.
+
+        :param path: the path
+        :return: the paths, empty if there is none
+        """
+        with self._lock:
+            node = self._find(path)
+            return self._walk(node) if node is not None else []
+
+    def subtree_resource(self, path:str) -> list:
+        """
+        Return the resource of a path and the ones below it, in the order of dump.
+
+        :param path: the path
+        :return: the resources, empty if there is none
+        """
+        return [self.tree[key] for key in self.subtree(path)]
+
     def __getitem__(self, item:str) -> object:
         return self.tree[item]
 
     def __setitem__(self, key:str, value:object) -> None:
-        self.tree[key] = value
+        with self._lock:
+            if key not in self.tree:
+                node = self._root
+                for segment in self._segments(key):
+                    child = node.children.get(segment)
+                    if child is None:
+                        child = node.children[segment] = _TreeNode()
+                        bisect.insort(node.names, segment)
+                    node = child
+                node.key = key
+                self._paths = None
+            self.tree[key] = value
+            self._version += 1
 
     def __delitem__(self, key:str) -> None:
-        del self.tree[key]
+        with self._lock:
+            del self.tree[key]
+            segments = self._segments(key)
+            nodes = [self._root]
+            for segment in segments:
+                nodes.append(nodes[-1].children[segment])
+            nodes[-1].key = None
+            self._paths = None
+            self._version += 1
+            # the nodes left without paths are removed
+            for i in range(len(segments) - 1, -1, -1):
+                node = nodes[i + 1]
+                if node.key is not None or node.children:
+                    break
+                parent = nodes[i]
+                del parent.children[segments[i]]
+                del parent.names[bisect.bisect_left(parent.names, segments[i])]
 
     def __contains__(self, item:str) -> bool:
         return item in self.tree
+
+    def __len__(self) -> int:
+        return len(self.tree)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.dump())
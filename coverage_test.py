@@ -4,8 +4,10 @@ from __future__ import annotations
 from typing import Tuple
 
 from queue import Queue
+import io
 import random
 import socket
+import tempfile
 import threading
 import unittest
 
@@ -1562,6 +1564,61 @@ sed ultrices sapien, at cras amet."""
 
         self._test_with_client([exchange1])
 
+    def test_post_block_stream_client(self) -> None:
+        print("TEST_POST_BLOCK_STREAM_CLIENT")
+        data = bytes(i % 251 for i in range(3000))
+        client = HelperClient(self.server_address)
+        try:
+            # the size of chunks produced by an iterator is known at the end only
+            progress:list[Tuple[int, int]] = []
+            chunks = (data[i:i + 700] for i in range(0, len(data), 700))
+            response = client.post("/big", chunks, timeout=10, progress=lambda sent, length: progress.append((sent, length)))
+            self.assertEqual(response.code, defines.Codes.CHANGED.number)
+            self.assertEqual(self.server.root["/big"].payload, data)
+            self.assertEqual(progress, [(1024, None), (2048, None), (3000, 3000)])
+
+            progress.clear()
+            response = client.put("/big", io.BytesIO(data[:2500]), timeout=10,
+                                   progress=lambda sent, length: progress.append((sent, length)))
+            self.assertEqual(response.code, defines.Codes.METHOD_NOT_ALLOWED.number)
+            self.assertEqual(progress, [(1024, 2500), (2048, 2500)])
+            response = client.post("/big", io.BytesIO(data[:2500]), timeout=10)
+            self.assertEqual(response.code, defines.Codes.CHANGED.number)
+            self.assertEqual(self.server.root["/big"].payload, data[:2500])
+            self.assertEqual(len(client.protocol._blockLayer._block1_sent), 0)
+
+            # a seekable file is sent from its current position
+            upload = io.BytesIO(data[:2500])
+            upload.read(100)
+            response = client.post("/big", upload, timeout=10)
+            self.assertEqual(response.code, defines.Codes.CHANGED.number)
+            self.assertEqual(self.server.root["/big"].payload, data[100:2500])
+            with tempfile.TemporaryFile() as upload:
+                upload.write(data)
+                upload.seek(500)
+                response = client.post("/big", upload, timeout=10)
+            self.assertEqual(response.code, defines.Codes.CHANGED.number)
+            self.assertEqual(self.server.root["/big"].payload, data[500:])
+        finally:
+            client.stop()
+
+    def test_get_block_window_client(self) -> None:
+        print("TEST_GET_BLOCK_WINDOW_CLIENT")
+        data = bytes(i % 251 for i in range(20000))
+        self.server.root["/big"].payload = data.decode("latin-1")
+        client = HelperClient(self.server_address, block2_window=4)
+        try:
+            # the blocks after the first one are requested 4 at a time
+            response = client.get("/big", timeout=10)
+            self.assertEqual(response.code, defines.Codes.CONTENT.number)
+            self.assertEqual(response.payload, data.decode("latin-1").encode("utf-8"))
+            self.assertEqual(response.block2, (len(response.payload) // 1024, 0, 1024))
+            self.assertEqual(len(client.protocol._blockLayer._downloads), 0)
+            response = client.get("/basic", timeout=10)
+            self.assertEqual(response.code, defines.Codes.CONTENT.number)
+        finally:
+            client.stop()
+
     def test_observe_client(self) -> None:
         print("TEST_OBSERVE_CLIENT")
         path = "/basic"
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+from typing import Tuple
+
+import random
+import socket
+import threading
+import unittest
+
+from coapthon import defines
+from coapthon.client.helperclient import HelperClient
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.serializer import Serializer
+from coapthon.server.coap_asyncio import CoAP
+from exampleresources import BasicResource, Storage, Big, voidResource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.server_address:defines.ServerT = ("127.0.0.1", 5683)
+        self.current_mid:int = random.randint(1, 1000)
+        self.server:CoAP = CoAP(self.server_address)
+        self.server.add_resource('basic/', BasicResource())
+        self.server.add_resource('storage/', Storage())
+        self.server.add_resource('big/', Big())
+        self.server.add_resource('void/', voidResource())
+        self.server_thread:threading.Thread = threading.Thread(target=self.server.listen, args=(1,))
+        self.server_thread.start()
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.server_thread.join(timeout=25)
+        self.server = None
+
+    def _test_with_client(self, message_list:list[Tuple[Request, Response]]) -> None:  # pragma: no cover
+        client = HelperClient(self.server_address)
+        for message, expected in message_list:
+            if message is not None:
+                received_message = client.send_request(message, timeout=10)
+            if expected is not None:
+                if expected.type is not None:
+                    self.assertEqual(received_message.type, expected.type)
+                if expected.mid is not None:
+                    self.assertEqual(received_message.mid, expected.mid)
+                self.assertEqual(received_message.code, expected.code)
+                if expected.payload is not None:
+                    self.assertEqual(received_message.payload, expected.payload)
+        client.stop()
+
+    def _test_plugtest(self, message_list:list[Tuple[Message, Response]]) -> None:  # pragma: no cover
+        serializer = Serializer()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(10)
+        for message, expected in message_list:
+            if message is not None:
+                datagram = serializer.serialize(message)
+                sock.sendto(datagram, message.destination)
+            if expected is not None:
+                datagram, source = sock.recvfrom(4096)
+                received_message = serializer.deserialize(datagram, source)
+                if expected.type is not None:
+                    self.assertEqual(received_message.type, expected.type)
+                if expected.mid is not None:
+                    self.assertEqual(received_message.mid, expected.mid)
+                self.assertEqual(received_message.code, expected.code)
+                if expected.payload is not None:
+                    self.assertEqual(received_message.payload, expected.payload)
+        sock.close()
+
+    def test_get(self) -> None:
+        print("TEST_ASYNCIO_GET")
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = "/basic"
+        req.type = defines.Types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.Types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.Codes.CONTENT.number
+        expected.payload = b"Basic Resource"
+
+        self._test_with_client([(req, expected)])
+
+    def test_not_allowed(self) -> None:
+        print("TEST_ASYNCIO_NOT_ALLOWED")
+        exchanges = []
+        for code in (defines.Codes.GET, defines.Codes.POST, defines.Codes.PUT, defines.Codes.DELETE):
+            req = Request()
+            req.code = code.number
+            req.uri_path = "/void"
+            req.type = defines.Types["CON"]
+            req._mid = self.current_mid
+            req.destination = self.server_address
+
+            expected = Response()
+            expected.type = defines.Types["ACK"]
+            expected._mid = self.current_mid
+            expected.code = defines.Codes.METHOD_NOT_ALLOWED.number
+            exchanges.append((req, expected))
+            self.current_mid += 1
+
+        self._test_with_client(exchanges)
+
+    def test_duplicate(self) -> None:
+        print("TEST_ASYNCIO_DUPLICATE")
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = "/basic"
+        req.type = defines.Types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+
+        expected = Response()
+        expected.type = defines.Types["ACK"]
+        expected._mid = self.current_mid
+        expected.code = defines.Codes.CONTENT.number
+        expected.payload = b"Basic Resource"
+
+        # the retransmitted request must be answered with the same response
+        self._test_plugtest([(req, expected), (req, expected)])
+
+    def test_post_block_big_client(self) -> None:
+        print("TEST_ASYNCIO_POST_BLOCK_BIG_CLIENT")
+        req = Request()
+        req.code = defines.Codes.POST.number
+        req.uri_path = "/big"
+        req.type = defines.Types["CON"]
+        req._mid = self.current_mid
+        req.destination = self.server_address
+        req.payload = b"0123456789abcdef" * 200
+
+        expected = Response()
+        expected.type = defines.Types["ACK"]
+        expected.code = defines.Codes.CHANGED.number
+
+        self._test_with_client([(req, expected)])
+        # the exchanges of the blocks acknowledged with 2.31 Continue are kept as datagrams only
+        blocks = [transaction for transaction in self.server._messageLayer._transactions.values()
+                  if transaction.block_transfer]
+        self.assertEqual(len(blocks), 3)
+        for transaction in blocks:
+            self.assertIsNone(transaction.request._payload)
+            self.assertEqual(transaction.request.payload, b"0123456789abcdef" * 64)
+
+if __name__ == '__main__':
+    unittest.main()
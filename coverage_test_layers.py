@@ -0,0 +1,777 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+from typing import Optional
+
+import itertools
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from coapthon import defines
+from coapthon.layers.messagelayer import MessageLayer
+from coapthon.layers.observelayer import ObserveLayer
+from coapthon.layers.blocklayer import BlockLayer
+from coapthon.layers.resourcelayer import LinkDocument, ResourceLayer
+from coapthon.messages.request import Request
+from coapthon.messages.message import Message
+from coapthon.messages.option import Option
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.resources.streamResource import BufferStream, IteratorStream, StreamResource
+from coapthon.serializer import Serializer
+from coapthon.transaction import Transaction
+from coapthon.utils import ExpiringTable, TransactionTable, Tree
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Server(object):
+    """
+    The resource tree of a server, as used by the resource layer.
+    """
+    def __init__(self) -> None:
+        self.root = Tree()
+        root = Resource("root", visible=False, observable=False)
+        root.path = "/"
+        self.root["/"] = root
+
+    def add(self, path:str, resource:Resource) -> Resource:
+        resource.path = path
+        self.root[path] = resource
+        return resource
+
+
+class Tests(unittest.TestCase):
+
+    def _request(self, mid:int, token:bytes, source:defines.ServerT=("127.0.0.1", 5683)) -> Request:
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = "/basic"
+        req.type = defines.Types["CON"]
+        req.mid = mid
+        req.token = token
+        req.source = source
+        return req
+
+    def test_expiring_table(self) -> None:
+        print("TEST_EXPIRING_TABLE")
+        table = ExpiringTable(lifetime=0.05)
+        table["a"] = 1
+        table["b"] = 2
+        time.sleep(0.06)
+        table["b"] = 3
+        # "a" expired and is evicted by the insert, "b" has been re-inserted
+        self.assertNotIn("a", table)
+        self.assertEqual(table["b"], 3)
+        self.assertEqual(len(table), 1)
+
+        table["c"] = 4
+        time.sleep(0.03)
+        table.touch("b")
+        time.sleep(0.03)
+        self.assertEqual(table.purge(), 1)
+        self.assertEqual(table.keys(), ["b"])
+
+    def test_expiring_table_cap(self) -> None:
+        print("TEST_EXPIRING_TABLE_CAP")
+        table = ExpiringTable(max_size=3)
+        for i in range(10):
+            table[i] = i
+        self.assertEqual(table.keys(), [7, 8, 9])
+        self.assertEqual(table.pop(8), 8)
+        self.assertEqual(len(table), 2)
+
+    def test_message_layer_cap(self) -> None:
+        print("TEST_MESSAGE_LAYER_CAP")
+        layer = MessageLayer(1, max_transactions=100)
+        for mid in range(1000):
+            layer.receive_request(self._request(mid, mid.to_bytes(2, "big")))
+        self.assertEqual(len(layer._transactions), 100)
+        self.assertEqual(len(layer._transactions_token), 100)
+
+        # the most recent exchanges are still matched as duplicates
+        transaction = layer.receive_request(self._request(999, b"\x03\xe7"))
+        self.assertTrue(transaction.request.duplicated)
+        transaction = layer.receive_request(self._request(0, b"\x00\x00"))
+        self.assertFalse(transaction.request.duplicated)
+
+    def test_message_layer_lifetime(self) -> None:
+        print("TEST_MESSAGE_LAYER_LIFETIME")
+        expiring = MessageLayer(1, None, 0.01)
+        # the layer of a client, whose observations may wait a long time for a notification
+        kept = MessageLayer(1, None, None)
+        for layer in (expiring, kept):
+            layer.receive_request(self._request(1, b"\x01"))
+        time.sleep(0.02)
+        for layer in (expiring, kept):
+            layer.receive_request(self._request(2, b"\x02"))
+        self.assertEqual(len(expiring._transactions_token), 1)
+        self.assertEqual(len(kept._transactions_token), 2)
+        kept.purge(0)
+        self.assertEqual(len(kept._transactions_token), 0)
+
+    def test_transaction_table(self) -> None:
+        print("TEST_TRANSACTION_TABLE")
+        table = TransactionTable(None)
+        key = TransactionTable.key
+        table[key("FF00::FD", 5683, 1)] = "multicast"
+        table[key("127.0.0.1", 5683, b"\x01")] = "a"
+        table[key("127.0.0.1", 5683, None)] = "b"
+        table[key("127.0.0.1", 5684, 2)] = "c"
+        self.assertEqual(table.get(key("ff00::fd", 5683, 1)), "multicast")
+        self.assertEqual(table.get(key("127.0.0.1", 5683, b"")), "b")
+        self.assertEqual(sorted(table.peer_keys("127.0.0.1", 5683)), [("127.0.0.1", 5683, b""), ("127.0.0.1", 5683, b"\x01")])
+
+        del table[key("127.0.0.1", 5683, b"\x01")]
+        self.assertEqual(table.peer_keys("127.0.0.1", 5683), [("127.0.0.1", 5683, b"")])
+        self.assertEqual(table.pop_peer("127.0.0.1", 5683), ["b"])
+        self.assertEqual(table.peer_keys("127.0.0.1", 5683), [])
+        self.assertEqual(len(table), 2)
+
+    def test_message_layer_match(self) -> None:
+        print("TEST_MESSAGE_LAYER_MATCH")
+        layer = MessageLayer(1)
+        request = self._request(10, b"\x0a")
+        request.destination = ("ff00::fd", 5683)
+        transaction = layer.send_request(request)
+
+        # an ACK from a member of the multicast group is matched through the group key
+        ack = Message()
+        ack.type = defines.Types["ACK"]
+        ack.mid = 10
+        ack.token = b"\x0a"
+        ack.source = ("fe80::1", 5683)
+        self.assertIs(layer.receive_empty(ack), transaction)
+        self.assertTrue(transaction.request.acknowledged)
+
+        ack.source = ("127.0.0.1", 5683)
+        self.assertIsNone(layer.receive_empty(ack))
+
+    def test_receive_duplicate(self) -> None:
+        print("TEST_RECEIVE_DUPLICATE")
+        layer = MessageLayer(1)
+        request = self._request(42, b"\x2a")
+        datagram = Serializer.serialize(request)
+        self.assertEqual(Serializer.peek(datagram), (defines.Types["CON"], defines.Codes.GET.number, 42))
+        self.assertIsNone(Serializer.peek(b"\x40\x01"))
+
+        # only identical retransmissions of completed exchanges are answered from the header
+        self.assertIsNone(layer.receive_duplicate("127.0.0.1", 5683, 42, datagram))
+        transaction = layer.receive_request(Serializer.deserialize(datagram, request.source))
+        self.assertIsNone(layer.receive_duplicate("127.0.0.1", 5683, 42, datagram))
+        transaction.response = Response()
+        transaction.response.destination = request.source
+        layer.send_response(transaction)
+        self.assertIs(layer.receive_duplicate("127.0.0.1", 5683, 42, datagram), transaction)
+        self.assertTrue(transaction.request.duplicated)
+        self.assertIsNone(layer.receive_duplicate("127.0.0.1", 5684, 42, datagram))
+        self.assertIsNone(layer.receive_duplicate("127.0.0.1", 5683, 42, datagram + b"\xffdata"))
+
+    def test_datagram_cache(self) -> None:
+        print("TEST_DATAGRAM_CACHE")
+        response = Response()
+        response.type = defines.Types["ACK"]
+        response.code = defines.Codes.CONTENT.number
+        response.mid = 5
+        response.payload = "Basic Resource" * 20
+        datagram = Serializer.serialize(response)
+        self.assertIs(Serializer.serialize(response), datagram)
+
+        # every change of the wire content drops the cached encoding
+        response.max_age = 30
+        self.assertIsNone(response.datagram)
+        datagram = Serializer.serialize(response)
+        del response.max_age
+        self.assertNotEqual(Serializer.serialize(response), datagram)
+        response.mid = 6
+        self.assertEqual(Serializer.serialize(response)[2:4], b"\x00\x06")
+
+        # a compacted message keeps its datagram and decodes the rest again on access
+        datagram = response.datagram
+        Serializer.compact(response)
+        self.assertEqual(response._options, [])
+        self.assertIsNone(response._payload)
+        self.assertIs(Serializer.serialize(response), datagram)
+        self.assertEqual(response.payload, b"Basic Resource" * 20)
+        self.assertEqual(response.max_age, defines.OptionRegistry.MAX_AGE.default)
+
+        layer = MessageLayer(1)
+        transaction = layer.receive_request(Serializer.deserialize(Serializer.serialize(self._request(9, b"\x09")), ("127.0.0.1", 5683)))
+        transaction.response = response
+        response.type = None
+        response.destination = ("127.0.0.1", 5683)
+        layer.send_response(transaction)
+        Serializer.serialize(response)
+        self.assertTrue(layer.compact(transaction))
+        self.assertIsNone(transaction.response._payload)
+        self.assertEqual(transaction.request.uri_path, "basic")
+
+        # the changes of the list of options and of an option in place drop the cached encoding too
+        request = self._request(10, b"\x0a")
+        request.uri_query = "a=1"
+        datagram = Serializer.serialize(request)
+        option = Option()
+        option.number = defines.OptionRegistry.URI_QUERY.number
+        option.value = "b=2"
+        request.options.append(option)
+        self.assertEqual(request.uri_query, "a=1&b=2")
+        self.assertEqual(Serializer.deserialize(Serializer.serialize(request), ("127.0.0.1", 5683)).uri_query, "a=1&b=2")
+        request.options[-1].value = "c=3"
+        self.assertEqual(Serializer.deserialize(Serializer.serialize(request), ("127.0.0.1", 5683)).uri_query, "a=1&c=3")
+        self.assertNotEqual(Serializer.serialize(request), datagram)
+
+    def test_option_index(self) -> None:
+        print("TEST_OPTION_INDEX")
+        req = self._request(3, b"\x03")
+        req.uri_query = "a=1&b=2"
+        req.block2 = (0, 0, 64)
+        self.assertEqual(req.uri_path, "basic")
+        self.assertEqual(req.uri_query, "a=1&b=2")
+        self.assertEqual(req.block2, (0, 0, 64))
+        self.assertEqual([option.value for option in req.get_options(defines.OptionRegistry.URI_QUERY.number)], ["a=1", "b=2"])
+        with self.assertRaises(TypeError):
+            req.block2 = (1, 0, 64)
+
+        # the cached values follow the changes, also those made on the list of options
+        del req.block2
+        self.assertIsNone(req.block2)
+        del req.uri_path
+        req.uri_path = "/other/path"
+        self.assertEqual(req.uri_path, "other/path")
+        option = Option()
+        option.number = defines.OptionRegistry.URI_QUERY.number
+        option.value = "c=3"
+        req.options.append(option)
+        self.assertEqual(req.uri_query, "a=1&b=2&c=3")
+        # an option replaced in place, the number of options does not change
+        option = Option()
+        option.number = defines.OptionRegistry.URI_QUERY.number
+        option.value = "d=4"
+        req.options[-1] = option
+        self.assertEqual(req.uri_query, "a=1&b=2&d=4")
+        req.options = []
+        self.assertIsNone(req.get_option(defines.OptionRegistry.URI_PATH.number))
+        self.assertEqual(req.uri_path, "")
+
+    def test_slots(self) -> None:
+        print("TEST_SLOTS")
+        req = self._request(4, b"\x04")
+        self.assertFalse(hasattr(req, "__dict__"))
+        with self.assertRaises(AttributeError):
+            req.unknown = 1
+        self.assertEqual(req.options[0], req.get_option(defines.OptionRegistry.URI_PATH.number))
+        self.assertNotEqual(req.options[0], "basic")
+
+        # the lock of a transaction is reentrant and excludes the other threads until it is released
+        transaction = Transaction(req)
+        self.assertFalse(hasattr(transaction, "__dict__"))
+        entered = threading.Event()
+
+        def enter() -> None:
+            with transaction:
+                entered.set()
+
+        with transaction:
+            with transaction:
+                thread = threading.Thread(target=enter)
+                thread.start()
+                self.assertFalse(entered.wait(0.1))
+            self.assertFalse(entered.wait(0.1))
+        thread.join(5)
+        self.assertTrue(entered.is_set())
+
+    def _observe(self, layer:ObserveLayer, resource:Resource, mid:int, observe:int=0) -> Transaction:
+        req = self._request(mid, bytes([mid]))
+        req.observe = observe
+        transaction = layer.receive_request(Transaction(req))
+        transaction.resource = resource
+        transaction.response = Response()
+        transaction.response.code = defines.Codes.CONTENT.number
+        return layer.send_response(transaction)
+
+    def test_observe_index(self) -> None:
+        print("TEST_OBSERVE_INDEX")
+        layer = ObserveLayer()
+        first = Resource("first")
+        second = Resource("second")
+        observers = [self._observe(layer, first, mid) for mid in range(3)]
+        self._observe(layer, second, 3)
+        self.assertEqual(layer.observers(first), 3)
+        self.assertEqual(layer.notify(first), observers)
+
+        # cancel, RST and timeout remove the relation from the index
+        self._observe(layer, first, 0, observe=1)
+        rst = Message()
+        rst.type = defines.Types["RST"]
+        layer.receive_empty(rst, observers[1])
+        message = Message()
+        message.destination = ("127.0.0.1", 5683)
+        message.token = b"\x02"
+        layer.remove_subscriber(message)
+        self.assertEqual(layer.observers(first), 0)
+        self.assertEqual(layer.notify(first), [])
+        self.assertEqual(len(layer.notify(second)), 1)
+
+    def test_tree(self) -> None:
+        print("TEST_TREE")
+        tree = Tree()
+        for path in ("/", "/storage", "/storage/a-b", "/storage/a", "/storage/a/b", "/big", "/stor"):
+            tree[path] = path.upper()
+        self.assertEqual(len(tree), 7)
+        self.assertEqual(tree.dump(), ["/", "/big", "/stor", "/storage", "/storage/a", "/storage/a/b", "/storage/a-b"])
+        self.assertEqual(list(tree), tree.dump())
+
+        # prefixes may end inside a segment, as with str.startswith
+        self.assertEqual(tree.with_prefix("/storage/a/c"), ["/", "/stor", "/storage", "/storage/a"])
+        self.assertEqual(tree.with_prefix_resource("/storage/a/c"), ["/", "/STOR", "/STORAGE", "/STORAGE/A"])
+        self.assertEqual(tree.longest_prefix("/storage/a/b"), "/storage/a/b")
+        self.assertEqual(tree.longest_prefix("/storagex"), "/storage")
+        self.assertEqual(tree.longest_prefix("/storage/a-bc"), "/storage/a-b")
+        for path in ("/storage/a/c", "/storagex", "/storage/a-bc", "/bi", "/"):
+            self.assertEqual(tree.with_prefix(path), [key for key in sorted(tree.dump(), key=len) if path.startswith(key)])
+        self.assertRaises(KeyError, Tree().with_prefix, "/storage")
+
+        self.assertEqual(tree.subtree("/storage/a"), ["/storage/a", "/storage/a/b"])
+        self.assertEqual(tree.subtree_resource("/storage/a/b"), ["/STORAGE/A/B"])
+        self.assertEqual(tree.subtree("/missing"), [])
+
+        # nodes without paths are pruned, the ones on the way to other paths are kept
+        del tree["/storage/a"]
+        self.assertNotIn("/storage/a", tree)
+        self.assertEqual(tree.subtree("/storage"), ["/storage", "/storage/a/b", "/storage/a-b"])
+        self.assertEqual(tree.longest_prefix("/storage/a/c"), "/storage")
+        del tree["/storage/a/b"]
+        self.assertEqual(tree._root.children[""].children["storage"].names, ["a-b"])
+        self.assertRaises(KeyError, tree.__delitem__, "/storage/a")
+
+    def _discover(self, layer:ResourceLayer, query:Optional[str]=None, etag:Optional[bytes]=None) -> Response:
+        req = self._request(1, b"\x01")
+        req.uri_path = defines.DISCOVERY_URL
+        if query is not None:
+            req.uri_query = query
+        if etag is not None:
+            req.etag = etag
+        transaction = Transaction(req)
+        transaction.response = Response()
+        return layer.discover(transaction).response
+
+    def test_discovery_cache(self) -> None:
+        print("TEST_DISCOVERY_CACHE")
+        server = Server()
+        layer = ResourceLayer(server)
+        temperature = server.add("/temperature", Resource("temperature", observable=False))
+        temperature.resource_type = "temp"
+        server.add("/hidden", Resource("hidden", visible=False))
+        server.add("/light", Resource("light", observable=False))
+
+        response = self._discover(layer)
+        self.assertEqual(response.code, defines.Codes.CONTENT.number)
+        self.assertEqual(response.payload, b'</light>;</temperature>;rt="temp",')
+        self.assertEqual(response.content_type, defines.Content_types["application/link-format"])
+        etag = response.etag[0]
+        # the document is not built again
+        self.assertIs(self._discover(layer).payload, response.payload)
+        valid = self._discover(layer, etag=etag)
+        self.assertEqual(valid.code, defines.Codes.VALID.number)
+        self.assertEqual(valid.etag, [etag])
+        self.assertIsNone(valid.payload)
+        self.assertEqual(self._discover(layer, query="rt=temp").payload, b'</temperature>;rt="temp",')
+
+        # only the link of the changed resource is formatted again
+        light = layer._links[server.root["/light"]]
+        temperature.interface_type = "sensor"
+        response = self._discover(layer, etag=etag)
+        self.assertEqual(response.code, defines.Codes.CONTENT.number)
+        self.assertEqual(response.payload, b'</light>;</temperature>;if="sensor";rt="temp",')
+        self.assertNotEqual(response.etag[0], etag)
+        self.assertIs(layer._links[server.root["/light"]], light)
+
+        server.add("/door", Resource("door"))
+        del server.root["/light"]
+        self.assertEqual(self._discover(layer).payload, b'</door>;obs,</temperature>;if="sensor";rt="temp",')
+        self.assertEqual(len(layer._links), 2)
+
+    def test_discovery_index(self) -> None:
+        print("TEST_DISCOVERY_INDEX")
+        server = Server()
+        layer = ResourceLayer(server)
+        for path, rt, interface in (("/a", "temperature", "sensor"), ("/b", "temp-indoor", "actuator"),
+                                    ("/c", "humidity", "sensor"), ("/d", "tempo", None)):
+            resource = server.add(path, Resource(path[1:], observable=False))
+            resource.resource_type = rt
+            if interface is not None:
+                resource.interface_type = interface
+        server.root["/c"].add_content_type(0)
+        server.root["/c"].add_content_type(50)
+
+        def found(query:str) -> list[str]:
+            paths = [resource.path for resource, link in layer.find(layer.filters(query))]
+            # the index gives the resources that the filters match one by one
+            self.assertEqual(paths, [path for path in ("/a", "/b", "/c", "/d")
+                                     if path in server.root and ResourceLayer.valid(query, server.root[path].attributes)])
+            return paths
+
+        self.assertEqual(found("rt=temperature"), ["/a"])
+        self.assertEqual(found("rt=temp*"), ["/a", "/b", "/d"])
+        self.assertEqual(found("rt=temp-*&if=actuator"), ["/b"])
+        self.assertEqual(found("if=sensor&rt=temp*"), ["/a"])
+        self.assertEqual(found("ct=50"), ["/c"])
+        self.assertEqual(found("rt=*"), ["/a", "/b", "/c", "/d"])
+        self.assertEqual(found("rt=hum"), [])
+        self.assertEqual(found("sz=1"), [])
+        self.assertEqual(found("obs"), ["/a", "/b", "/c", "/d"])
+        self.assertEqual(self._discover(layer, query="rt=temp*&if=sensor").payload, b'</a>;if="sensor";rt="temperature",')
+
+        # the index follows the changes of the attributes and of the tree
+        server.root["/a"].resource_type = "pressure"
+        del server.root["/b"]
+        self.assertEqual(found("rt=temp*"), ["/d"])
+        self.assertEqual(found("rt=pressure"), ["/a"])
+        self.assertNotIn("temp-indoor", layer._attribute_values["rt"])
+        self.assertNotIn("actuator", layer._attribute_index["if"])
+
+    def test_discovery_blocks(self) -> None:
+        print("TEST_DISCOVERY_BLOCKS")
+        document = LinkDocument([b"</a>;", b"</bb>;obs,", b"", "</\u00e8>;".encode("utf-8")])
+        full = b"".join([b"</a>;", b"</bb>;obs,", "</\u00e8>;".encode("utf-8")])
+        self.assertEqual(len(document), len(full))
+        self.assertEqual(bytes(document), full)
+        for start in range(len(full) + 1):
+            for stop in range(start, len(full) + 2):
+                self.assertEqual(document[start:stop], full[start:stop])
+        self.assertEqual(document[::2], full[::2])
+
+        server = Server()
+        layer = ResourceLayer(server)
+        for i in range(100):
+            server.add(f"/sensors/s{i}", Resource(f"s{i}", observable=False)).resource_type = f"temperature{i % 2}"
+        expected = b"".join(link for resource, link in layer.find([("rt", "temperature1")]))
+        self.assertGreater(len(expected), defines.MAX_PAYLOAD)
+
+        block_layer = BlockLayer()
+
+        def block(num:int) -> Response:
+            req = self._request(num + 1, b"\x05")
+            req.uri_path = defines.DISCOVERY_URL
+            req.uri_query = "rt=temperature1"
+            req.block2 = (num, 0, 256)
+            transaction = block_layer.receive_request(Transaction(req))
+            transaction.response = Response()
+            layer.discover(transaction)
+            # the payload is generated by block, the whole document is not built
+            self.assertIsInstance(transaction.response.payload, LinkDocument)
+            return block_layer.send_response(transaction).response
+
+        received = b""
+        num = 0
+        while True:
+            response = block(num)
+            self.assertEqual(response.block2[0], num)
+            self.assertEqual(response.size2, len(expected))
+            received += response.payload
+            if response.block2[1] == 0:
+                break
+            num += 1
+        self.assertEqual(received, expected)
+        self.assertEqual(block(1).payload, expected[256:512])
+        self.assertEqual(block(0).payload, expected[:256])
+        # the blocks are sliced out of the same document
+        self.assertEqual(len(layer._documents), 1)
+
+    def _block1(self, layer:BlockLayer, token:bytes, num:int, m:int, payload:bytes, size1:Optional[int]=None,
+                source:defines.ServerT=("127.0.0.1", 5683)) -> Transaction:
+        req = self._request(num + 1, token, source)
+        req.code = defines.Codes.POST.number
+        req.block1 = (num, m, 16)
+        if size1 is not None:
+            req.size1 = size1
+        req.payload = payload
+        return layer.receive_request(Transaction(req))
+
+    def test_block1_reassembly(self) -> None:
+        print("TEST_BLOCK1_REASSEMBLY")
+        body = bytes(range(40))
+        layer = BlockLayer(max_block1_size=64, max_block1_total=80, block1_lifetime=0.05)
+        # the buffer is allocated for the announced size and cut to the received body
+        self.assertEqual(self._block1(layer, b"\x01", 0, 1, body[:16], size1=48).response.code,
+                         defines.Codes.CONTINUE.number)
+        self.assertEqual(len(layer._block1_receive.values()[0].payload), 48)
+        # a block received again is acknowledged without being written twice
+        duplicate = self._block1(layer, b"\x01", 0, 1, body[:16])
+        self.assertEqual(duplicate.response.code, defines.Codes.CONTINUE.number)
+        self.assertEqual(duplicate.response.block1, (0, 1, 16))
+        # a block ahead of the next one is written at its offset, if it has the size of the blocks
+        self.assertEqual(self._block1(layer, b"\x01", 2, 1, body[32:]).response.code,
+                         defines.Codes.REQUEST_ENTITY_INCOMPLETE.number)
+        ahead = self._block1(layer, b"\x01", 2, 0, body[32:])
+        self.assertEqual(ahead.response.code, defines.Codes.CONTINUE.number)
+        self.assertEqual(ahead.response.block1, (2, 0, 16))
+        self.assertEqual(self._block1(layer, b"\x01", 2, 0, body[32:]).response.code, defines.Codes.CONTINUE.number)
+        self.assertEqual(self._block1(layer, b"\x01", 3, 0, body[32:]).response.code,
+                         defines.Codes.REQUEST_ENTITY_INCOMPLETE.number)
+        self.assertEqual(len(layer._block1_receive.values()[0].payload), 40)
+        transaction = self._block1(layer, b"\x01", 1, 1, body[16:32])
+        self.assertIsNone(transaction.response)
+        self.assertFalse(transaction.block_transfer)
+        self.assertEqual(transaction.request.payload, body)
+        self.assertEqual(len(layer._block1_receive), 0)
+        self.assertEqual(layer._block1_bytes, 0)
+
+        # a body larger than a session may hold
+        response = self._block1(layer, b"\x02", 0, 1, body[:16], size1=65).response
+        self.assertEqual(response.code, defines.Codes.REQUEST_ENTITY_TOO_LARGE.number)
+        self.assertEqual(response.size1, 64)
+        self._block1(layer, b"\x02", 0, 1, body[:16])
+        for num in range(1, 4):
+            self._block1(layer, b"\x02", num, 1, body[:16])
+        self.assertEqual(self._block1(layer, b"\x02", 4, 1, body[:16]).response.code,
+                         defines.Codes.REQUEST_ENTITY_TOO_LARGE.number)
+        self.assertNotIn(TransactionTable.key("127.0.0.1", 5683, b"\x02"), layer._block1_receive)
+
+        # the sessions together hold at most 80 bytes
+        self._block1(layer, b"\x03", 0, 1, body[:16], size1=64)
+        response = self._block1(layer, b"\x04", 0, 1, body[:16], size1=32).response
+        self.assertEqual(response.code, defines.Codes.SERVICE_UNAVAILABLE.number)
+        self.assertEqual(response.max_age, defines.SHED_MAX_AGE)
+        self.assertEqual(self._block1(layer, b"\x04", 0, 1, body[:16]).response.code, defines.Codes.CONTINUE.number)
+
+        # the idle sessions expire and their memory is available again
+        time.sleep(0.06)
+        layer.purge()
+        self.assertEqual(len(layer._block1_receive), 0)
+        self.assertEqual(layer._block1_bytes, 0)
+        self.assertEqual(self._block1(layer, b"\x03", 1, 1, body[16:32]).response.code,
+                         defines.Codes.REQUEST_ENTITY_INCOMPLETE.number)
+
+    def _block2(self, layer:BlockLayer, token:bytes, num:int, representation:Optional[bytes],
+                etag:Optional[bytes]=None) -> Transaction:
+        req = self._request(num + 1, token)
+        req.uri_path = "/firmware"
+        req.block2 = (num, 0, 64)
+        transaction = layer.receive_request(Transaction(req))
+        if transaction.block_transfer:
+            return transaction
+        # rendered by the resource layer
+        self.assertIsNotNone(representation)
+        transaction.response = Response()
+        transaction.response.code = defines.Codes.CONTENT.number
+        transaction.response.payload = (defines.Content_types["application/octet-stream"], representation)
+        if etag is not None:
+            transaction.response.etag = etag
+        return layer.send_response(transaction)
+
+    def test_block2_pinned(self) -> None:
+        print("TEST_BLOCK2_PINNED")
+        representation = bytes(range(200))
+        layer = BlockLayer(max_block2_pinned=400, block2_lifetime=0.05)
+        first = self._block2(layer, b"\x01", 0, representation).response
+        self.assertEqual(first.block2, (0, 1, 64))
+        # the following blocks are slices of the representation of the first one, not rendered again
+        received = bytes(first.payload)
+        for num in range(1, 4):
+            transaction = self._block2(layer, b"\x01", num, None)
+            self.assertIsInstance(transaction.response.payload, memoryview)
+            self.assertEqual(transaction.response.block2, (num, 1 if num < 3 else 0, 64))
+            self.assertEqual(transaction.response.content_type, defines.Content_types["application/octet-stream"])
+            received += bytes(transaction.response.payload)
+        self.assertEqual(received, representation)
+        # a representation without ETag is dropped with its transfer
+        self.assertEqual(len(layer._block2_receive), 0)
+        self.assertEqual(layer._pinned_bytes, 0)
+
+        # the transfers of the same representation share it
+        self._block2(layer, b"\x02", 0, representation, b"v1")
+        self._block2(layer, b"\x03", 0, representation, b"v1")
+        self.assertEqual(layer._pinned_bytes, 200)
+        self.assertEqual(self._block2(layer, b"\x03", 1, None).response.etag, [b"v1"])
+        # beyond the budget the least recently used representation is dropped, its transfer renders again
+        self._block2(layer, b"\x04", 0, bytes(200), b"v2")
+        self._block2(layer, b"\x05", 0, bytes(100), b"v3")
+        self.assertEqual(layer._pinned_bytes, 300)
+        self.assertFalse(self._block2(layer, b"\x02", 1, representation, b"v1").block_transfer)
+        self.assertTrue(self._block2(layer, b"\x04", 1, None).block_transfer)
+
+        # the sessions and the representations not used during their lifetime expire
+        time.sleep(0.06)
+        layer.purge()
+        self.assertEqual(len(layer._block2_receive), 0)
+        self.assertEqual(layer._pinned_bytes, 0)
+
+    def test_block2_window(self) -> None:
+        print("TEST_BLOCK2_WINDOW")
+        data = bytes(i % 251 for i in range(300))
+        layer = BlockLayer(block2_window=3)
+        mids = itertools.count(2)
+        req = self._request(1, b"\x01")
+        req.destination = ("127.0.0.1", 5683)
+        layer.send_request(req)
+        # the size of the representation is asked with the first request
+        self.assertEqual(req.size2, 0)
+
+        def respond(request:Request, code:int=defines.Codes.CONTENT.number) -> Transaction:
+            if request.mid is None:
+                # set by the message layer
+                request.mid = next(mids)
+            response = Response()
+            response.source = ("127.0.0.1", 5683)
+            response.token = b"\x01"
+            response.mid = request.mid
+            response.code = code
+            if code == defines.Codes.CONTENT.number:
+                num = request.block2[0] if request.block2 is not None else 0
+                response.block2 = (num, 1 if num * 64 + 64 < len(data) else 0, 64)
+                response.size2 = len(data)
+                response.payload = data[num * 64:num * 64 + 64]
+            transaction = Transaction(request)
+            transaction.response = response
+            layer.receive_response(transaction)
+            return transaction
+
+        first = respond(req)
+        self.assertTrue(first.block_transfer)
+        requests = layer.block_requests(first)
+        self.assertEqual([request.block2 for request in requests], [(1, 0, 64), (2, 0, 64), (3, 0, 64)])
+        # the blocks are written at their offset whatever the order of the responses
+        fourth = layer.block_requests(respond(requests[2]))
+        self.assertEqual([request.block2 for request in fourth], [(4, 0, 64)])
+        self.assertEqual(layer.block_requests(respond(requests[0])), [])
+        # a block that failed is requested again
+        retry = layer.block_requests(respond(requests[1], defines.Codes.SERVICE_UNAVAILABLE.number))
+        self.assertEqual([request.block2 for request in retry], [(2, 0, 64)])
+        respond(retry[0])
+        last = respond(fourth[0])
+        self.assertFalse(last.block_transfer)
+        self.assertIs(last.request, req)
+        self.assertEqual(last.response.payload, data)
+        self.assertEqual(last.response.block2, (4, 0, 64))
+        self.assertEqual(len(layer._downloads), 0)
+
+    def test_stream_resource(self) -> None:
+        print("TEST_STREAM_RESOURCE")
+        data = bytes(i % 251 for i in range(3000))
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        self.addCleanup(os.remove, f.name)
+        server = Server()
+        layer = ResourceLayer(server)
+        block_layer = BlockLayer()
+        server.add("/file", StreamResource("file", f.name))
+        server.add("/chunks", StreamResource("chunks", lambda: (data[i:i + 700] for i in range(0, len(data), 700))))
+        server.add("/small", StreamResource("small", lambda: iter([b"abc", b"def"])))
+
+        def get(path:str, num:Optional[int]=None) -> Response:
+            req = self._request(1, path.encode("utf-8"))
+            req.uri_path = path
+            if num is not None:
+                req.block2 = (num, 0, 1024)
+            transaction = block_layer.receive_request(Transaction(req))
+            if not transaction.block_transfer:
+                transaction.resource = server.root[path]
+                transaction.response = Response()
+                layer.get_resource(transaction)
+                block_layer.send_response(transaction)
+            return transaction.response
+
+        first = get("/file")
+        # the size of the file, which is read by block
+        self.assertEqual(first.size2, 3000)
+        self.assertEqual(first.block2, (0, 1, 1024))
+        self.assertEqual(first.content_type, defines.Content_types["application/octet-stream"])
+        stream = block_layer._block2_receive.values()[0].payload
+        self.assertEqual([get("/file", num).payload for num in (1, 2)], [data[1024:2048], data[2048:]])
+        self.assertTrue(stream._file.closed)
+        self.assertEqual(len(block_layer._block2_receive), 0)
+
+        # the size of a representation produced by chunks is known at its end only
+        blocks = [get("/chunks")] + [get("/chunks", num) for num in (1, 2)]
+        self.assertEqual([response.size2 for response in blocks], [None, None, 3000])
+        self.assertEqual([response.block2[1] for response in blocks], [1, 1, 0])
+        self.assertEqual(b"".join(response.payload for response in blocks), data)
+        small = get("/small")
+        self.assertEqual((small.payload, small.block2), (b"abcdef", None))
+
+        stream = IteratorStream(iter([data[:1000], data[1000:]]))
+        self.assertEqual(stream.block(512, 512), (data[512:1024], True))
+        self.assertEqual(stream.block(512, 512), (data[512:1024], True))
+        self.assertRaises(ValueError, stream.block, 0, 512)
+        self.assertEqual(BufferStream(bytearray(data)).block(2900, 200), (data[2900:], False))
+
+    def test_serializer(self) -> None:
+        print("TEST_SERIALIZER")
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.type = defines.Types["CON"]
+        req.mid = 513
+        req.token = b"\x0a\x0b"
+        req.uri_path = "/a/" + "b" * 20
+        req.observe = 0
+        req.size2 = 70000
+        req.payload = "x" * 300
+        datagram = Serializer.serialize(req)
+        # header, token, Observe 0 (empty), Uri-Path "a", Uri-Path with an extended length, Size2 with an extended delta
+        self.assertEqual(datagram[:12], b"\x42\x01\x02\x01\x0a\x0b\x60\x51a\x0d\x07b")
+        self.assertEqual(datagram[31:36], b"\xd3\x04\x01\x11\x70")
+        self.assertEqual(datagram[36:], b"\xff" + b"x" * 300)
+
+        message = Serializer.deserialize(datagram, ("127.0.0.1", 5683))
+        self.assertEqual(message.mid, 513)
+        self.assertEqual(message.token, b"\x0a\x0b")
+        self.assertEqual(message.uri_path, "a/" + "b" * 20)
+        self.assertEqual(message.observe, 0)
+        self.assertEqual(message.size2, 70000)
+        self.assertEqual(message.payload, b"x" * 300)
+        self.assertEqual(Serializer.serialize(message), datagram)
+
+        # a malformed option value gives the error path, not an exception
+        for value in (-5, 1.5):
+            req = Request()
+            req.code = defines.Codes.GET.number
+            req.type = defines.Types["CON"]
+            req.mid = 514
+            option = Option()
+            option.number = defines.OptionRegistry.MAX_AGE.number
+            option._value = value
+            req.add_option(option)
+            self.assertIsNone(Serializer.serialize(req))
+
+        # a document is sliced by the block layer, it is not sent whole
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.type = defines.Types["CON"]
+        req.mid = 515
+        req.payload = LinkDocument([b"</a>", b",</b>"])
+        self.assertIsNone(Serializer.serialize(req))
+
+    def test_deserializer(self) -> None:
+        print("TEST_DESERIALIZER")
+        req = self._request(7, b"\x01\x02")
+        req.observe = 1
+        req.payload = "data"
+        datagram = Serializer.serialize(req)
+        message = Serializer.deserialize(datagram, ("127.0.0.1", 5683))
+        # options and payload are decoded on first access only
+        self.assertIsNotNone(message._raw_options)
+        self.assertIsNotNone(message._raw_payload)
+        self.assertEqual(message.token, b"\x01\x02")
+        self.assertEqual(message.observe, 1)
+        self.assertIsNone(message._raw_options)
+        message.add_option(req.options[0])
+        self.assertEqual([option.number for option in message.options], [6, 11, 11])
+        self.assertEqual(message.payload, b"data")
+
+        bad_request = defines.Codes.BAD_REQUEST.number
+        # option value longer than the datagram
+        self.assertEqual(Serializer.deserialize(datagram[:-6], ("127.0.0.1", 5683)), bad_request)
+        # unknown critical option 9
+        self.assertEqual(Serializer.deserialize(b"\x40\x01\x00\x01\x91x", ("127.0.0.1", 5683)), bad_request)
+        # invalid UTF-8 in Uri-Path
+        self.assertEqual(Serializer.deserialize(b"\x40\x01\x00\x01\xb1\xff", ("127.0.0.1", 5683)), bad_request)
+        # payload marker without payload
+        self.assertEqual(Serializer.deserialize(b"\x40\x01\x00\x01\xff", ("127.0.0.1", 5683)), bad_request)
+
+
+if __name__ == '__main__':
+    unittest.main()
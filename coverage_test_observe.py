@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+from typing import Hashable, Optional
+
+import socket
+import threading
+import time
+import unittest
+
+from coapthon import defines
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+from coapthon.messages.response import Response
+from coapthon.resources.resource import Resource
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+from coapthon.server.dispatcher import NotificationDispatcher
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class CountingResource(Resource):
+    def __init__(self, name:Optional[str]="Counting") -> None:
+        super(CountingResource, self).__init__(name, visible=True, observable=True, allow_children=False)
+        self.payload = "Counting Resource"
+        self.payload = (defines.Content_types["application/json"], '{"name": "Counting"}')
+        self.renders = 0
+        self.render_threads:list[str] = []
+
+    def render_GET(self, request:Request) -> Resource:
+        self.renders += 1
+        self.render_threads.append(threading.current_thread().name)
+        return self
+
+    def render_PUT(self, request:Request) -> Resource:
+        self.payload = bytes(request.payload).decode("utf-8")
+        return self
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.server = CoAP(("127.0.0.1", 0), notifiers=1)
+        self.resource = CountingResource()
+        self.server.add_resource("counting/", self.resource)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(5)
+        self.mid = 1
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.sock.close()
+
+    def _observe(self, token:bytes, accept:Optional[int]=None, type:str="CON", query:Optional[str]=None) -> Response:
+        req = Request()
+        req.code = defines.Codes.GET.number
+        req.uri_path = "/counting"
+        if query is not None:
+            req.uri_query = query
+        req.type = defines.Types[type]
+        req.mid = self.mid
+        req.token = token
+        req.observe = 0
+        if accept is not None:
+            req.accept = accept
+        self.mid += 1
+        message = Serializer.deserialize(Serializer.serialize(req), self.sock.getsockname())
+        self.server.receive_request(self.server._messageLayer.receive_request(message))
+        return self._receive()
+
+    def _receive(self) -> Response:
+        datagram, source = self.sock.recvfrom(4096)
+        return Serializer.deserialize(datagram, source)
+
+    def test_notification_fan_out(self) -> None:
+        print("TEST_NOTIFICATION_FAN_OUT")
+        json = defines.Content_types["application/json"]
+        for token, accept in ((b"\x01", None), (b"\x02", None), (b"\x03", json), (b"\x04", None)):
+            self.assertEqual(self._observe(token, accept).code, defines.Codes.CONTENT.number)
+        self.assertEqual(self.resource.renders, 4)
+
+        # one render per Accept, every observer gets its own token and MID
+        self.resource.observe_count += 1
+        self.server.notify(self.resource)
+        self.assertEqual(self.resource.renders, 6)
+        notifications = {}
+        for _ in range(4):
+            notification = self._receive()
+            notifications[notification.token] = notification
+        self.assertEqual(sorted(notifications), [b"\x01", b"\x02", b"\x03", b"\x04"])
+        self.assertEqual(len({notification.mid for notification in notifications.values()}), 4)
+        for token, notification in notifications.items():
+            self.assertEqual(notification.type, defines.Types["CON"])
+            self.assertEqual(notification.observe, self.resource.observe_count)
+            if token == b"\x03":
+                self.assertEqual(notification.payload, b'{"name": "Counting"}')
+                self.assertEqual(notification.content_type, json)
+            else:
+                self.assertEqual(notification.payload, b"Counting Resource")
+                self.assertEqual(notification.content_type, 0)
+        self.assertEqual(notifications[b"\x01"].datagram[4 + 1:], notifications[b"\x04"].datagram[4 + 1:])
+
+    def _change(self, payload:str) -> None:
+        self.resource.payload = payload
+        self.resource.observe_count += 1
+        self.server.notify(self.resource)
+
+    def test_conditional_observe(self) -> None:
+        print("TEST_CONDITIONAL_OBSERVE")
+        self.resource.payload = "20"
+        self._observe(b"\x01", type="NON")
+        self._observe(b"\x02", type="NON", query="pmin=0.3")
+        self._observe(b"\x03", type="NON", query="st=5")
+
+        # the changes within pmin are coalesced into one notification with the last state
+        start = time.monotonic()
+        for payload in ("22", "23", "27"):
+            self._change(payload)
+        received = [self._receive() for _ in range(5)]
+        tokens = [notification.token for notification in received]
+        self.assertEqual(tokens.count(b"\x01"), 3)
+        self.assertEqual(tokens.count(b"\x03"), 1)
+        self.assertEqual(received[-1].token, b"\x02")
+        self.assertEqual(received[-1].payload, b"27")
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+        self.assertEqual([n.payload for n in received if n.token == b"\x03"], [b"27"])
+        # the coalesced notification is rendered by the dispatcher, not by the thread of the timers
+        self.assertTrue(self.resource.render_threads[-1].startswith("CoAPNotifier"))
+
+    def test_pmax_keepalive(self) -> None:
+        print("TEST_PMAX_KEEPALIVE")
+        registration = self._observe(b"\x04", type="NON", query="pmax=0.2")
+        notification = self._receive()
+        self.assertEqual(notification.token, b"\x04")
+        self.assertEqual(notification.payload, b"Counting Resource")
+        # the keep-alive carries the sequence number of the unchanged resource
+        self.assertEqual(notification.observe, registration.observe)
+        self.assertEqual(self.resource.observe_count, registration.observe)
+        self.assertTrue(self.resource.render_threads[-1].startswith("CoAPNotifier"))
+
+        # cancelling the relation stops the keep-alives
+        self._observe(b"\x04", type="NON", query="pmax=0.2")
+        self.server._observeLayer.remove_subscriber(self._message(b"\x04"))
+        self.sock.settimeout(0.5)
+        self.assertRaises(socket.timeout, self.sock.recvfrom, 4096)
+
+    def test_pmax_keepalive_workers(self) -> None:
+        print("TEST_PMAX_KEEPALIVE_WORKERS")
+        # without notifiers the keep-alives are rendered by the worker pool
+        self.server.close()
+        self.server = CoAP(("127.0.0.1", 0), workers=1)
+        self.server.add_resource("counting/", self.resource)
+        self._observe(b"\x04", type="NON", query="pmax=0.2")
+        notification = self._receive()
+        self.assertEqual(notification.token, b"\x04")
+        self.assertTrue(self.resource.render_threads[-1].startswith("CoAPWorker"))
+
+    def test_dispatcher(self) -> None:
+        print("TEST_DISPATCHER")
+        release = threading.Event()
+        sent:list[list[Hashable]] = []
+        first, second, third = Resource("first"), Resource("second"), Resource("third")
+        relations = {first: ["a", "b"], second: ["c"], third: ["d"]}
+
+        def send(keys:list[Hashable]) -> None:
+            sent.append(keys)
+            release.wait(5)
+
+        dispatcher = NotificationDispatcher(relations.__getitem__, send, 1, 2, 1)
+        try:
+            self.assertTrue(dispatcher.submit(first))
+            while not sent:
+                time.sleep(0.01)
+            # a is being notified and b waits: the next changes of first are merged into one change,
+            # which gives a new notification to a and none to b
+            for _ in range(3):
+                self.assertTrue(dispatcher.submit(first))
+            self.assertTrue(dispatcher.submit(second))
+            # the backlog of changes is full, the change of third is dropped
+            self.assertFalse(dispatcher.submit(third))
+            self.assertEqual(dispatcher.queue_depth, 3)
+            release.set()
+            while dispatcher.stats()["dispatched"] < 4:
+                time.sleep(0.01)
+            self.assertEqual(sent, [["a"], ["b"], ["a"], ["c"]])
+            stats = dispatcher.stats()
+            self.assertEqual(stats["queue_depth"], 0)
+            self.assertEqual(stats["queue_max"], 3)
+            self.assertEqual(stats["submitted"], 3)
+            self.assertEqual(stats["coalesced"], 3)
+            self.assertEqual(stats["overflow"], 1)
+            self.assertEqual(stats["batches"], 4)
+        finally:
+            release.set()
+            dispatcher.shutdown(5)
+        self.assertFalse(dispatcher.submit(first))
+
+    def _put(self, token:bytes, payload:str) -> None:
+        req = Request()
+        req.code = defines.Codes.PUT.number
+        req.uri_path = "/counting"
+        req.type = defines.Types["CON"]
+        req.mid = self.mid
+        req.token = token
+        req.payload = payload
+        self.mid += 1
+        message = Serializer.deserialize(Serializer.serialize(req), self.sock.getsockname())
+        self.server.receive_request(self.server._messageLayer.receive_request(message))
+
+    def test_notify_changed(self) -> None:
+        print("TEST_NOTIFY_CHANGED")
+        self._observe(b"\x01", type="NON")
+        self._put(b"\x02", "Changed")
+
+        # the notification is rendered by the dispatcher, not by the thread of the request
+        received = {notification.token: notification for notification in (self._receive(), self._receive())}
+        self.assertEqual(received[b"\x02"].code, defines.Codes.CHANGED.number)
+        self.assertEqual(received[b"\x01"].code, defines.Codes.CONTENT.number)
+        self.assertEqual(received[b"\x01"].payload, b"Changed")
+        self.assertEqual(self.resource.render_threads[0], threading.current_thread().name)
+        self.assertTrue(self.resource.render_threads[1].startswith("CoAPNotifier"))
+        self.assertEqual(self.server.notification_stats()["submitted"], 1)
+
+        # a change the dispatcher cannot queue is dropped, not notified on the thread of the request
+        self.server._dispatcher.shutdown(5)
+        self._put(b"\x03", "Dropped")
+        self.assertEqual(self._receive().token, b"\x03")
+        self.sock.settimeout(0.5)
+        self.assertRaises(socket.timeout, self.sock.recvfrom, 4096)
+        self.assertEqual(len(self.resource.render_threads), 2)
+
+    def _message(self, token:bytes) -> Message:
+        message = Message()
+        message.destination = self.sock.getsockname()
+        message.token = token
+        return message
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import socket
+import threading
+import time
+import unittest
+
+from coapthon import defines
+from coapthon.messages.message import Message
+from coapthon.messages.request import Request
+from coapthon.scheduler import DeadlineQueue, Retransmitter, Scheduler
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+from coapthon.transaction import Transaction
+from exampleresources import GatedResource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.scheduler = Scheduler()
+        self.ack_timeout = defines.ACK_TIMEOUT
+        defines.ACK_TIMEOUT = 0.02
+
+    def tearDown(self) -> None:
+        defines.ACK_TIMEOUT = self.ack_timeout
+        self.scheduler.stop()
+
+    def test_order(self) -> None:
+        print("TEST_SCHEDULER_ORDER")
+        fired:list[int] = []
+        done = threading.Event()
+
+        def cb(i:int) -> None:
+            fired.append(i)
+            if len(fired) == 4:
+                done.set()
+
+        for i, delay in enumerate([0.08, 0.02, 0.06, 0.04, 0.05]):
+            handle = self.scheduler.call_later(delay, cb, i)
+            if i == 4:
+                handle.cancel()
+        self.assertTrue(done.wait(timeout=5))
+        time.sleep(0.05)
+        self.assertEqual(fired, [1, 3, 2, 0])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_cancel_many(self) -> None:
+        print("TEST_SCHEDULER_CANCEL")
+        fired:list[int] = []
+        handles = [self.scheduler.call_later(10, fired.append, i) for i in range(1000)]
+        for handle in handles[:900]:
+            handle.cancel()
+        self.assertEqual(len(self.scheduler), 100)
+        self.assertEqual(fired, [])
+
+    def test_cancel_race(self) -> None:
+        print("TEST_SCHEDULER_CANCEL_RACE")
+        ran = threading.Event()
+        handle = self.scheduler.call_later(0, ran.set)
+        self.assertTrue(ran.wait(timeout=5))
+        # a cancel that read the scheduler of the handle before the handle was run
+        self.scheduler._cancel(handle)
+        self.assertEqual(self.scheduler._cancelled_count, 0)
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_retransmit(self) -> None:
+        print("TEST_SCHEDULER_RETRANSMIT")
+        sent:list[Message] = []
+        given_up = threading.Event()
+        retransmitter = Retransmitter(sent.append, lambda t, m: given_up.set(), scheduler=self.scheduler)
+
+        transaction = Transaction()
+        message = Message()
+        message.type = defines.Types["CON"]
+        message.mid = 1
+        retransmitter.start(transaction, message)
+        self.assertTrue(given_up.wait(timeout=10))
+        self.assertEqual(len(sent), defines.MAX_RETRANSMIT)
+        self.assertTrue(message.timeouted)
+        self.assertIsNone(transaction.retransmit_handle)
+
+        # an acknowledged message is neither retransmitted nor given up
+        sent.clear()
+        given_up.clear()
+        transaction = Transaction()
+        message = Message()
+        message.type = defines.Types["CON"]
+        message.mid = 2
+        retransmitter.start(transaction, message)
+        message.acknowledged = True
+        transaction.retransmit_handle.cancel()
+        self.assertFalse(given_up.wait(timeout=1))
+        self.assertEqual(sent, [])
+
+    def test_deadline_queue(self) -> None:
+        print("TEST_SCHEDULER_DEADLINE_QUEUE")
+        queue = DeadlineQueue(0.05, self.scheduler)
+        fired:list[int] = []
+        done = threading.Event()
+
+        def cb(i:int) -> None:
+            fired.append(i)
+            if i == 9:
+                done.set()
+
+        handles = [queue.add(cb, i) for i in range(10)]
+        for handle in handles[2:8]:
+            handle.cancel()
+        self.assertEqual(len(queue), 4)
+        self.assertTrue(done.wait(timeout=5))
+        self.assertEqual(fired, [0, 1, 8, 9])
+        self.assertEqual(len(queue), 0)
+
+    def test_separate_ack(self) -> None:
+        print("TEST_SCHEDULER_SEPARATE_ACK")
+        server_address = ("127.0.0.1", 5683)
+        server = CoAP(server_address)
+        resource = GatedResource()
+        server.add_resource('gated/', resource)
+        server_thread = threading.Thread(target=server.listen, args=(1,))
+        server_thread.start()
+
+        serializer = Serializer()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        try:
+            req = Request()
+            req.code = defines.Codes.GET.number
+            req.uri_path = "/gated"
+            req.type = defines.Types["CON"]
+            req._mid = 100
+            req.token = b"\x01"
+            req.destination = server_address
+            sock.sendto(serializer.serialize(req), server_address)
+
+            # the handler is still running, so an empty ACK is sent after ACK_TIMEOUT
+            datagram, source = sock.recvfrom(4096)
+            ack = serializer.deserialize(datagram, source)
+            self.assertEqual(ack.type, defines.Types["ACK"])
+            self.assertEqual(ack.mid, 100)
+            self.assertFalse(ack.code)
+
+            resource.gate.set()
+            datagram, source = sock.recvfrom(4096)
+            response = serializer.deserialize(datagram, source)
+            self.assertEqual(response.type, defines.Types["CON"])
+            self.assertEqual(response.token, b"\x01")
+            self.assertEqual(response.code, defines.Codes.CONTENT.number)
+        finally:
+            resource.gate.set()
+            sock.close()
+            server.close()
+            server_thread.join(timeout=25)
+
+
+if __name__ == '__main__':
+    unittest.main()
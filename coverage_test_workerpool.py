@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import random
+import socket
+import threading
+import time
+import unittest
+
+from coapthon import defines
+from coapthon.messages.request import Request
+from coapthon.serializer import Serializer
+from coapthon.server.coap import CoAP
+from coapthon.server.workerpool import WorkerPool
+from exampleresources import GatedResource
+
+__author__ = 'Giacomo Tanganelli'
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.server_address:defines.ServerT = ("127.0.0.1", 5683)
+        self.current_mid:int = random.randint(1, 1000)
+        self.server:CoAP = CoAP(self.server_address, workers=1, queue_size=1, shed_max_age=7)
+        self.resource = GatedResource()
+        self.server.add_resource('gated/', self.resource)
+        self.server_thread:threading.Thread = threading.Thread(target=self.server.listen, args=(1,))
+        self.server_thread.start()
+
+    def tearDown(self) -> None:
+        self.resource.gate.set()
+        self.server.close()
+        self.server_thread.join(timeout=25)
+        self.server = None
+
+    def test_shed(self) -> None:
+        print("TEST_SHED")
+        serializer = Serializer()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(10)
+
+        # one request in the worker, one in the queue, the remaining ones are shed
+        for i in range(4):
+            req = Request()
+            req.code = defines.Codes.GET.number
+            req.uri_path = "/gated"
+            req.type = defines.Types["NON"]
+            req._mid = self.current_mid + i
+            req.token = bytes([i + 1])
+            req.destination = self.server_address
+            sock.sendto(serializer.serialize(req), self.server_address)
+            if i == 0:
+                self.assertTrue(self.resource.entered.wait(timeout=10))
+
+        shed = []
+        for i in range(2):
+            datagram, source = sock.recvfrom(4096)
+            response = serializer.deserialize(datagram, source)
+            shed.append(response)
+        for response in shed:
+            self.assertEqual(response.code, defines.Codes.SERVICE_UNAVAILABLE.number)
+            self.assertEqual(response.max_age, 7)
+        self.assertEqual(sorted(r.token for r in shed), [b"\x03", b"\x04"])
+
+        self.resource.gate.set()
+        for i in range(2):
+            datagram, source = sock.recvfrom(4096)
+            response = serializer.deserialize(datagram, source)
+            self.assertEqual(response.code, defines.Codes.CONTENT.number)
+            self.assertEqual(response.payload, b"Gated Resource")
+        sock.close()
+
+        stats = self.server.worker_stats()
+        self.assertEqual(stats["shed"], 2)
+        self.assertEqual(stats["submitted"], 2)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_pool(self) -> None:
+        print("TEST_POOL")
+        pool = WorkerPool(2, 4)
+        done = threading.Event()
+        results:list[int] = []
+        gate = threading.Event()
+
+        def task(i:int) -> None:
+            gate.wait(timeout=10)
+            results.append(i)
+            if len(results) == 6:
+                done.set()
+
+        accepted = [pool.submit(task, i) for i in range(8)]
+        # two tasks may already be running, so between four and six are accepted
+        self.assertIn(accepted.count(True), range(4, 7))
+        gate.set()
+        # the rejected tasks are submitted again while the queue drains
+        deadline = time.monotonic() + 10
+        while accepted.count(True) < 6 and time.monotonic() < deadline:
+            accepted.append(pool.submit(task, len(accepted)))
+            if not accepted[-1]:
+                time.sleep(0.01)
+        self.assertEqual(accepted.count(True), 6)
+        self.assertTrue(done.wait(timeout=10))
+        stats = pool.stats()
+        self.assertEqual(stats["workers"], 2)
+        self.assertEqual(stats["shed"], accepted.count(False))
+        self.assertGreaterEqual(stats["wait_max"], stats["wait_avg"])
+        pool.shutdown(timeout=5)
+
+    def test_close(self) -> None:
+        print("TEST_CLOSE")
+        # the server waits for its workers when it is closed
+        threads = self.server._workerPool._threads
+        self.assertTrue(all(t.is_alive() for t in threads))
+        self.server.close()
+        self.assertFalse(any(t.is_alive() for t in threads))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 from __future__ import annotations
 from typing import Optional, cast
 
+import threading
 import time
 from coapthon import defines
 
@@ -117,6 +118,20 @@ class Long(Resource):
         return self
 
 
+class GatedResource(Resource):
+
+    def __init__(self, name:Optional[str]="Gated", coap_server:Optional[CoAP]=None):
+        super(GatedResource, self).__init__(name, coap_server, visible=True, observable=False, allow_children=False)
+        self.payload = "Gated Resource"
+        self.gate = threading.Event()
+        self.entered = threading.Event()
+
+    def render_GET(self, request:Request) -> Resource:
+        self.entered.set()
+        self.gate.wait(timeout=10)
+        return self
+
+
 class Big(Resource):
 
     def __init__(self, name:Optional[str]="Big", coap_server:Optional[CoAP]=None):